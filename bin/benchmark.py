@@ -0,0 +1,345 @@
+""" Benchmarks full scaling passes against synthetic fleets.
+
+Every external service is replaced by an in-process stand-in: Graphite serves
+synthetic raw responses for N hosts x T minutes, EC2 reports instance sizes,
+the deployment API returns fixed build and instance ids, and KBS prints a
+deployment id. Each fleet size runs in a fresh process, so peak memory is
+measured per size.
+
+Usage:
+	python bin/benchmark.py --hosts 10 100 1000 5000 --output bench.json
+	python bin/benchmark.py --baseline bench.json --tolerance 0.25
+
+Results are JSON: per-stage latency (from leptoid.metrics timers), pass time,
+throughput and peak RSS for every fleet size and pass. With --baseline, the
+script exits with status 1 if any pass is more than ${tolerance} slower than
+the baseline's.
+"""
+
+import os
+import sys
+import json
+import yaml
+import argparse
+import resource
+import tempfile
+import multiprocessing
+import numpy as np
+from time import time
+from StringIO import StringIO
+from collections import namedtuple
+
+import logging
+
+sys.path.insert(0, "")
+
+from leptoid.targets import SERVICES, TARGETS
+
+# Synthetic fleet defaults: minutes of history, and the seed for host loads.
+DEFAULT_HOSTS = [10, 100, 1000, 5000]
+DEFAULT_MINUTES = 4320
+DEFAULT_PASSES = 2
+SEED = 1234
+
+INSTANCE_TYPES = ['m1.small', 'm1.medium', 'm1.large', 'm1.xlarge']
+ENVIRONMENTS = ['Production', 'Staging']
+
+Host = namedtuple('Host', 'environment service instance_id instance_type load')
+Instance = namedtuple('Instance', 'id instance_type')
+Reservation = namedtuple('Reservation', 'instances')
+
+def synthetic_fleet(hosts, seed=SEED):
+	""" Spreads ${hosts} hosts across every service and environment, with
+	baseline utilizations on both sides of the scaling limits.
+	"""
+	state = np.random.RandomState(seed)
+	fleet = []
+	for idx in xrange(hosts):
+		fleet.append(Host(ENVIRONMENTS[idx % 2],
+			SERVICES[(idx // 2) % len(SERVICES)], 'i-%08x' % idx,
+			INSTANCE_TYPES[idx % len(INSTANCE_TYPES)],
+			state.uniform(0.05, 0.9)))
+	return fleet
+
+class SyntheticGraphite(object):
+	"""
+	Serves raw-format Graphite responses for a synthetic fleet. Arrival rates
+	follow a daily cycle around each host's load; service times are constant,
+	so utilization stays near the host's load. Values only depend on the
+	timestamp, so overlapping requests agree.
+	"""
+
+	def __init__(self, fleet, minutes, step=60):
+		self.fleet = fleet
+		self.minutes = minutes
+		self.step = step
+		self.cache = dict()
+
+	def _series(self, host, metric, start, npoints):
+		""" Raw-format line for one host and metric. """
+		if metric == 'arrival_rates':
+			name = ('scale(Knewton.%s.%s.Instance.%s.arrival_rate,0.016666)' %
+					(host.environment, host.service, host.instance_id))
+			minutes = (start + self.step * np.arange(npoints)) / 60.
+			values = 60. * host.load * (1 + 0.2 * np.sin(
+				2 * np.pi * (minutes / 1440. + host.load)))
+		else:
+			name = ('Knewton.%s.%s.Instance.%s.proxy_service_time_avg' %
+					(host.environment, host.service, host.instance_id))
+			values = np.ones(npoints) / 60.
+		return '%s,%i,%i,%i|%s\n' % (name, start, start + npoints * self.step,
+				self.step, ('%.6f,' * npoints % tuple(values))[:-1])
+
+	def render(self, targets, params):
+		""" Returns the raw response body for a /render request. """
+		# Incremental requests ask for '-Ns'; anything else is the full window.
+		window = params.get('from', '')
+		seconds = int(window[1:-1]) if window.endswith('s') else \
+				self.minutes * 60
+		end = int(time()) // self.step * self.step
+		start = end - seconds // self.step * self.step
+		npoints = (end - start) // self.step
+
+		body = []
+		for target in targets:
+			metric = 'arrival_rates' if 'arrival_rate' in target else \
+					'service_times'
+			key = (target, start, npoints)
+			if key not in self.cache:
+				self.cache[key] = ''.join(self._series(host, metric, start,
+					npoints) for host in self.fleet
+					if '.%s.%s.' % (host.environment, host.service) in target)
+			body.append(self.cache[key])
+		return ''.join(body)
+
+	def prime(self, api_params):
+		""" Renders the full window for every target ahead of time, so the
+		first pass doesn't time response generation.
+		"""
+		for targets in TARGETS.itervalues():
+			for target in targets:
+				self.render([target], api_params)
+
+	def urlopen(self, call):
+		""" Stand-in for urllib2.urlopen on /render URLs. """
+		query = call.split('?', 1)[1]
+		return StringIO(self._handle(query))
+
+	def _handle(self, query):
+		params, targets = dict(), []
+		for item in query.split('&'):
+			if not item:
+				continue
+			key, value = item.split('=', 1)
+			if key == 'target':
+				targets.append(value)
+			else:
+				params[key] = value
+		return self.render(targets, params)
+
+	def connection(self, host, timeout=None):
+		""" Stand-in for httplib.HTTPSConnection. """
+		return GraphiteConnection(self)
+
+class GraphiteConnection(object):
+	""" Keep-alive connection to a SyntheticGraphite. """
+
+	def __init__(self, graphite):
+		self.graphite = graphite
+		self.query = None
+
+	def request(self, method, path):
+		self.query = path.split('?', 1)[1]
+
+	def getresponse(self):
+		response = StringIO(self.graphite._handle(self.query))
+		response.status = 200
+		return response
+
+	def close(self):
+		pass
+
+class SyntheticEC2(object):
+	""" Stand-in for boto's EC2Connection for one environment. """
+
+	def __init__(self, fleet, environment):
+		self.sizes = dict((host.instance_id, host.instance_type)
+				for host in fleet if host.environment.lower() == environment)
+
+	def get_all_instances(self):
+		return [Reservation([Instance(iid, size)
+			for iid, size in self.sizes.iteritems()])]
+
+	def get_instance_attribute(self, instance_id, attribute):
+		return {attribute: self.sizes[instance_id]}
+
+class SyntheticKBS(object):
+	""" Stand-in for a KBS process started with subprocess.Popen. """
+
+	def __init__(self, args, stdout=None, **kwargs):
+		self.pid = os.getpid()
+		self.returncode = 0
+		self.stdout = StringIO("Deployment 12345 started...\n")
+
+	def kill(self):
+		pass
+
+	def wait(self):
+		return 0
+
+def _config(backend):
+	""" Writes a scaling config for the benchmark and returns its path. """
+	with open('leptoid/leptoid.conf') as infile:
+		config = yaml.load(infile)
+	config['model_config']['backend'] = backend
+	config['forecast_pool'] = {'workers': 1}
+	config['plot_config'] = {'enabled': False}
+	config['metrics_config'] = {'enabled': False}
+	config['noop'] = False
+	config['incremental_config']['store_directory'] = None
+	handle, path = tempfile.mkstemp(suffix='.yml')
+	with os.fdopen(handle, 'w') as outfile:
+		yaml.dump(config, outfile)
+	return path
+
+def run_fleet(hosts, minutes, passes, backend):
+	"""
+	Runs ${passes} scaling passes for a synthetic fleet of ${hosts} hosts.
+
+	Returns a dict with the fleet size, setup time, per-pass results and peak
+	RSS in kilobytes.
+	"""
+	import leptoid.deploy as deploy
+	import leptoid.graphite as graphite
+	import leptoid.scaler as scaler_module
+	import leptoid.utils as utils
+	from leptoid.forecast_pool import ForecastPool
+	from leptoid.metrics import METRICS, MemorySink
+
+	started = time()
+	fleet = synthetic_fleet(hosts)
+	fake_graphite = SyntheticGraphite(fleet, minutes)
+	config_path = _config(backend)
+	scaler = scaler_module.LeptoidScaler(TARGETS, scaling_config=config_path)
+	os.remove(config_path)
+	api_params = dict(scaler.api_params, **{'from': '-%imin' % minutes})
+	scaler.api_params = api_params
+	if scaler.history:
+		for history in scaler.history.itervalues():
+			history.history_seconds = minutes * 60
+	fake_graphite.prime(api_params)
+
+	# Stand-ins for Graphite, EC2, the deployment API and KBS.
+	graphite.urlopen = fake_graphite.urlopen
+	graphite.httplib.HTTPSConnection = fake_graphite.connection
+	utils.INSTANCE_SIZES.connections = dict(
+			(env.lower(), SyntheticEC2(fleet, env.lower()))
+			for env in ENVIRONMENTS)
+	utils.INSTANCE_SIZES.sizes.clear()
+	utils.INSTANCE_SIZES.refreshed.clear()
+	deploy.find_latest_build = lambda service: 100
+	scaler_module.find_instance_ids = lambda deploy_id: ('i-00000000',)
+	deploy.subprocess.Popen = SyntheticKBS
+	deploy.NOOP_MODE = False
+
+	sink = MemorySink()
+	METRICS.sink = sink
+	METRICS.prefix = 'bench'
+	METRICS.flush_interval = float('inf')
+	pool = ForecastPool(model_config=scaler.model_config,
+			detection_config=scaler.detection_config,
+			**scaler.pool_config)
+	setup = time() - started
+
+	results = []
+	for number in xrange(passes):
+		del sink.datapoints[:]
+		started = time()
+		queues = scaler.query_graphite_targets()
+		forecasts = pool.forecast(queues)
+		with METRICS.timer('scaler.evaluate'):
+			for queue, (insample, estimate) in zip(queues, forecasts):
+				if estimate is not None:
+					scaler.evaluate_instance(queue, estimate)
+			scaler.wait_for_deploys()
+		seconds = time() - started
+		METRICS.flush()
+
+		values = sink.values()
+		stages = dict((path[len('bench.'):-len('.total')], value)
+				for path, value in values.iteritems()
+				if path.endswith('.total'))
+		counters = dict((path[len('bench.'):], value)
+				for path, value in values.iteritems()
+				if not path.endswith(('.total', '.count', '.max')))
+		results.append({'pass': number, 'seconds': seconds,
+			'hosts_per_second': len(queues) / seconds if seconds else None,
+			'hosts_forecast': len(queues), 'stages': stages,
+			'counters': counters})
+
+	return {'hosts': hosts, 'minutes': minutes, 'backend': backend,
+			'setup_seconds': setup, 'passes': results,
+			'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def _run_isolated(args):
+	""" Runs one fleet size in a fresh worker process. """
+	pool = multiprocessing.Pool(1, maxtasksperchild=1)
+	try:
+		return pool.apply(run_fleet, args)
+	finally:
+		pool.close()
+		pool.join()
+
+def compare(results, baseline, tolerance):
+	"""
+	Compares pass times against a baseline run.
+
+	Returns a list of strs describing every pass more than ${tolerance}
+	(a fraction) slower than the baseline.
+	"""
+	previous = dict(((run['hosts'], run_pass['pass']), run_pass['seconds'])
+			for run in baseline['results'] for run_pass in run['passes'])
+	regressions = []
+	for run in results:
+		for run_pass in run['passes']:
+			before = previous.get((run['hosts'], run_pass['pass']))
+			if before and run_pass['seconds'] > before * (1 + tolerance):
+				regressions.append("%i hosts, pass %i: %0.2fs vs %0.2fs" % (
+					run['hosts'], run_pass['pass'], run_pass['seconds'],
+					before))
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--hosts', type=int, nargs='+', default=DEFAULT_HOSTS)
+	parser.add_argument('--minutes', type=int, default=DEFAULT_MINUTES)
+	parser.add_argument('--passes', type=int, default=DEFAULT_PASSES)
+	parser.add_argument('--backend', default='numpy', choices=['numpy', 'r'])
+	parser.add_argument('--output', help="write JSON results to this file")
+	parser.add_argument('--baseline', help="JSON results to compare against")
+	parser.add_argument('--tolerance', type=float, default=0.25)
+	args = parser.parse_args()
+
+	# Synthetic fleets trigger plenty of expected deploy errors (e.g. no size
+	# below m1.small); keep them out of the output.
+	logging.basicConfig(level=logging.CRITICAL)
+	results = [_run_isolated((hosts, args.minutes, args.passes, args.backend))
+			for hosts in args.hosts]
+	output = json.dumps({'benchmark': 'scaling_pass', 'results': results},
+			indent=2, sort_keys=True)
+	if args.output:
+		with open(args.output, 'w') as outfile:
+			outfile.write(output)
+	else:
+		print output
+
+	if args.baseline:
+		with open(args.baseline) as infile:
+			regressions = compare(results, json.load(infile), args.tolerance)
+		for regression in regressions:
+			sys.stderr.write("Regression: %s\n" % regression)
+		if regressions:
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
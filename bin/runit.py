@@ -3,36 +3,67 @@
 TODO: How should this run script REALLY look?
 """
 
-from time import sleep
 import logging
 logging.basicConfig(
 		filename='/var/leptoid/log/leptoid.log', level=logging.INFO,
 		format="%(asctime)s %(levelname)s:%(name)s %(message)s")
 LOG = logging.getLogger('runit')
 
+import atexit
 import sys
 sys.path.insert(0, "")
 
 from leptoid.targets import TARGETS
 from leptoid.scaler import LeptoidScaler
-import leptoid.forecasting as forecasting
+from leptoid.forecast_pool import ForecastPool
+from leptoid.plotting import ForecastPlotter
+from leptoid.scheduler import PassScheduler
+from leptoid.metrics import METRICS
 
 scaler = LeptoidScaler(TARGETS)
+METRICS.configure(scaler.metrics_config)
+pool = ForecastPool(model_config=scaler.model_config,
+		detection_config=scaler.detection_config,
+		**scaler.pool_config)
+plotter = ForecastPlotter.from_config(scaler.plot_config)
+scheduler = PassScheduler.from_config(scaler.scheduler_config)
+# Hand this worker's pairs over right away on shutdown, instead of when its
+# leases expire.
+if scaler.coordinator is not None:
+	atexit.register(scaler.coordinator.release)
 
 while True:
+	# Passes start on fixed wall-clock boundaries.
+	current = scheduler.next_pass()
 	LOG.info("\n*****\nBeginning scaling evaluation pass...\n*****")
+	# Every pass works from one snapshot of the config.
+	scaler.refresh_config()
+	# With several workers, renew leases and keep only this worker's pairs.
+	scaler.refresh_shards()
 	# Query Graphite for utilization data.
 	service_queues = scaler.query_graphite_targets()
 
-	for queue in service_queues:
-		# Generate utilization forecasts for every queue in the scaler.
-		insample_forecast, util_estimate = forecasting.forecast(queue)
+	# After an overrun, only forecast hosts likely to need scaling.
+	scaler.defer_low_priority(service_queues, current.behind)
 
+	# Generate utilization forecasts for every queue in the scaler.
+	forecasts = pool.forecast(service_queues)
+
+	for queue, (insample_forecast, util_estimate) in zip(
+			service_queues, forecasts):
 		# Scale instances up or down with KBS, based on the utilization forecast.
 		# Skip instances with insufficient sample data.
-		if (insample_forecast, util_estimate) != (None, None):
+		if util_estimate is not None:
 			scaler.evaluate_instance(queue, util_estimate)
+			# Plots render in the background; skip them once past the deadline.
+			if plotter is not None and not current.overrun():
+				plotter.submit(queue, insample_forecast, util_estimate)
+	scheduler.finish(current)
 	LOG.info(
 			"\n*****\nCompleted scaling evaluation pass. Sleeping...\n*****")
-	sleep(60)
+	stats = scheduler.stats()
+	LOG.info("Pass timing: %s" % stats)
+	for name in ('lag_last', 'duration_last', 'skipped', 'overruns'):
+		METRICS.gauge('scheduler.%s' % name, stats[name])
+	METRICS.flush()
 
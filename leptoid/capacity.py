@@ -0,0 +1,139 @@
+"""
+Capacity planning with queuing theory. Utilization is arrival rate times
+service time; moving an instance to a type with c times its relative capacity
+divides service time, and so utilization, by c. The planner turns an
+instance's peak utilization (forecast, or observed over the last few points)
+into the capacity it needs, and picks the smallest instance type of the same
+family that keeps utilization under the limit. A saturated host then reaches
+enough capacity in one deploy, instead of one size step per decision as with
+leptoid.deploy.UPSCALE_TARGETS. Downscales still move one size at a time
+unless multi-step downscaling is enabled, so a quiet spell can't shrink an
+instance several sizes in one pass.
+"""
+
+import numpy as np
+
+import logging
+LOG = logging.getLogger('capacity')
+
+# Relative capacity of each instance type (EC2 compute units).
+INSTANCE_CAPACITY = {
+		'm1.small': 1., 'm1.medium': 2., 'm1.large': 4., 'm1.xlarge': 8.,
+		'm1.2xlarge': 16.,
+		'm2.xlarge': 6.5, 'm2.2xlarge': 13., 'm2.4xlarge': 26.,
+		'c1.medium': 5., 'c1.xlarge': 20.}
+
+# Downscaled instances should stay this far below the upscale limit, so the
+# next pass doesn't scale them straight back up.
+HEADROOM = 0.8
+
+# Latest observed points (arrival rate times service time) considered along
+# with the forecast.
+RECENT_POINTS = 5
+
+class CapacityPlanner(object):
+	""" Picks the instance type an instance should move to. """
+
+	def __init__(self, capacities=None, headroom=HEADROOM,
+			recent_points=RECENT_POINTS, multi_step_downscale=False):
+		"""
+		Parameters
+		----------
+		capacities
+			dict mapping instance types ('m1.large') to relative capacity
+		headroom
+			float, fraction of the upscale limit a downscaled instance may
+			reach
+		recent_points
+			int, latest observations whose utilization is also planned for
+		multi_step_downscale
+			bool, whether downscales may skip sizes; by default they move to
+			the next smaller type
+		"""
+		self.capacities = dict(capacities or INSTANCE_CAPACITY)
+		self.headroom = headroom
+		self.recent_points = recent_points
+		self.multi_step_downscale = multi_step_downscale
+
+	@classmethod
+	def from_config(cls, capacity_config):
+		""" Builds a planner from capacity_config, or returns None if capacity
+		planning is disabled.
+		"""
+		if not capacity_config or not capacity_config.get('enabled'):
+			return None
+		return cls(capacity_config.get('capacities'),
+				capacity_config.get('headroom', HEADROOM),
+				capacity_config.get('recent_points', RECENT_POINTS),
+				capacity_config.get('multi_step_downscale', False))
+
+	def family(self, instance_type):
+		""" Instance types sharing instance_type's family, by capacity. """
+		prefix = instance_type.split('.')[0]
+		return sorted((capacity, name) for name, capacity in
+				self.capacities.iteritems() if name.split('.')[0] == prefix)
+
+	def peak_utilization(self, queue, estimated_util):
+		""" Highest forecast utilization, or observed utilization (arrival
+		rate times service time) over the latest points.
+		"""
+		observed = np.multiply(
+				np.asarray(queue.arrival_rate)[-1 * self.recent_points:],
+				np.asarray(queue.service_time)[-1 * self.recent_points:])
+		return np.nanmax(np.concatenate([np.asarray(estimated_util,
+			dtype=float), observed]))
+
+	def target(self, queue, estimated_util, limit):
+		"""
+		Finds the smallest instance type keeping utilization under limit.
+
+		Parameters
+		----------
+		queue
+			leptoid.ServiceQueue with the instance's type and queuing data
+		estimated_util
+			np.array, forecast utilization over the scaling horizon
+		limit
+			float, utilization the instance should stay under
+
+		Returns the instance type (e.g. 'm1.xlarge'): the largest of the
+		family if none is big enough. Returns None if the instance's type
+		isn't in the capacity table.
+		"""
+		current = queue.instance_size
+		if current not in self.capacities:
+			return None
+		demand = self.peak_utilization(queue, estimated_util) * \
+				self.capacities[current]
+		sizes = self.family(current)
+		for capacity, name in sizes:
+			if demand <= limit * capacity:
+				break
+		LOG.info("\t%s:%s needs %0.2f units of capacity; %s has %0.2f." %
+				(queue.service, queue.instance_id, demand, name, capacity))
+		return name
+
+	def upscale_target(self, queue, estimated_util, upscale_limit):
+		""" Target type for an upscale, or None if no larger type helps. """
+		target = self.target(queue, estimated_util, upscale_limit)
+		if target is None or self.capacities[target] <= \
+				self.capacities[queue.instance_size]:
+			return None
+		return target
+
+	def downscale_target(self, queue, estimated_util, upscale_limit):
+		""" Target type for a downscale, keeping utilization under
+		headroom * upscale_limit, or None if no smaller type does. Unless
+		multi-step downscaling is enabled, this is at most the next smaller
+		type.
+		"""
+		target = self.target(queue, estimated_util,
+				self.headroom * upscale_limit)
+		current = self.capacities.get(queue.instance_size)
+		if target is None or self.capacities[target] >= current:
+			return None
+		if not self.multi_step_downscale:
+			smaller = [name for capacity, name in
+					self.family(queue.instance_size) if capacity < current]
+			target = smaller[-1]
+		return target
@@ -0,0 +1,238 @@
+"""
+Change detection ahead of forecasting. Most hosts' utilization follows its
+last forecast closely from one pass to the next, so refitting them every
+minute buys nothing. Before a pass is forecast, each host's newest points are
+compared against the forecast made for them:
+
+(1)		any point outside the forecast's prediction interval (mean +/-
+		${interval} residual standard deviations) triggers a refit;
+(2)		a two-sided CUSUM over the standardized errors catches smaller,
+		persistent shifts that stay inside the interval;
+(3)		forecasts are refit anyway once ${max_age} points have been observed
+		since the fit, or once the new points use up the forecast horizon.
+
+Hosts that pass all checks keep their previous forecast, shifted forward by
+the number of new points. Every host's outcome is recorded in reasons, one of
+REASONS, for the current pass.
+"""
+
+import numpy as np
+
+import logging
+LOG = logging.getLogger('change_detection')
+
+from leptoid.metrics import METRICS
+
+# Outcomes recorded for each host. 'unchanged' and 'shifted' reuse the
+# previous forecast; every other reason refits.
+REASONS = ('new', 'unchanged', 'shifted', 'interval', 'cusum', 'age',
+		'expired')
+REUSED = ('unchanged', 'shifted')
+
+# Residuals used to estimate a forecast's error, and the smallest standard
+# deviation used to standardize errors (flat series have none).
+SIGMA_WINDOW = 60
+MIN_SIGMA = 1e-3
+
+class PreviousForecast(object):
+	""" Last forecast for a host, and the CUSUM state since it was made. """
+	__slots__ = ('last_index', 'in_sample', 'estimate', 'sigma', 'high',
+			'low', 'age')
+
+	def __init__(self, last_index, in_sample, estimate, sigma):
+		"""
+		Parameters
+		----------
+		last_index
+			index of the last observation the forecast was made from
+		in_sample
+			np.array, one-step ahead forecasts over the series
+		estimate
+			np.array, forecast beyond last_index
+		sigma
+			float, standard deviation of the in-sample residuals
+		"""
+		self.last_index = last_index
+		self.in_sample = in_sample
+		self.estimate = estimate
+		self.sigma = sigma
+		self.high = 0.
+		self.low = 0.
+		self.age = 0
+
+def _series(queues):
+	""" Yields (index, values) for every queue's utilization. """
+	if hasattr(queues, 'utilization') and hasattr(queues, 'index'):
+		# Columnar fleets share one index.
+		for row in xrange(len(queues)):
+			yield queues.index, queues.utilization[row]
+	else:
+		for queue in queues:
+			utilization = queue.utilization
+			yield getattr(utilization, 'index', None), \
+					np.asarray(utilization, dtype=float)
+
+def _shift(values, steps):
+	""" Drops the first ${steps} forecasts and extends the forecast along its
+	last slope, which is how a linear-trend forecast continues.
+	"""
+	if len(values) < 2:
+		return np.repeat(values[-1:], len(values))
+	slope = values[-1] - values[-2]
+	extension = values[-1] + slope * np.arange(1, steps + 1)
+	return np.concatenate([values[steps:], extension])
+
+class ChangeDetector(object):
+	"""
+	Decides, host by host, whether a forecast can be carried over from the
+	previous pass.
+	"""
+
+	def __init__(self, interval=3.0, drift=0.5, threshold=4.0, max_age=15):
+		"""
+		Parameters
+		----------
+		interval
+			float, half-width of the prediction interval, in residual
+			standard deviations
+		drift
+			float, CUSUM allowance per point, in standard deviations
+		threshold
+			float, CUSUM decision threshold, in standard deviations
+		max_age
+			int, points observed since a fit after which it is refit anyway
+		"""
+		self.interval = interval
+		self.drift = drift
+		self.threshold = threshold
+		self.max_age = max_age
+		self.previous = dict()
+		self.reasons = dict()
+
+	@classmethod
+	def from_config(cls, detection_config):
+		""" Builds a detector from detection_config, or returns None if change
+		detection is disabled.
+		"""
+		if not detection_config or not detection_config.get('enabled'):
+			return None
+		return cls(detection_config.get('interval', 3.0),
+				detection_config.get('cusum_drift', 0.5),
+				detection_config.get('cusum_threshold', 4.0),
+				detection_config.get('max_age', 15))
+
+	def _check(self, previous, index, values, new_points):
+		"""
+		Tests a host's new points against its previous forecast.
+
+		Returns (reason, result), where result is the shifted forecast if it
+		can be reused and None otherwise.
+		"""
+		if not new_points:
+			return 'unchanged', (previous.in_sample, previous.estimate)
+		if new_points >= len(previous.estimate) or \
+				previous.age + new_points > self.max_age:
+			return 'age', None
+
+		errors = (values[-1 * new_points:] -
+				previous.estimate[:new_points]) / previous.sigma
+		if (np.abs(errors) > self.interval).any():
+			return 'interval', None
+		high, low = previous.high, previous.low
+		for error in errors:
+			high = max(0., high + error - self.drift)
+			low = max(0., low - error - self.drift)
+		if max(high, low) > self.threshold:
+			return 'cusum', None
+
+		in_sample = np.concatenate([previous.in_sample,
+			previous.estimate[:new_points]])[-1 * len(values):]
+		estimate = _shift(previous.estimate, new_points)
+		shifted = PreviousForecast(index[-1], in_sample, estimate,
+				previous.sigma)
+		shifted.high, shifted.low = high, low
+		shifted.age = previous.age + new_points
+		return 'shifted', shifted
+
+	def check(self, queues, keys):
+		"""
+		Checks every queue against its previous forecast.
+
+		Parameters
+		----------
+		queues
+			list of leptoid.ServiceQueues, or a leptoid.FleetQueues
+		keys
+			list of (env, service, instance_id) tuples, one per queue
+
+		Returns a list with the reusable (in_sample_forecast, util_estimate)
+		for each queue, or None where the queue must be forecast.
+		"""
+		self.reasons = dict()
+		previous, self.previous = self.previous, dict()
+		counts = dict()
+		results = []
+		# Hosts in a fleet share an index, and usually their last update.
+		new_points = dict()
+		for key, (index, values) in zip(keys, _series(queues)):
+			entry = previous.get(key)
+			if entry is None or index is None:
+				reason, result = 'new', None
+			elif entry.last_index < index[0]:
+				reason, result = 'expired', None
+			else:
+				position = (id(index), entry.last_index)
+				if position not in new_points:
+					new_points[position] = int(
+							(index > entry.last_index).sum())
+				reason, result = self._check(entry, index, values,
+						new_points[position])
+			if reason == 'unchanged':
+				self.previous[key] = entry
+			elif reason == 'shifted':
+				self.previous[key] = result
+				result = (result.in_sample, result.estimate)
+			self.reasons[key] = reason
+			counts[reason] = counts.get(reason, 0) + 1
+			results.append(result)
+
+		for reason, count in counts.iteritems():
+			METRICS.incr('change_detection.%s' % reason, count)
+		reused = sum(counts.get(reason, 0) for reason in REUSED)
+		LOG.info("Reusing %i of %i forecasts: %s" % (reused, len(results),
+			counts))
+		return results
+
+	def update(self, queues, keys, results):
+		"""
+		Remembers freshly made forecasts for the next pass.
+
+		Parameters
+		----------
+		queues
+			list of leptoid.ServiceQueues, or a leptoid.FleetQueues
+		keys
+			list of (env, service, instance_id) tuples, one per queue
+		results
+			list of (in_sample_forecast, util_estimate) tuples, one per queue
+		"""
+		for key, (index, values), (in_sample, estimate) in zip(keys,
+				_series(queues), results):
+			if index is None or in_sample is None or estimate is None or \
+					not len(index):
+				continue
+			in_sample = np.asarray(in_sample, dtype=float)
+			residuals = (values[-1 * len(in_sample):] -
+					in_sample)[-1 * SIGMA_WINDOW:]
+			residuals = residuals[~np.isnan(residuals)]
+			sigma = max(np.std(residuals) if len(residuals) else 0.,
+					MIN_SIGMA)
+			self.previous[key] = PreviousForecast(index[-1], in_sample,
+					np.asarray(estimate, dtype=float), sigma)
+
+	def summary(self):
+		""" Returns a dict counting this pass's hosts by reason. """
+		counts = dict()
+		for reason in self.reasons.itervalues():
+			counts[reason] = counts.get(reason, 0) + 1
+		return counts
@@ -0,0 +1,106 @@
+"""
+Leptoid's scaling configuration, parsed once and reloaded when it changes.
+
+The YAML file is only parsed again when its modification time (or size)
+changes, and only when a caller asks for a fresh snapshot, which the run
+script does once at the start of each pass. Everything else reads the last
+snapshot, so a pass never sees half of an edit, and the hot path does no file
+I/O. If the file disappears or no longer parses, the last good snapshot is
+kept.
+
+    from leptoid.config import CONFIG
+
+    config = CONFIG.snapshot()		# start of a pass
+    ...
+    CONFIG.current()['noop']		# anywhere during the pass
+"""
+
+import os
+import yaml
+import threading
+
+import logging
+LOG = logging.getLogger('config')
+
+SCALING_CONFIG = 'leptoid/scaling_config.yml'
+
+class ConfigFile(object):
+	""" Cached contents of a YAML configuration file. """
+
+	def __init__(self, path, stat=os.stat):
+		"""
+		Parameters
+		----------
+		path
+			str, path to the YAML file
+		stat
+			callable returning an os.stat result for path
+		"""
+		self.path = path
+		self.stat = stat
+		self.lock = threading.Lock()
+		self.signature = None
+		self.config = None
+		self.version = 0
+
+	def _signature(self):
+		""" Returns (mtime, size) for the file, or None if it is missing. """
+		try:
+			info = self.stat(self.path)
+		except OSError:
+			return None
+		return (info.st_mtime, info.st_size)
+
+	def _load(self, signature):
+		""" Parses the file and makes it the current snapshot. """
+		with open(self.path, 'r') as infile:
+			config = yaml.load(infile)
+		if not isinstance(config, dict):
+			raise Exception("%s does not hold a YAML mapping." % self.path)
+		self.config = config
+		self.signature = signature
+		self.version += 1
+		if self.version > 1:
+			LOG.info("Reloaded %s." % self.path)
+
+	def snapshot(self):
+		"""
+		Reloads the file if it changed since the last snapshot.
+
+		Returns the configuration dict. Callers shouldn't modify it; it is
+		shared until the next reload.
+		"""
+		with self.lock:
+			signature = self._signature()
+			if self.config is not None and signature == self.signature:
+				return self.config
+			if signature is None and self.config is not None:
+				LOG.warning("%s is missing; keeping the last configuration." %
+						self.path)
+				return self.config
+			try:
+				self._load(signature)
+			except Exception, e:
+				if self.config is None:
+					raise
+				LOG.error("Could not reload %s; keeping the last "
+						"configuration: %s" % (self.path, e))
+				self.signature = signature
+			return self.config
+
+	def current(self):
+		""" Returns the last snapshot, loading the file if there is none. """
+		config = self.config
+		if config is None:
+			config = self.snapshot()
+		return config
+
+# Process-wide scaling configuration. load() points it at another file.
+CONFIG = ConfigFile(SCALING_CONFIG)
+
+def load(path=SCALING_CONFIG):
+	""" Makes ${path} the process-wide configuration, and returns it. """
+	global CONFIG
+	if CONFIG.path != path:
+		CONFIG = ConfigFile(path)
+	return CONFIG
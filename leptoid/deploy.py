@@ -1,13 +1,19 @@
 """ Functions wrapping Leptoid's upscaling/downscaling work. """
 
 from re import findall
+from time import time
 
+import os
+import signal
 import subprocess
+import threading
+import Queue
 import logging
 LOG = logging.getLogger('deploy')
 
 from leptoid.deploy_api import find_latest_build
-from leptoid.utils import fetch_yaml
+import leptoid.config as configuration
+from leptoid.metrics import METRICS, timed
 
 # Mapping instance sizes to upscale and downscale targets.
 UPSCALE_TARGETS = {
@@ -30,9 +36,23 @@ DOWNSCALE_TARGETS = {
 			'xlarge': 'medium'}
 		}
 
-NOOP_MODE = fetch_yaml('leptoid/scaling_config.yml')['noop']
+# Overrides the config's noop flag when set to True or False.
+NOOP_MODE = None
 
-def upscale(queue):
+def noop_mode():
+	""" Returns whether KBS commands are only logged, following the noop
+	flag of the current config snapshot unless NOOP_MODE is set.
+	"""
+	if NOOP_MODE is not None:
+		return NOOP_MODE
+	return configuration.CONFIG.current()['noop']
+
+# Background deployments: concurrent KBS commands, and seconds a single
+# command may run before it is killed.
+DEPLOY_WORKERS = 2
+KBS_TIMEOUT = 900
+
+def upscale(queue, timeout=None):
 	""" Externally-facing method for upscaling a service's instance size.
 
 	Parameters
@@ -40,6 +60,8 @@ def upscale(queue):
 	queue
 		leptoid.ServiceQueue object with the environment, service type, and
 		instance id to be scaled
+	timeout
+		int, seconds before the KBS command is killed (no limit if None)
 
 	Returns: int specifying deployment id#
 	"""
@@ -53,14 +75,14 @@ def upscale(queue):
 	try:
 		kbs_cmd = _build_kbs_command(queue, UPSCALE_TARGETS, build_id)
 		# Call KBS and parse output
-		deploy_id = _call_kbs(kbs_cmd)
+		deploy_id = _call_kbs(kbs_cmd, timeout)
 	except KeyError, e:
 		LOG.error("Could not upscale %s from a %s. Continuing..." %
 				(queue.instance_id, e))
 
 	return deploy_id
 
-def downscale(queue):
+def downscale(queue, timeout=None):
 	""" Externally-facing method for downscaling a service's instance size.
 
 	Parameters
@@ -68,6 +90,8 @@ def downscale(queue):
 	queue
 		leptoid.ServiceQueue object with the environment, service type, and
 		instance id to be scaled
+	timeout
+		int, seconds before the KBS command is killed (no limit if None)
 	
 	Returns: int specifying deployment id#
 	"""
@@ -81,14 +105,43 @@ def downscale(queue):
 	try:
 		kbs_cmd = _build_kbs_command(queue, DOWNSCALE_TARGETS, build_id)
 		# Call KBS, parse output.
-		deploy_id = _call_kbs(kbs_cmd)
+		deploy_id = _call_kbs(kbs_cmd, timeout)
 	except KeyError, e:
 		LOG.error("Could not downscale %s from a %s. Continuing..." %
 				(queue.instance_id, e))
 
 	return deploy_id
 
-def rollback(queue, deploy_id):
+def resize(queue, instance_type, timeout=None):
+	""" Externally-facing method for moving an instance straight to a given
+	instance type, e.g. one chosen by leptoid.capacity.CapacityPlanner.
+
+	Parameters
+	----------
+	queue
+		leptoid.ServiceQueue object with the environment, service type, and
+		instance id to be scaled
+	instance_type
+		str, target instance type (e.g. 'm1.xlarge')
+	timeout
+		int, seconds before the KBS command is killed (no limit if None)
+
+	Returns: int specifying deployment id#
+	"""
+
+	# Return blank deployment id in case of an error.
+	deploy_id = 0
+	build_id = find_latest_build(queue.service)
+
+	# Build KBS command and resize.
+	LOG.info("RESIZING INSTANCE %s" % queue.instance_id.upper())
+	instance_prefix, target_size = instance_type.split('.')
+	kbs_cmd = _build_kbs_resize(queue, instance_prefix, target_size, build_id)
+	deploy_id = _call_kbs(kbs_cmd, timeout)
+
+	return deploy_id
+
+def rollback(queue, deploy_id, timeout=None):
 	""" Externally-facing method for rolling back a deployment.
 
 	Parameters
@@ -98,6 +151,8 @@ def rollback(queue, deploy_id):
 		instance id to be scaled
 	deploy_id
 		int, deployment id to roll back
+	timeout
+		int, seconds before the KBS command is killed (no limit if None)
 	
 	Returns nothing.
 	
@@ -111,7 +166,7 @@ def rollback(queue, deploy_id):
 	# Build KBS command and scale down.
 	LOG.info("ROLLING BACK INSTANCE %s" % queue.instance_id.upper())
 	kbs_cmd = _build_kbs_rollback(deploy_id)
-	deploy_id = _call_kbs(kbs_cmd)
+	deploy_id = _call_kbs(kbs_cmd, timeout)
 
 def _build_kbs_command(queue, target_size_hash, build_id):
 	""" Build the KBS command for resizing a given instance. 
@@ -125,12 +180,17 @@ def _build_kbs_command(queue, target_size_hash, build_id):
 	build_id
 		int, id to use when deploying new box
 	"""
-	env, service, instance_id = (queue.environment, queue.service,
-			queue.instance_id)
-
 	# Get instance size, retrieve target size, and pass it into KBS.
 	[instance_prefix, instance_size] = queue.instance_size.split('.') 
 	target_size = target_size_hash[instance_prefix][instance_size]
+	return _build_kbs_resize(queue, instance_prefix, target_size, build_id)
+
+def _build_kbs_resize(queue, instance_prefix, target_size, build_id):
+	""" Build the KBS command deploying queue's service on an instance of
+	type ${instance_prefix}.${target_size}.
+	"""
+	env, service, instance_id = (queue.environment, queue.service,
+			queue.instance_id)
 	LOG.info("\tScaling %s:%s to %s" % (service, instance_id, target_size))
 
 	if queue.legacy:
@@ -147,13 +207,16 @@ def _build_kbs_rollback(deploy_id):
 	LOG.info("\tRolling back deployment #%s" % str(deploy_id))
 	return 'kbs d rollback %s' % str(deploy_id)
 
-def _call_kbs(kbs_cmd):
+@timed('deploy.kbs')
+def _call_kbs(kbs_cmd, timeout=None):
 	""" Calls KBS with build command. Returns deployment id.
 
 	Parameters
 	----------
 	kbs_cmd
 		str, command to issue to KBS
+	timeout
+		int, seconds before the command is killed (no limit if None)
 	
 	TODO: THIS IS HACKISH. It assumes KBS only outputs a single line,
 	then parses that single line for a deployment id. This will break when
@@ -162,9 +225,16 @@ def _call_kbs(kbs_cmd):
 	# Route STDOUT to a subprocess pipe, then parse the KBS output.
 	LOG.info("\tExecuting command:")
 	LOG.info("\t" + kbs_cmd)
-	if not NOOP_MODE:
-		p = subprocess.Popen(args=kbs_cmd.split(' '), stdout=subprocess.PIPE)
-		output = p.stdout.readline()
+	if not noop_mode():
+		if timeout is None:
+			p = subprocess.Popen(args=kbs_cmd.split(' '),
+					stdout=subprocess.PIPE)
+			output = p.stdout.readline()
+		else:
+			# Own process group, so a timeout also kills KBS's children.
+			p = subprocess.Popen(args=kbs_cmd.split(' '),
+					stdout=subprocess.PIPE, preexec_fn=os.setsid)
+			output = _read_with_timeout(p, timeout)
 		LOG.info(output)
 		depid = findall('[0-9]{4,6}', output)[0]
 	else:
@@ -172,3 +242,191 @@ def _call_kbs(kbs_cmd):
 
 	# Use regex to find the only numeric string in return value and extract it.
 	return int(depid)
+
+def _read_with_timeout(process, timeout):
+	""" Reads a KBS process's first line of output, killing the process if
+	nothing arrives within ${timeout} seconds.
+	"""
+	killed = []
+	def kill():
+		killed.append(True)
+		try:
+			os.killpg(process.pid, signal.SIGKILL)
+		except OSError:
+			pass
+
+	timer = threading.Timer(timeout, kill)
+	timer.start()
+	try:
+		output = process.stdout.readline()
+	finally:
+		timer.cancel()
+	if killed:
+		METRICS.incr('deploy.timeouts')
+		process.wait()
+		raise Exception("KBS command timed out after %is." % timeout)
+	return output
+
+class DeployJob(object):
+	""" A KBS command running (or waiting to run) in the background. """
+
+	def __init__(self, instance_id, function, args, timeout):
+		self.instance_id = instance_id
+		self.function = function
+		self.args = args
+		self.timeout = timeout
+		self.callbacks = []
+		self.deploy_id = None
+		self.error = None
+		self.superseded_by = None
+		self.finished = threading.Event()
+
+	def run(self):
+		""" Runs the command, then every completion callback. The executor
+		marks the job finished afterwards.
+		"""
+		kwargs = {} if self.timeout is None else {'timeout': self.timeout}
+		try:
+			self.deploy_id = self.function(*self.args, **kwargs)
+		except Exception, e:
+			LOG.error("Deployment for %s failed." % self.instance_id)
+			LOG.error(e)
+			METRICS.incr('deploy.failures')
+			self.error = e
+		self._run_callbacks()
+
+	def supersede(self, job):
+		""" Marks this job as combined into ${job}, which is already in
+		flight for the same instance: it never runs, and its callbacks see an
+		error.
+		"""
+		self.superseded_by = job
+		self.error = Exception("Superseded by a deployment already in flight "
+				"for %s." % self.instance_id)
+		self._run_callbacks()
+		self.finished.set()
+
+	def _run_callbacks(self):
+		""" Runs every completion callback, logging their failures. """
+		for callback in self.callbacks:
+			try:
+				callback(self)
+			except Exception, e:
+				LOG.error("Deployment callback for %s failed." %
+						self.instance_id)
+				LOG.error(e)
+
+	def wait(self, timeout=None):
+		""" Blocks until the job is done. Returns True if it finished. """
+		self.finished.wait(timeout)
+		return self.finished.is_set()
+
+class DeployExecutor(object):
+	"""
+	Runs upscale, downscale and rollback commands on a bounded number of
+	background threads, so a slow KBS call never holds up scaling decisions
+	for other instances. Only one command runs per instance at a time:
+	requests for an instance with a command in flight are combined with it.
+	"""
+
+	def __init__(self, workers=DEPLOY_WORKERS, timeout=KBS_TIMEOUT):
+		"""
+		Parameters
+		----------
+		workers
+			int, maximum number of concurrent KBS commands
+		timeout
+			int, seconds before a KBS command is killed
+		"""
+		self.workers = workers
+		self.timeout = timeout
+		self.jobs = Queue.Queue()
+		self.inflight = dict()
+		self.lock = threading.Lock()
+		self.threads = []
+
+	@classmethod
+	def from_config(cls, executor_config):
+		""" Builds an executor from executor_config, or returns None if
+		deployments should run in the calling thread.
+		"""
+		if not executor_config or not executor_config.get('enabled'):
+			return None
+		return cls(executor_config.get('workers', DEPLOY_WORKERS),
+				executor_config.get('timeout', KBS_TIMEOUT))
+
+	def submit(self, instance_id, function, args, callback=None):
+		"""
+		Queues function(*args, timeout=...) for instance_id, unless a command
+		for that instance is already queued or running.
+
+		Parameters
+		----------
+		instance_id
+			str, instance the command deploys
+		function
+			callable returning a deployment id
+		args
+			tuple of arguments for function
+		callback
+			callable taking the finished DeployJob
+
+		Returns the DeployJob doing the work, which may be an earlier one. A
+		request combined with an earlier job doesn't run; its callback gets a
+		superseded DeployJob instead (see DeployJob.supersede).
+		"""
+		with self.lock:
+			job = self.inflight.get(instance_id)
+			if job is not None:
+				LOG.info("Deployment for %s already in flight; combining." %
+						instance_id)
+				METRICS.incr('deploy.combined')
+		if job is not None:
+			skipped = DeployJob(instance_id, function, args, self.timeout)
+			if callback is not None:
+				skipped.callbacks.append(callback)
+			skipped.supersede(job)
+			return job
+
+		with self.lock:
+			job = DeployJob(instance_id, function, args, self.timeout)
+			if callback is not None:
+				job.callbacks.append(callback)
+			self.inflight[instance_id] = job
+			self.jobs.put(job)
+			if len(self.threads) < self.workers:
+				thread = threading.Thread(target=self._run, name='deploy')
+				thread.daemon = True
+				thread.start()
+				self.threads.append(thread)
+		return job
+
+	def _run(self):
+		""" Worker loop running queued jobs. """
+		while True:
+			job = self.jobs.get()
+			try:
+				job.run()
+			finally:
+				with self.lock:
+					del self.inflight[job.instance_id]
+				job.finished.set()
+
+	def pending(self):
+		""" Returns the number of queued or running jobs. """
+		with self.lock:
+			return len(self.inflight)
+
+	def wait(self, timeout=None):
+		""" Blocks until every submitted job has finished, or for at most
+		${timeout} seconds. Returns True if nothing is left in flight.
+		"""
+		deadline = None if timeout is None else time() + timeout
+		while True:
+			with self.lock:
+				jobs = self.inflight.values()
+			if not jobs:
+				return True
+			if deadline is not None and time() >= deadline:
+				return False
+			jobs[0].wait(None if deadline is None else deadline - time())
@@ -8,6 +8,9 @@ import sys
 sys.path.insert(0, os.path.abspath(
 	os.path.dirname(os.path.abspath(__file__)) + "/../lib"))
 import urllib2
+import threading
+from time import time
+from collections import defaultdict, namedtuple
 
 try:
 	import knewton.json as json
@@ -20,52 +23,292 @@ except ImportError:
 
 from leptoid.utils import ServiceRevisionIds
 
+# Seconds between downloads of the deployment API's build list, and the
+# shortest interval between downloads forced by unknown deployment ids.
+CATALOG_REFRESH_INTERVAL = 60
+CATALOG_FORCED_INTERVAL = 10
+
+# Seconds an auth token is trusted, and how long before then it is replaced.
+AUTH_TOKEN_TTL = 3600
+AUTH_TOKEN_REFRESH_MARGIN = 300
+
 def extract_ids(server_info):
 	return [server['aws_instance_id'] for server in server_info]
 
 def match_deploy_id(deploy_id, reservation):
 	return reservation['build_id'] == int(deploy_id)
 
-def build_auth_token():
+def fetch_api_settings():
+	""" Reads the authentication and deployment service configs.
+
+	Returns a dict with the auth url, username, password and deployment url.
+	"""
+	config = KnewtonConfig()
+	auth_items = config.fetch_config(
+			'applications/deployment.yml')['application']
+	return {
+			'auth_url': config.fetch_config(
+				'services/authentication.yml')['service']['url'],
+			'deployment_url': config.fetch_config(
+				'services/deployment.yml')['service']['url'],
+			'username': auth_items['username'].strip(),
+			'password': auth_items['password'].strip()}
+
+def build_auth_token(settings=None):
 	""" Builds Leptoid's auth token for the deployment API.
 
+	Parameters
+	----------
+	settings
+		dict returned by fetch_api_settings(); read from disk if not given
+
 	Returns an auth token built by knewton.services.authentication_client.
 	"""
-	auth_url = KnewtonConfig(
-			).fetch_config('services/authentication.yml')['service']['url']
-	auth_items = KnewtonConfig(
-			).fetch_config('applications/deployment.yml')['application']
-	username = auth_items['username'].strip()
-	password = auth_items['password'].strip()
-	return auth_client.get_auth_token(auth_url, username, password)
+	if settings is None:
+		settings = fetch_api_settings()
+	return auth_client.get_auth_token(settings['auth_url'],
+			settings['username'], settings['password'])
 
-def fetch_servers():
-	""" Fetches info for every deploy. Also handles auth. """
+class TokenManager(object):
+	"""
+	Caches the deployment API settings and Leptoid's auth token. The token is
+	replaced shortly before it expires, or as soon as the API rejects it.
+	Concurrent callers needing a new token share a single refresh.
+	"""
+
+	def __init__(self, ttl=AUTH_TOKEN_TTL, margin=AUTH_TOKEN_REFRESH_MARGIN):
+		"""
+		Parameters
+		----------
+		ttl
+			int, seconds an auth token is valid for
+		margin
+			int, seconds before expiry at which the token is refreshed
+		"""
+		self.ttl = ttl
+		self.margin = margin
+		self.lock = threading.Lock()
+		self.token = None
+		self.expires = 0
+		self._settings = None
+
+	@property
+	def settings(self):
+		""" Deployment API settings, read from disk once. """
+		if self._settings is None:
+			self._settings = fetch_api_settings()
+		return self._settings
+
+	def get(self):
+		""" Returns a valid auth token, refreshing it if needed. """
+		token = self.token
+		if token is not None and time() < self.expires - self.margin:
+			return token
+
+		with self.lock:
+			# Another caller may have refreshed the token while we waited.
+			if self.token is None or time() >= self.expires - self.margin:
+				LOG.info("Refreshing deployment API auth token.")
+				self.token = build_auth_token(self.settings)
+				self.expires = time() + self.ttl
+			return self.token
+
+	def invalidate(self, token):
+		""" Discards a token rejected by the API (e.g. after a 401). """
+		with self.lock:
+			if self.token == token:
+				self.token = None
+
+TOKENS = TokenManager()
+
+def extract_revision(build):
+	""" Builds a ServiceRevisionIds tuple from a build's info. """
+	if 'manifests' in build:
+		jenkins_job_id = int(build['manifests']['jenkins_job_id'])
+	else:
+		jenkins_job_id = None
+	return ServiceRevisionIds(name=build['application_name'],
+			date=build['created_at'],
+			svn=int(build['services'][0]['svn_rev']), jenkins=jenkins_job_id)
+
+BuildIndexes = namedtuple('BuildIndexes',
+		'revisions reservations by_build_id by_instance')
+
+class BuildCatalog(object):
+	"""
+	Local copy of the deployment API's /builds list, indexed by application
+	name, build id and instance id. The list is downloaded at most once per
+	refresh interval, and revalidated with ETag/Last-Modified headers when the
+	server provides them. Readers on deploy threads always see a complete set
+	of indexes, and only one download runs at a time.
+	"""
+
+	def __init__(self, refresh_interval=CATALOG_REFRESH_INTERVAL,
+			forced_interval=CATALOG_FORCED_INTERVAL):
+		"""
+		Parameters
+		----------
+		refresh_interval
+			int, seconds before the build list is fetched again
+		forced_interval
+			int, seconds after a download before a forced one may follow
+		"""
+		self.refresh_interval = refresh_interval
+		self.forced_interval = forced_interval
+		self.lock = threading.Lock()
+		self.attempted = None
+		self.available = True
+		self.etag = None
+		self.last_modified = None
+		self.load([])
+
+	@property
+	def revisions(self):
+		return self.indexes.revisions
+
+	@property
+	def reservations(self):
+		return self.indexes.reservations
+
+	@property
+	def by_build_id(self):
+		return self.indexes.by_build_id
+
+	@property
+	def by_instance(self):
+		return self.indexes.by_instance
+
+	def load(self, builds):
+		""" Rebuilds every index from a list of builds, then swaps them in
+		at once.
+		"""
+		revisions = defaultdict(list)
+		reservations = []
+		by_build_id = dict()
+		by_instance = dict()
 
-	output = []
-	try:
-		builds = fetch_build_info()
 		for build in builds:
-			print build
+			if 'application_name' in build and build.get('services'):
+				revisions[build['application_name']].append(
+						extract_revision(build))
 			if 'reservation' in build and build['reservation']:
-				output.append(build['reservation'])
-	except urllib2.URLError, err:
-		LOG.error(err.code)
-		LOG.error(err.read())
+				reservation = build['reservation']
+				reservations.append(reservation)
+				by_build_id[int(reservation['build_id'])] = reservation
+				for instance_id in extract_ids(reservation.get('servers', [])):
+					by_instance[instance_id] = reservation
+		self.indexes = BuildIndexes(revisions, reservations, by_build_id,
+				by_instance)
+
+	def _stale(self, force):
+		""" Whether the build list should be downloaded again. Forced
+		downloads are limited to one per ${forced_interval} seconds. After a
+		failed download, the last good indexes are used until the refresh
+		interval has passed.
+		"""
+		if self.attempted is None:
+			return True
+		if force and self.available:
+			interval = self.forced_interval
+		else:
+			interval = self.refresh_interval
+		return time() - self.attempted >= interval
+
+	def refresh(self, force=False):
+		"""
+		Downloads the build list if the local copy is older than the refresh
+		interval (or if forced). On errors the previous copy is kept.
+		"""
+		if not self._stale(force):
+			return
+
+		with self.lock:
+			# Another thread may have downloaded the list while we waited.
+			if self._stale(force):
+				self._download()
+
+	def _download(self):
+		""" Fetches the build list and rebuilds the indexes. Call with the
+		lock.
+		"""
+		self.attempted = time()
+		self.available = False
+		headers = {}
+		if self.etag:
+			headers['If-None-Match'] = self.etag
+		if self.last_modified:
+			headers['If-Modified-Since'] = self.last_modified
+
+		try:
+			contents = open_build_info(headers)
+			self.load(json.loads(contents.read()))
+			info = contents.info()
+			self.etag = info.getheader('ETag')
+			self.last_modified = info.getheader('Last-Modified')
+			self.available = True
+		except urllib2.HTTPError, err:
+			if err.code == 304:
+				LOG.debug("Build list not modified.")
+				self.available = True
+			else:
+				LOG.error(err.code)
+				LOG.error(err.read())
+		except urllib2.URLError, err:
+			LOG.error(err.reason)
+		if not self.available:
+			LOG.warning("Build list unavailable; retrying in %i seconds." %
+					self.refresh_interval)
+
+	def find_reservation(self, deploy_id):
+		""" Returns the reservation for a deployment id, or None. Fetches the
+		build list again if the deployment isn't known yet.
+		"""
+		self.refresh()
+		# Ids below 1 (-1 in noop mode, 0 on errors) never name a build.
+		if int(deploy_id) > 0 and int(deploy_id) not in self.by_build_id:
+			self.refresh(force=True)
+		return self.by_build_id.get(int(deploy_id))
+
+	def find_instance_reservation(self, instance_id):
+		""" Returns the reservation an instance was launched in, or None. """
+		self.refresh()
+		return self.by_instance.get(instance_id)
+
+	def find_revisions(self, service_name):
+		""" Returns every ServiceRevisionIds for a service. """
+		self.refresh()
+		return list(self.revisions.get(service_name, []))
+
+CATALOG = BuildCatalog()
+
+def fetch_servers():
+	""" Fetches info for every deploy. Also handles auth. """
+	CATALOG.refresh()
+	return list(CATALOG.reservations)
 
-	return output
+def open_build_info(headers=None):
+	""" Requests info for every build. Returns the open response.
+
+	Parameters
+	----------
+	headers
+		dict with extra request headers (e.g. for conditional requests)
+	"""
+
+	url = TOKENS.settings['deployment_url'] + '/builds'
+	auth = TOKENS.get()
+	try:
+		return auth_client.fetch_url(url, None, headers or {}, auth)
+	except urllib2.HTTPError, err:
+		if err.code != 401:
+			raise
+		# Token was rejected; retry once with a fresh one.
+		TOKENS.invalidate(auth)
+		return auth_client.fetch_url(url, None, headers or {}, TOKENS.get())
 
 def fetch_build_info():
 	""" Fetches info for every build. """
-
-	auth = build_auth_token()
-	deployment_url = KnewtonConfig(
-			).fetch_config('services/deployment.yml')['service']['url']
-	
-	# Fetching build info
-	url = deployment_url + '/builds'
-	contents = auth_client.fetch_url(url, None, {}, auth)
-	return json.loads(contents.read())
+	return json.loads(open_build_info().read())
 
 def find_instance_ids(deploy_id):
 	""" Retrives instance ids associated with a deploy.
@@ -78,19 +321,14 @@ def find_instance_ids(deploy_id):
 	Returns a list of every instance id (one or more) in this deployment.
 	"""
 
-	deploys = fetch_servers()
-	ids = None
-	
-	# Return instance ids from build info.
-	for server in deploys:
-		if match_deploy_id(deploy_id, server):
-			ids = extract_ids(server['servers'])
-
-	return ids
+	reservation = CATALOG.find_reservation(deploy_id)
+	if reservation is None:
+		return None
+	return extract_ids(reservation['servers'])
 
 def find_service_revs(service_name):
-	""" Retrieves all builds associated with a service. Connects to the
-	deployment API (with auth) to accomplish this.
+	""" Retrieves all builds associated with a service from the build
+	catalog, which connects to the deployment API (with auth) as needed.
 
 	Parameters
 	----------
@@ -99,29 +337,7 @@ def find_service_revs(service_name):
 
 	Returns five most recent build ids.
 	"""
-
-	output = []
-	try:
-		builds = fetch_build_info()
-		for build in builds:
-			# If we find an applicable deployment, get its info.
-			if build['application_name'] == service_name:
-				name = build['application_name']
-				svn_rev = int(build['services'][0]['svn_rev'])
-				date = build['created_at']
-				if 'manifests' in build:
-					jenkins_job_id = int(build['manifests']['jenkins_job_id'])
-				else:
-					jenkins_job_id = None
-				output.append(
-						ServiceRevisionIds(name=name, date=date,
-							svn=svn_rev, jenkins=jenkins_job_id))
-	except urllib2.URLError, err:
-		LOG.error(err.code)
-		LOG.error(err.read())
-
-	# Return the most recent build.
-	return output
+	return CATALOG.find_revisions(service_name)
 
 def find_latest_build(service_name):
 	""" Takes a list of service revisions for ${service_name} produced by
@@ -0,0 +1,256 @@
+"""
+Pure-NumPy exponential smoothing backend. Fits additive ETS models (simple
+exponential smoothing, Holt's linear trend and damped trend) to every row of a
+hosts x time matrix in a single batch, without going through R.
+
+Smoothing parameters are chosen per row by a grid search that runs every
+candidate model over the whole fleet at once. As with R's ets(model='ZZZ'),
+the model form is picked by AIC. Seasonal models are not fitted: the series
+handed to R's ets() are plain vectors (frequency 1), so the R backend never
+fits seasonal models either.
+
+See Hyndman et al. for the model definitions:
+	http://www.jstatsoft.org/v27/i03/paper
+"""
+
+import numpy as np
+
+import logging
+LOG = logging.getLogger('ets')
+
+# Smoothing parameter grids. Trend smoothing is only paired with alphas at
+# least as large, and damping only applies to models with a trend.
+ALPHAS = np.array([0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 0.9])
+BETAS = np.array([0.01, 0.05, 0.1])
+PHIS = np.array([1.0, 0.98])
+
+# Observations used to initialize the level and trend.
+INIT_WINDOW = 10
+
+# Model forms accepted in model_config['model_type'].
+MODEL_TYPES = ('ZZZ', 'ANN', 'AAN')
+
+def _candidates(model_type='ZZZ'):
+	"""
+	Builds the grid of candidate models.
+
+	Returns: tuple of np.arrays (alpha, beta, phi, nparams), one entry per
+	candidate. nparams counts smoothing parameters and initial states.
+	"""
+	if model_type not in MODEL_TYPES:
+		raise Exception("Unsupported model type %s for the numpy backend." %
+				model_type)
+
+	candidates = []
+	if model_type in ('ZZZ', 'ANN'):
+		candidates += [(alpha, 0., 1., 2) for alpha in ALPHAS]
+	if model_type in ('ZZZ', 'AAN'):
+		candidates += [(alpha, beta, phi, 4 if phi == 1. else 5)
+				for alpha in ALPHAS for beta in BETAS for phi in PHIS
+				if beta <= alpha]
+	return tuple(np.array(column) for column in zip(*candidates))
+
+def _initial_states(matrix):
+	""" Heuristic initial level and trend for every row of matrix. """
+	window = min(INIT_WINDOW, matrix.shape[1])
+	level = matrix[:, :window].mean(axis=1)
+	if matrix.shape[1] >= 2 * INIT_WINDOW:
+		trend = (matrix[:, INIT_WINDOW:2 * INIT_WINDOW].mean(axis=1) -
+				level) / INIT_WINDOW
+	else:
+		trend = np.zeros(matrix.shape[0])
+	return level, trend
+
+def _without_trend(beta, trend):
+	""" Zeroes the trend of models without trend smoothing (ETS(A,N,N)),
+	which would otherwise carry their initial slope forever.
+	"""
+	return np.where(beta == 0., 0., trend)
+
+def _filter(matrix, alpha, beta, phi, level, trend, keep_fitted=False):
+	"""
+	Runs the ETS(A,Ad,N) recursions over every row of matrix.
+
+	Parameters
+	----------
+	matrix
+		np.array, hosts x time
+	alpha, beta, phi
+		np.arrays of smoothing parameters, shaped (hosts,) or
+		(hosts, candidates)
+	level, trend
+		np.arrays of initial states, same shape as the parameters
+	keep_fitted
+		bool, whether to keep one-step ahead forecasts (only for
+		(hosts,)-shaped parameters)
+
+	Returns: tuple with final level, final trend, sum of squared errors and
+	fitted values (None unless keep_fitted).
+	"""
+	column = (-1,) + (1,) * (alpha.ndim - 1)
+	sse = np.zeros(alpha.shape)
+	fitted = np.empty(matrix.shape) if keep_fitted else None
+	trend = _without_trend(beta, trend)
+
+	for idx in xrange(matrix.shape[1]):
+		prediction = level + phi * trend
+		error = matrix[:, idx].reshape(column) - prediction
+		sse += error * error
+		if keep_fitted:
+			fitted[:, idx] = prediction
+		level = prediction + alpha * error
+		trend = phi * trend + beta * error
+
+	return level, trend, sse, fitted
+
+def _forecast_mean(level, trend, phi, horizon, beta=None):
+	""" Point forecasts from final states, shaped (hosts, horizon). Rows
+	with a zero ${beta} get flat forecasts.
+	"""
+	if beta is not None:
+		trend = _without_trend(beta, trend)
+	damping = np.cumsum(phi[:, np.newaxis] ** np.arange(1, horizon + 1),
+			axis=1)
+	return level[:, np.newaxis] + trend[:, np.newaxis] * damping
+
+class ETSFit(object):
+	"""
+	Parameters, final states and in-sample fit of the ETS models chosen for
+	every row of a matrix.
+	"""
+
+	def __init__(self, x, alpha, beta, phi, level, trend, fitted):
+		self.x = x
+		self.alpha = alpha
+		self.beta = beta
+		self.phi = phi
+		self.level = level
+		self.trend = trend
+		self.fitted = fitted
+		self.residuals = x - fitted
+		self.sigma2 = np.mean(self.residuals ** 2, axis=1)
+
+	@property
+	def method(self):
+		""" Model names, formatted the way R's forecast package names them. """
+		names = np.empty(len(self.alpha), dtype=object)
+		names[:] = 'ETS(A,Ad,N)'
+		names[self.phi == 1.] = 'ETS(A,A,N)'
+		names[self.beta == 0.] = 'ETS(A,N,N)'
+		return names
+
+	def forecast(self, horizon):
+		"""
+		Generates point forecasts from the final states.
+
+		Parameters
+		----------
+		horizon
+			int, number of steps to forecast
+
+		Returns an ETSForecast covering every row.
+		"""
+		mean = _forecast_mean(self.level, self.trend, self.phi, horizon,
+				self.beta)
+		return ETSForecast(mean, self.fitted, self.x, self.method)
+
+class ETSForecast(object):
+	"""
+	Forecast output for one or more rows. Exposes the same attribute names as
+	the objects returned by R's forecast.forecast(), both directly and through
+	rx2(), so leptoid.utils.get_forecast_attribute() works with either backend.
+	"""
+
+	ATTRIBUTES = ('mean', 'fitted', 'x', 'residuals', 'method')
+
+	def __init__(self, mean, fitted, x, method):
+		self.mean = mean
+		self.fitted = fitted
+		self.x = x
+		self.residuals = x - fitted
+		self.method = method
+
+	def rx2(self, attr):
+		""" Attribute lookup mirroring rpy2's ListVector.rx2(). """
+		if attr not in self.ATTRIBUTES:
+			raise KeyError("%s is not available from the numpy backend." %
+					attr)
+		return getattr(self, attr)
+
+	def row(self, idx):
+		""" Returns the forecast for a single row. """
+		return ETSForecast(self.mean[idx], self.fitted[idx], self.x[idx],
+				self.method[idx])
+
+def fit(matrix, model_type='ZZZ'):
+	"""
+	Fits an ETS model to every row of matrix.
+
+	Parameters
+	----------
+	matrix
+		np.array, hosts x time
+	model_type
+		str, one of MODEL_TYPES. 'ZZZ' picks the model form by AIC.
+
+	Returns an ETSFit.
+	"""
+	matrix = np.atleast_2d(np.asarray(matrix, dtype=float))
+	nrows, nobs = matrix.shape
+	alphas, betas, phis, nparams = _candidates(model_type)
+	LOG.debug("Fitting %i candidate models to %i series." %
+			(len(alphas), nrows))
+
+	# Search every candidate over every row at once.
+	level, trend = _initial_states(matrix)
+	grid = (nrows, len(alphas))
+	_, _, sse, _ = _filter(matrix,
+			np.resize(alphas, grid), np.resize(betas, grid),
+			np.resize(phis, grid),
+			np.repeat(level[:, np.newaxis], len(alphas), axis=1),
+			np.repeat(trend[:, np.newaxis], len(alphas), axis=1))
+	aic = nobs * np.log(sse / nobs + 1E-12) + 2 * nparams
+	best = np.argmin(aic, axis=1)
+
+	# Rerun the chosen models to recover fitted values and final states.
+	alpha, beta, phi = alphas[best], betas[best], phis[best]
+	final_level, final_trend, _, fitted = _filter(
+			matrix, alpha, beta, phi, level, trend, keep_fitted=True)
+	return ETSFit(matrix, alpha, beta, phi, final_level, final_trend, fitted)
+
+def forecast_batch(matrix, horizon, model_type='ZZZ'):
+	"""
+	Fits ETS models to every row of matrix and forecasts ${horizon} steps.
+
+	Returns an ETSForecast with hosts x horizon mean forecasts and
+	hosts x time fitted values.
+	"""
+	return fit(matrix, model_type).forecast(horizon)
+
+def smooth(values, alpha, beta, phi, level, trend):
+	"""
+	Updates a single fitted model's states with new observations, without
+	re-estimating its parameters.
+
+	Parameters
+	----------
+	values
+		np.array of new observations
+	alpha, beta, phi
+		floats, the model's smoothing parameters
+	level, trend
+		floats, the model's states before the new observations
+
+	Returns: tuple with the new level, new trend and one-step ahead forecasts
+	for every value.
+	"""
+	params = [np.array([param]) for param in (alpha, beta, phi, level, trend)]
+	level, trend, _, fitted = _filter(np.atleast_2d(values), *params,
+			keep_fitted=True)
+	return level[0], trend[0], fitted[0]
+
+def forecast_states(level, trend, phi, horizon, beta=None):
+	""" Point forecasts for a single model from its states. """
+	return _forecast_mean(np.array([level]), np.array([trend]),
+			np.array([phi]), horizon,
+			None if beta is None else np.array([beta]))[0]
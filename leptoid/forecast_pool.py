@@ -0,0 +1,240 @@
+"""
+Process pool for forecasting many ServiceQueues in parallel. Each worker
+process starts R and loads the forecast package when it starts, so every worker
+holds its own R interpreter; rpy2 cannot share one interpreter across processes.
+
+Workers only receive the pieces of a ServiceQueue that forecasting needs
+(see ForecastTask), which keeps the per-task pickling cost small. Fitted models
+are cached in the parent process and travel with each task, so warm starts
+work no matter which worker picks a queue up.
+"""
+
+import multiprocessing
+import numpy as np
+from time import time
+from collections import namedtuple
+
+import logging
+LOG = logging.getLogger('forecast_pool')
+
+from leptoid.model_cache import ModelCache
+from leptoid.change_detection import ChangeDetector
+from leptoid.hierarchy import Hierarchy, aggregate_keys
+from leptoid.metrics import METRICS, timed
+
+class ForecastTask(namedtuple('ForecastTask',
+		'environment service instance_id utilization cached')):
+	""" Picklable subset of a leptoid.ServiceQueue used by
+	leptoid.forecasting.forecast().
+	"""
+	__slots__ = ()
+
+	def get_first_timestamp(self):
+		""" Returns timestamp for the first utilization value. """
+		return self.utilization.index[0]
+
+def _key(queue):
+	""" Key identifying a queue's cached model. """
+	return (queue.environment, queue.service, queue.instance_id)
+
+def _init_worker():
+	""" Starts R in a new worker process. Metrics are only sent from the
+	parent process. Pools are replaced after timeouts, so workers may be
+	forked while the parent's plotter or deploy threads hold the R lock; each
+	worker takes a fresh one.
+	"""
+	METRICS.configure(None)
+	from leptoid.utils import R
+	R.after_fork()
+	R.package('forecast')
+
+def _forecast_task(task, model_config=None):
+	"""
+	Forecasts a single ForecastTask. Runs inside a worker process.
+
+	Returns a tuple with the forecast and the task's model cache entry (None
+	unless warm starts are enabled).
+	"""
+	import leptoid.forecasting as forecasting
+	cache = ModelCache.from_config(model_config)
+	if cache is None:
+		return forecasting.forecast(task, model_config), None
+
+	key = (task.environment, task.service, task.instance_id)
+	if task.cached is not None:
+		cache.put(key, task.cached)
+	result = forecasting.forecast(task, model_config, cache)
+	return result, cache.models.get(key)
+
+class ForecastPool(object):
+	"""
+	Spreads forecasts across a pool of worker processes. Results are returned
+	in the same order as the queues passed in, so they can be matched back to
+	their ServiceQueues before scaling decisions are made.
+
+	The numpy backend fits the whole fleet in one batch, so it runs in the
+	calling process instead.
+	"""
+
+	def __init__(self, workers=None, timeout=None, model_config=None,
+			detection_config=None):
+		"""
+		Parameters
+		----------
+		workers
+			int, number of worker processes (defaults to the number of cores).
+			With a single worker, forecasts run in the calling process.
+		timeout
+			int, seconds a single forecast may take before it is abandoned
+		model_config
+			dict with forecasting settings, passed to leptoid.forecasting
+		detection_config
+			dict with change detection settings; when enabled, hosts whose
+			new points match their last forecast aren't forecast again
+		"""
+		self.workers = workers or multiprocessing.cpu_count()
+		self.timeout = timeout
+		self.model_config = model_config
+		self.cache = ModelCache.from_config(model_config)
+		self.detector = ChangeDetector.from_config(detection_config)
+		self.hierarchy = Hierarchy.from_config(model_config)
+		self.pool = None
+
+	@timed('forecasting.pool')
+	def forecast(self, queues):
+		"""
+		Generates forecasts for every queue.
+
+		Parameters
+		----------
+		queues
+			list of leptoid.ServiceQueues, or a leptoid.FleetQueues
+
+		Returns a list of (in_sample_forecast, util_estimate) tuples, one per
+		queue. Forecasts that fail or time out are returned as (None, None).
+		With change detection enabled, unchanged hosts get their previous
+		forecast back (see leptoid.change_detection); with hierarchical
+		forecasting, only services whose instances all stayed unchanged do.
+		"""
+		keys = [_key(queue) for queue in queues]
+		if self.cache is not None:
+			self.cache.retain(keys if self.hierarchy is None else
+					aggregate_keys(keys))
+		if self.detector is None:
+			return self._forecast(queues, keys)
+
+		# Only forecast hosts whose new points don't match their last
+		# forecast.
+		results = self.detector.check(queues, keys)
+		refit = [idx for idx, result in enumerate(results) if result is None]
+		if not refit:
+			return results
+		if self.hierarchy is not None:
+			# Aggregates must sum every instance of a service, so a service
+			# is refit as a whole when any of its instances changed.
+			services = set(keys[idx][:2] for idx in refit)
+			refit = [idx for idx, key in enumerate(keys)
+					if key[:2] in services]
+		if hasattr(queues, 'subset'):
+			mask = np.zeros(len(results), dtype=bool)
+			mask[refit] = True
+			changed = queues.subset(mask)
+		else:
+			changed = [queues[idx] for idx in refit]
+		changed_keys = [keys[idx] for idx in refit]
+		forecasts = self._forecast(changed, changed_keys)
+		self.detector.update(changed, changed_keys, forecasts)
+		for idx, forecast in zip(refit, forecasts):
+			results[idx] = forecast
+		return results
+
+	def _forecast(self, queues, keys):
+		""" Forecasts every queue, through per-service aggregates if
+		hierarchical forecasting is enabled.
+		"""
+		if self.hierarchy is None or not len(keys):
+			return self._forecast_queues(queues, keys)
+		matrix, aggregates, groups = self.hierarchy.aggregate(queues, keys)
+		forecasts = self._forecast_queues(aggregates,
+				[_key(aggregate) for aggregate in aggregates])
+		return self.hierarchy.split(matrix, groups, forecasts)
+
+	def _forecast_queues(self, queues, keys):
+		""" Forecasts every queue, in worker processes or in batch. """
+		if (self.model_config or {}).get('backend') == 'numpy':
+			import leptoid.forecasting as forecasting
+			return forecasting.forecast_fleet(queues, self.model_config,
+					self.cache)
+		queues = list(queues)
+
+		tasks = [ForecastTask(queue.environment, queue.service,
+			queue.instance_id, queue.utilization, self._cached(key))
+			for queue, key in zip(queues, keys)]
+		if self.workers <= 1:
+			return [self._store(key, self._run_serial(task))
+					for key, task in zip(keys, tasks)]
+
+		if self.pool is None:
+			self.pool = multiprocessing.Pool(self.workers,
+					initializer=_init_worker)
+		pending = [self.pool.apply_async(_forecast_task,
+			(task, self.model_config)) for task in tasks]
+
+		# Tasks are handed to workers in order, so the i-th task starts no
+		# later than (i // workers) timeouts after submission.
+		started = time()
+		results = []
+		timed_out = False
+		for idx, (key, task, result) in enumerate(zip(keys, tasks, pending)):
+			wait = None
+			if self.timeout is not None:
+				deadline = started + self.timeout * (idx // self.workers + 1)
+				wait = max(0, deadline - time())
+			try:
+				results.append(self._store(key, result.get(wait)))
+			except multiprocessing.TimeoutError:
+				LOG.error("Forecast for %s:%s timed out. Continuing..." %
+						(task.service, task.instance_id))
+				results.append((None, None))
+				METRICS.incr('forecasting.timeouts')
+				timed_out = True
+			except Exception, e:
+				LOG.error("Forecast for %s:%s failed. Continuing..." %
+						(task.service, task.instance_id))
+				LOG.error(e)
+				results.append((None, None))
+
+		# Workers stuck in R can't be interrupted; replace the whole pool.
+		if timed_out:
+			self.close()
+		return results
+
+	def _run_serial(self, task):
+		""" Forecasts a task in the calling process. """
+		try:
+			return _forecast_task(task, self.model_config)
+		except Exception, e:
+			LOG.error("Forecast for %s:%s failed. Continuing..." %
+					(task.service, task.instance_id))
+			LOG.error(e)
+			return (None, None), None
+
+	def _cached(self, key):
+		""" Returns the cached model for key, if warm starts are enabled. """
+		if self.cache is None:
+			return None
+		return self.cache.get(key)
+
+	def _store(self, key, output):
+		""" Keeps the model returned by a worker, and returns its forecast. """
+		result, cached = output
+		if self.cache is not None and cached is not None:
+			self.cache.put(key, cached)
+		return result
+
+	def close(self):
+		""" Terminates all worker processes. """
+		if self.pool is not None:
+			self.pool.terminate()
+			self.pool.join()
+			self.pool = None
@@ -9,41 +9,35 @@ Leptoid interface to R for forecasting. Notes on rpy2:
 
 Uses R's forecast package to generate forecasts. See the paper for more details:
 	http://www.jstatsoft.org/v27/i03/paper
+
+R is started through leptoid.utils.R the first time a forecast needs it, so
+importing this module (e.g. for the numpy backend) doesn't start R.
 """
 
-import datetime
 import numpy as np
 import logging
 LOG = logging.getLogger('forecasting')
 
-# Importing rpy2 and working with Numpy objects.
-import rpy2.robjects as robjects
-import rpy2.robjects.numpy2ri
-rpy2.robjects.numpy2ri.activate()
-
-# Importing plotting functions from R.
-RBMP = robjects.r['bitmap']
-RPLOT = robjects.r['plot']
-RDEVOFF = robjects.r['dev.off']
-
-# Importing packages from R.
-from rpy2.robjects.packages import importr
-forecast = importr('forecast')
-graphics = importr('graphics')
-
-from leptoid.utils import get_forecast_attribute
+import pandas
+import leptoid.ets as ets
+from leptoid.model_cache import CachedModel, DRIFT_WINDOW
+from leptoid.resolution import CompactView
+from leptoid.utils import get_forecast_attribute, R
+from leptoid.metrics import METRICS, timed
 
 RECENT_DATA_WINDOW = 120
-PLOT_DIRECTORY = '/var/leptoid/img/'
-PLOT_SIGNIFICANCE_THRESHOLD = 1E-5
+BACKENDS = ('r', 'numpy')
+SMOOTHING_PARAMS = ('alpha', 'beta', 'gamma', 'phi')
 
-def add_new_series(nseries, seriesname='nseries'):
-	"""Adds time series to R's global environment as ts object. """
-	freq = len(nseries)
+def add_new_series(nseries, seriesname='nseries', freq=1):
+	"""Adds time series to R's global environment as ts object, with ${freq}
+	observations per seasonal cycle (1 for a plain, non-seasonal series).
+	"""
+	robjects = R.robjects
 	robjects.globalenv['raw_vector'] = nseries
 	robjects.r('%s <- ts(raw_vector, frequency=%i)' % (seriesname, freq))
 
-def _forecast_utilization(series, model_config=None):
+def _forecast_utilization(series, model_config=None, cached=None):
 	"""
 	Generate a forecast using R functions.
 	
@@ -53,6 +47,9 @@ def _forecast_utilization(series, model_config=None):
 		np.array containing sample data
 	model_config
 		dict with values for 'model_type' and 'horizon'
+	cached
+		leptoid.model_cache.CachedModel; if given, its model form and
+		smoothing parameters are reused instead of being re-estimated
 	
 	Returns an R object with these attributes:
 	model: a list with model information,
@@ -80,16 +77,66 @@ def _forecast_utilization(series, model_config=None):
 	# Handling case where recent samples are missing or not available.
 	if (series[-1 * RECENT_DATA_WINDOW:] == 0).all():
 		forecast_output = None
+	elif cached is None:
+		with R.lock:
+			forecast = R.package('forecast')
+			etsout = forecast.ets(series, model=model_type)
+			forecast_output = forecast.forecast(etsout, h=horizon)
 	else:
-		etsout = forecast.ets(series, model=model_type)
-		forecast_output = forecast.forecast(etsout, h=horizon)
+		with R.lock:
+			forecast = R.package('forecast')
+			etsout = forecast.ets(series, model=cached.form, **cached.params)
+			forecast_output = forecast.forecast(etsout, h=horizon)
 
 	return forecast_output
 
-def forecast(queue):
+def _get_backend(model_config):
+	""" Returns the forecasting backend named in model_config ('r' or
+	'numpy'), defaulting to R.
+	"""
+	if model_config is None:
+		return 'r'
+	backend = model_config.get('backend', 'r')
+	if backend not in BACKENDS:
+		raise Exception("Unknown forecasting backend %s." % backend)
+	return backend
+
+def _cache_key(queue):
+	""" Key identifying a queue's model in a leptoid.model_cache.ModelCache. """
+	return (queue.environment, queue.service, queue.instance_id)
+
+def _last_index(utilization):
+	""" Index of the newest observation, or None for plain arrays. """
+	index = getattr(utilization, 'index', None)
+	return index[-1] if index is not None else None
+
+def _model_form(method):
+	"""
+	Converts a method name such as 'ETS(A,Ad,N)' into the model form accepted
+	by R's ets() ('AAN') and whether its trend is damped.
 	"""
-	Forecasting values using R's forecast package. Series reporting empty data
-	over the last ${recent_data_window} minutes will return None.
+	error, trend, season = method[method.find('(') + 1:-1].split(',')
+	return error + trend[0] + season, trend.endswith('d')
+
+def _cache_r_model(model_output):
+	"""
+	Builds a CachedModel from an R forecast object, keeping the chosen model
+	form and its smoothing parameters.
+	"""
+	method = get_forecast_attribute(model_output, attr='method')[0]
+	form, damped = _model_form(str(method))
+	par = model_output.rx2('model').rx2('par')
+	params = dict([(name, float(value)) for name, value in zip(par.names, par)
+		if name in SMOOTHING_PARAMS])
+	params['damped'] = damped
+	sigma2 = get_forecast_attribute(model_output, 'model', 'sigma2')[0]
+	return CachedModel(form, params, sigma2)
+
+def forecast(queue, model_config=None, cache=None):
+	"""
+	Forecasting values using R's forecast package, or the numpy backend if
+	model_config selects it. Series reporting empty data over the last
+	${recent_data_window} minutes will return None.
 
 	Parameters
 	----------
@@ -97,18 +144,56 @@ def forecast(queue):
 		pandas.TimeSeries with utilization data. Data is extracted from the
 		underlying buffer using np.frombuffer.
 	service, instance_id
-		information for instance, used when plotting
+		information for instance, used in logs
+	model_config
+		dict with values for 'backend', 'model_type' and 'horizon'
+	cache
+		leptoid.model_cache.ModelCache with previously fitted models
 
 	TODO: Currently Leptoid uses R via rpy2. This will change since rpy2 is
 	poorly maintained.
 	"""
 
+	if _get_backend(model_config) == 'numpy':
+		return forecast_fleet([queue], model_config, cache)[0]
+
 	LOG.info("Generating forecast for %s:%s" %
 			(queue.service, queue.instance_id))
 
 	# Retrieving forecast from rpy2, then extracting the attributes
-	# (forecasted utilization, one-step ahead forecast) we want.
-	model_output = _forecast_utilization(np.frombuffer(queue.utilization.data))
+	# (forecasted utilization, one-step ahead forecast) we want. Cached models
+	# skip parameter estimation unless their residuals have drifted.
+	series = np.frombuffer(queue.utilization.data)
+	view = CompactView.from_config(model_config)
+	if view is not None:
+		# Dormant instances are checked on the raw series.
+		if (series[-1 * RECENT_DATA_WINDOW:] == 0).all():
+			return (None, None)
+		fit_series, past, ahead = view.prepare(series[np.newaxis],
+				model_config['horizon'])
+		fit_series = fit_series[0]
+	else:
+		fit_series = series
+	cached = None
+	if cache is not None:
+		cached = cache.get(_cache_key(queue))
+	with METRICS.timer('forecasting.r_fit'):
+		model_output = _forecast_utilization(fit_series, model_config, cached)
+	if cached is not None and model_output is not None:
+		recent_errors = get_forecast_attribute(model_output, "residuals")
+		if cache.has_drifted(cached, recent_errors):
+			LOG.info("Residuals drifted for %s:%s; refitting." %
+					(queue.service, queue.instance_id))
+			METRICS.incr('forecasting.drift_refits')
+			cached = None
+			with METRICS.timer('forecasting.r_fit'):
+				model_output = _forecast_utilization(fit_series, model_config)
+
+	if cache is not None and model_output is not None:
+		if cached is None:
+			cache.put(_cache_key(queue), _cache_r_model(model_output))
+		else:
+			cached.passes += 1
 
 	# Handling case where output == None, indicating a dormant instance.
 	if model_output == None:
@@ -117,37 +202,167 @@ def forecast(queue):
 	else:
 		in_sample_forecast = get_forecast_attribute(model_output, "fitted")
 		util_estimate = get_forecast_attribute(model_output, "mean")
-
-		# Let's avoid empty plots
-		if np.max(util_estimate) > PLOT_SIGNIFICANCE_THRESHOLD:
-			plot_forecast(model_output, queue)
+		if view is not None:
+			in_sample_forecast, util_estimate = view.restore(
+					in_sample_forecast, util_estimate, past[0], ahead[0],
+					len(series))
 
 	return (in_sample_forecast, util_estimate)
 
-def plot_forecast(model_output, queue):
+def _fit_series(utilization, row):
+	""" Series with the newest points of utilization's index and the values
+	in row (e.g. a leptoid.resolution.CompactView of it).
 	"""
-	Plots output from R forecast. Uses R functions extracted via rpy2
-	(see global vars above).
+	index = getattr(utilization, 'index', None)
+	if index is None:
+		return row
+	index = index[-1 * len(row):]
+	return pandas.TimeSeries(data=row[-1 * len(index):], index=index)
+
+def _warm_forecast(queue, cached, cache, horizon, utilization=None):
+	"""
+	Brings a cached numpy model up to date with the points observed since it
+	was last used, then forecasts from its states. ${utilization} replaces
+	the queue's series, e.g. with its compact view.
+
+	Returns (in_sample_forecast, util_estimate), or None if the model can't
+	be reused and should be refit.
+	"""
+	if utilization is None:
+		utilization = queue.utilization
+	index = getattr(utilization, 'index', None)
+	if index is None or cached.last_index is None or \
+			cached.last_index < index[0] or \
+			len(cached.fitted) != len(utilization):
+		return None
+
+	new_points = np.asarray(utilization[index > cached.last_index],
+			dtype=float)
+	level, trend = cached.state
+	level, trend, predictions = ets.smooth(new_points, cached.params['alpha'],
+			cached.params['beta'], cached.params['phi'], level, trend)
+	residuals = np.concatenate([cached.residuals, new_points - predictions])
+	if cache.has_drifted(cached, residuals):
+		LOG.info("Residuals drifted for %s:%s; refitting." %
+				(queue.service, queue.instance_id))
+		return None
+
+	# Keep the in-sample forecast aligned with the current window.
+	fitted = np.concatenate([cached.fitted, predictions])[len(new_points):]
+	cached.state = (level, trend)
+	cached.fitted = fitted
+	cached.residuals = residuals[-1 * DRIFT_WINDOW:]
+	cached.last_index = index[-1]
+	cached.passes += 1
+	return (fitted, ets.forecast_states(level, trend, cached.params['phi'],
+		horizon, cached.params['beta']))
+
+@timed('forecasting.fleet')
+def forecast_fleet(queues, model_config=None, cache=None):
+	"""
+	Forecasts utilization for many queues. With the numpy backend every queue
+	is fitted in one batch; otherwise queues are forecast one at a time
+	through R.
 
 	Parameters
 	----------
-	model_output
-		R object returned by leptoid.forecasting._forecast_utilization(). Contains
-		forecast information (confidence intervals, etc.).
-	queue
-		leptoid.ServiceQueue with information about the service
-	
-	Returns nothing, but saves a plot to disk with a timestamp.
+	queues
+		list of leptoid.ServiceQueues, or a leptoid.FleetQueues
+	model_config
+		dict with values for 'backend', 'model_type' and 'horizon'
+	cache
+		leptoid.model_cache.ModelCache with previously fitted models. Queues
+		with a reusable model are only updated with their newest points.
+
+	Returns a list of (in_sample_forecast, util_estimate) tuples, one per
+	queue, with (None, None) for dormant instances.
 	"""
-	forecast_method = get_forecast_attribute(model_output, attr='method')
-	n = datetime.datetime.now()
+	if _get_backend(model_config) != 'numpy':
+		return [forecast(queue, model_config, cache) for queue in queues]
+
+	results = [(None, None)] * len(queues)
+	if not len(queues):
+		return results
+
+	if hasattr(queues, 'utilization'):
+		# Columnar fleets already hold every series in one matrix.
+		matrix = queues.utilization
+		nobs = matrix.shape[1]
+		widths = [nobs] * len(queues)
+	else:
+		# Right-align every series in one matrix, padding short series with 0
+		# the same way missing Graphite data is filled.
+		series = [np.asarray(queue.utilization, dtype=float)
+				for queue in queues]
+		widths = [len(values) for values in series]
+		nobs = max(widths)
+		matrix = np.zeros((len(series), nobs))
+		for idx, values in enumerate(series):
+			matrix[idx, nobs - len(values):] = values
 
-	RBMP('%s%s-%s-%i-%i-%i-%i:%i.jpg' %
-			(PLOT_DIRECTORY, queue.service, queue.instance_id, n.year,
-				n.month, n.day, n.hour, n.minute),
-			width=1400, height=800, units='px', type='jpeg')
-	RPLOT(model_output, main="Util forecast for %s:%s (using %s)" %
-			(queue.service, queue.instance_id, forecast_method),
-			xlab="Minutes elapsed since %s" % queue.get_first_timestamp())
-	RDEVOFF()
+	# Dormant instances are skipped, as with the R backend.
+	active = np.flatnonzero(
+			(matrix[:, -1 * RECENT_DATA_WINDOW:] != 0).any(axis=1))
+	if not len(active):
+		return results
 
+	model_type = model_config.get('model_type', 'ZZZ')
+	horizon = model_config.get('horizon', int(0.1 * nobs))
+
+	# Models are fitted to a short, deseasonalized view if enabled.
+	view = CompactView.from_config(model_config)
+	if view is not None:
+		matrix, past, ahead = view.prepare(matrix, horizon)
+
+	# Cached models only need their states updated.
+	refit = []
+	for idx in active:
+		cached = None
+		if cache is not None:
+			cached = cache.get(_cache_key(queues[idx]))
+		if cached is not None:
+			utilization = None
+			if view is not None:
+				utilization = _fit_series(queues[idx].utilization,
+						matrix[idx])
+			results[idx] = _warm_forecast(queues[idx], cached, cache, horizon,
+					utilization)
+		if results[idx] is None or cached is None:
+			refit.append(idx)
+	METRICS.incr('forecasting.warm_starts', len(active) - len(refit))
+	METRICS.incr('forecasting.refits', len(refit))
+	if refit:
+		_fit_batch(queues, matrix, refit, widths, results, model_type,
+				horizon, cache)
+
+	if view is not None:
+		for idx in active:
+			in_sample, estimate = results[idx]
+			results[idx] = view.restore(in_sample, estimate, past[idx],
+					ahead[idx], widths[idx])
+	return results
+
+def _fit_batch(queues, matrix, refit, widths, results, model_type, horizon,
+		cache):
+	""" Fits the rows of matrix listed in refit in one batch, storing their
+	forecasts in results and their models in cache.
+	"""
+	LOG.info("Generating forecasts for %i instances with the numpy backend" %
+			len(refit))
+	with METRICS.timer('forecasting.batch_fit'):
+		model_fit = ets.fit(matrix[refit], model_type)
+		model_output = model_fit.forecast(horizon)
+	for row, idx in enumerate(refit):
+		output = model_output.row(row)
+		width = min(widths[idx], matrix.shape[1])
+		results[idx] = (get_forecast_attribute(output, "fitted")[-width:],
+				get_forecast_attribute(output, "mean"))
+		if cache is not None:
+			form, damped = _model_form(output.method)
+			params = dict(alpha=model_fit.alpha[row], beta=model_fit.beta[row],
+					phi=model_fit.phi[row], damped=damped)
+			cache.put(_cache_key(queues[idx]), CachedModel(form, params,
+				model_fit.sigma2[row],
+				state=(model_fit.level[row], model_fit.trend[row]),
+				fitted=results[idx][0],
+				last_index=_last_index(queues[idx].utilization)))
@@ -1,19 +1,61 @@
 """ Defining class responsible for retrieving data from Graphite. """
 
+import re
+import json
+import socket
+import httplib
+import threading
+import numpy as np
 import pandas
-import pickle
+import Queue
 
-from time import ctime
+from time import ctime, time
 from urllib2 import urlopen
 from string import join
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 import logging
 LOG = logging.getLogger('graphite')
 
 from leptoid.utils import parse_namespace_contents
+from leptoid.metrics import METRICS, timed
 
 SERIES_WINDOW_SIZE = 5
+DEFAULT_STEP = 60
+
+# Bytes read from Graphite at a time while parsing raw responses.
+READ_CHUNK_SIZE = 65536
+
+GRAPHITE_HOST = 'graphite.knewton.net'
+RENDER_PATH = '/render/?'
+
+# Sharded fetching defaults: concurrent requests, retries per shard, socket
+# timeout in seconds, and how targets are grouped into shards.
+SHARD_WORKERS = 4
+SHARD_RETRIES = 2
+SHARD_TIMEOUT = 60
+SHARD_KEYS = ('service', 'environment', 'target')
+
+# Environment and service embedded in a target, e.g.
+# scale(*.Production.Application-Knewmena.Instance.*.arrival_rate,0.016666)
+TARGET_PATTERN = re.compile(r'\*\.([^.]+)\.([^.]+)\.Instance\.')
+
+def build_render_path(targets, api_params):
+	""" Construct the path and query string of a /render API call. See
+	build_graphite_call().
+	"""
+
+	# Convert single namespace to a list.
+	if not isinstance(targets, list):
+		targets = list(targets)
+	target_list = ["&target=%s" % target for target in targets]
+	LOG.log(logging.DEBUG, "Building Graphite /render API call.")
+	call = RENDER_PATH
+	for config in api_params.iteritems():
+		call += '&%s' % '='.join(config)
+	call += join(target_list, "")
+
+	return call
 
 def build_graphite_call(targets, api_params):
 	""" Construct /render API call to Graphite. API params retrieved
@@ -26,71 +68,721 @@ def build_graphite_call(targets, api_params):
 		list of strs, queries for Graphite. Can accept either a single
 		namespace or a list of namespaces.
 	
-	Returns: pickled object sent by Graphite with namespace data.
+	Returns: str with the /render URL.
 	"""
+	return "https://%s%s" % (GRAPHITE_HOST,
+			build_render_path(targets, api_params))
 
-	# Convert single namespace to a list.
-	if not isinstance(targets, list):
-		targets = list(targets)
-	target_list = ["&target=%s" % target for target in targets]
-	LOG.log(logging.DEBUG, "Building Graphite /render API call.")
-	call = "https://graphite.knewton.net/render/?"
-	for config in api_params.iteritems():
-		call += '&%s' % '='.join(config)
-	call += join(target_list, "")
+class RawSeriesParser(object):
+	"""
+	Incremental parser for Graphite's raw format, where each series is a line:
 
-	return call
+		name,start,end,step|value,value,None,...
+
+	Chunks can be fed as they arrive from the network. Values are decoded
+	straight into a preallocated float array per series, with NaN for None.
+	"""
+
+	def __init__(self):
+		self.series = []
+		self.buffer = ''
+		self.current = None
+		self.position = 0
+
+	def _start_series(self, header):
+		""" Parses a series header and allocates its values. """
+		# Names can contain commas (e.g. scale(...,0.016666)), so split from
+		# the right.
+		name, start, end, step = header.rsplit(',', 3)
+		start, end, step = int(start), int(end), int(step)
+		values = np.empty((end - start) // step)
+		values.fill(np.nan)
+		self.current = {'name': name, 'start': start, 'end': end,
+				'step': step, 'values': values}
+		self.position = 0
+
+	def _add_values(self, tokens):
+		""" Writes decoded values into the current series. """
+		if not tokens:
+			return
+		values = np.array(tokens, dtype=float)
+		space = len(self.current['values']) - self.position
+		if len(values) > space:
+			LOG.warning("Too many values for %s; truncating." %
+					self.current['name'])
+			values = values[:space]
+		self.current['values'][self.position:self.position + len(values)] = \
+				values
+		self.position += len(values)
 
+	def feed(self, chunk):
+		""" Parses the next chunk of a raw response. """
+		data = self.buffer + chunk
+		self.buffer = ''
+		while data:
+			if self.current is None:
+				split = data.find('|')
+				if split == -1:
+					self.buffer = data
+					return
+				self._start_series(data[:split].lstrip())
+				data = data[split + 1:]
+
+			end = data.find('\n')
+			segment = data if end == -1 else data[:end]
+			tokens = segment.replace('None', 'nan').split(',')
+			if end == -1:
+				# The last value may continue in the next chunk.
+				self.buffer = tokens.pop()
+				self._add_values(tokens)
+				return
+
+			self._add_values([token for token in tokens if token])
+			self.series.append(self.current)
+			self.current = None
+			data = data[end + 1:]
+
+	def close(self):
+		""" Finishes parsing and returns the list of series dicts. """
+		if self.current is not None:
+			if self.buffer:
+				self._add_values(self.buffer.replace('None', 'nan').split(','))
+			self.series.append(self.current)
+		self.current = None
+		self.buffer = ''
+		return self.series
+
+def parse_raw(stream, chunk_size=READ_CHUNK_SIZE):
+	""" Parses a raw Graphite response while it is being read.
+
+	Returns: list of dicts with name, start, end, step and values.
+	"""
+	parser = RawSeriesParser()
+	chunk = stream.read(chunk_size)
+	while chunk:
+		parser.feed(chunk)
+		chunk = stream.read(chunk_size)
+	return parser.close()
+
+def parse_json(stream):
+	""" Parses a JSON Graphite response into the same series dicts as
+	parse_raw().
+	"""
+	series = []
+	for target in json.load(stream):
+		datapoints = target['datapoints']
+		values = np.array([point[0] for point in datapoints], dtype=float)
+		start = datapoints[0][1] if datapoints else 0
+		step = datapoints[1][1] - start if len(datapoints) > 1 \
+				else DEFAULT_STEP
+		series.append({'name': target['target'], 'start': start,
+			'end': start + len(values) * step, 'step': step,
+			'values': values})
+	return series
+
+PARSERS = {'raw': parse_raw, 'json': parse_json}
+
+@timed('graphite.fetch')
 def call_graphite(targets, api_params):
 	"""
-	Construct /render API call and retrieves pickled response from Graphite.
-	API params retrieved from YAML in as a dict. Details at:
+	Construct /render API call and parses Graphite's response as it streams
+	in. API params retrieved from YAML in as a dict. Details at:
 	http://graphite.readthedocs.org/en/0.9.10/render_api.html
 
+	Only the raw and json formats are supported; responses are never
+	unpickled.
+
 	Parameters
 	----------
 	targets
 		list of strs, target namespaces for Graphite query
 		Can accept either a single namespace or a list of namespaces.
 	
-	Returns: pickled object sent by Graphite with namespace data.
+	Returns: list of dicts with name, start, end, step and values (np.array,
+	NaN for missing data) for every series.
 	"""
+	api_params = _supported_params(api_params)
 	call = build_graphite_call(targets, api_params)
 	LOG.log(logging.INFO, "Calling Graphite with %s" % call)
 	response = urlopen(call)
-	return pickle.load(response)
+	return PARSERS[api_params['format']](response)
+
+def _supported_params(api_params):
+	""" Returns a copy of api_params requesting a format we can parse. """
+	api_params = dict(api_params)
+	if api_params.get('format') not in PARSERS:
+		LOG.warning("Graphite format %s is not supported; requesting raw." %
+				api_params.get('format'))
+		api_params['format'] = 'raw'
+	return api_params
+
+def shard_targets(targets, shard_by='service'):
+	"""
+	Groups targets into shards that can be fetched independently.
+
+	Parameters
+	----------
+	targets
+		list of strs, target namespaces for Graphite query
+	shard_by
+		str, one of SHARD_KEYS. Targets that don't name an environment and
+		service get a shard of their own.
+
+	Returns: list of lists of targets, in the order they first appear.
+	"""
+	if shard_by not in SHARD_KEYS:
+		raise Exception("Cannot shard Graphite targets by %s." % shard_by)
+
+	shards = OrderedDict()
+	for target in targets:
+		match = TARGET_PATTERN.search(target)
+		if match is None or shard_by == 'target':
+			key = target
+		elif shard_by == 'service':
+			key = match.group(2)
+		else:
+			key = match.group(1)
+		shards.setdefault(key, []).append(target)
+	return shards.values()
+
+class ShardedFetcher(object):
+	"""
+	Fetches Graphite targets in shards, over a bounded number of worker
+	threads. Keep-alive connections are pooled and reused across shards and
+	passes, and each shard is retried on its own, so one slow or failing
+	wildcard only costs its own shard.
+	"""
+
+	def __init__(self, workers=SHARD_WORKERS, retries=SHARD_RETRIES,
+			timeout=SHARD_TIMEOUT, shard_by='service', host=GRAPHITE_HOST):
+		"""
+		Parameters
+		----------
+		workers
+			int, maximum number of concurrent requests
+		retries
+			int, extra attempts for a shard after its first request fails
+		timeout
+			int, socket timeout in seconds for each request
+		shard_by
+			str, one of SHARD_KEYS
+		host
+			str, Graphite host
+		"""
+		self.workers = workers
+		self.retries = retries
+		self.timeout = timeout
+		self.shard_by = shard_by
+		self.host = host
+		self.connections = Queue.Queue()
+		self.failed = []
+		# Shards whose last request failed, by their targets.
+		self.incomplete = set()
+
+	@classmethod
+	def from_config(cls, shard_config):
+		""" Builds a fetcher from shard_config, or returns None if sharded
+		fetching is disabled.
+		"""
+		if not shard_config or not shard_config.get('enabled'):
+			return None
+		return cls(shard_config.get('workers', SHARD_WORKERS),
+				shard_config.get('retries', SHARD_RETRIES),
+				shard_config.get('timeout', SHARD_TIMEOUT),
+				shard_config.get('shard_by', 'service'))
+
+	def _connection(self):
+		""" Returns an idle pooled connection, or opens a new one. """
+		try:
+			return self.connections.get_nowait()
+		except Queue.Empty:
+			return httplib.HTTPSConnection(self.host, timeout=self.timeout)
+
+	def _fetch_shard(self, targets, api_params):
+		"""
+		Requests a single shard, retrying on connection and parse errors.
+
+		Returns: list of series dicts, or None if every attempt failed.
+		"""
+		path = build_render_path(targets, api_params)
+		for attempt in xrange(self.retries + 1):
+			connection = self._connection()
+			reusable = False
+			try:
+				with METRICS.timer('graphite.shard'):
+					connection.request('GET', path)
+					response = connection.getresponse()
+					if response.status != 200:
+						raise httplib.HTTPException("Graphite returned %i." %
+								response.status)
+					series = PARSERS[api_params['format']](response)
+				reusable = True
+			except (httplib.HTTPException, socket.error, ValueError), e:
+				LOG.warning("Graphite shard %s failed (attempt %i): %s" %
+						(targets[0], attempt + 1, e))
+				METRICS.incr('graphite.shard_errors')
+				continue
+			finally:
+				# A connection that failed may be half-read; never reuse it.
+				if reusable:
+					self.connections.put(connection)
+				else:
+					connection.close()
+			return series
+
+		LOG.error("Giving up on Graphite shard %s." % targets[0])
+		METRICS.incr('graphite.shard_failures')
+		return None
+
+	def _work(self, shards, results):
+		""" Worker loop: fetches shards until none are left. """
+		while True:
+			try:
+				idx, targets, api_params = shards.get_nowait()
+			except Queue.Empty:
+				return
+			results[idx] = self._fetch_shard(targets, api_params)
+
+	@timed('graphite.fetch')
+	def fetch(self, targets, api_params, backfill_params=None):
+		"""
+		Fetches every target, one shard per request. Shards that still fail
+		after their retries are left out and listed in self.failed.
+
+		Parameters
+		----------
+		targets
+			list of strs, target namespaces for Graphite query
+		api_params
+			dict of render API options
+		backfill_params
+			dict of render API options for shards whose last request failed,
+			e.g. the full window when api_params only asks for recent data
+
+		Returns: list of series dicts, as returned by call_graphite().
+		"""
+		api_params = _supported_params(api_params)
+		if backfill_params is not None:
+			backfill_params = _supported_params(backfill_params)
+		shards = shard_targets(targets, self.shard_by)
+		pending = Queue.Queue()
+		for idx, shard in enumerate(shards):
+			if backfill_params is not None and tuple(shard) in self.incomplete:
+				LOG.info("Backfilling Graphite shard %s." % shard[0])
+				pending.put((idx, shard, backfill_params))
+			else:
+				pending.put((idx, shard, api_params))
+		results = [None] * len(shards)
+
+		LOG.info("Fetching %i targets from Graphite in %i shards." %
+				(len(targets), len(shards)))
+		workers = [threading.Thread(target=self._work,
+			args=(pending, results))
+			for _ in xrange(min(self.workers, len(shards)))]
+		for worker in workers:
+			worker.daemon = True
+			worker.start()
+		for worker in workers:
+			worker.join()
+
+		self.failed = [shard for shard, result in zip(shards, results)
+				if result is None]
+		# Calls for other metrics share the fetcher; only update these shards.
+		self.incomplete.difference_update(tuple(shard) for shard in shards)
+		self.incomplete.update(tuple(shard) for shard in self.failed)
+		series = []
+		for result in results:
+			series.extend(result or [])
+		return series
+
+	def close(self):
+		""" Closes every pooled connection. """
+		while True:
+			try:
+				self.connections.get_nowait().close()
+			except Queue.Empty:
+				return
+
+class FleetMatrix(object):
+	"""
+	Moving averages for many Graphite series, aligned on one shared time index
+	and stacked into a single series x time array.
+	"""
+
+	def __init__(self, start, step, values, keys):
+		"""
+		Parameters
+		----------
+		start
+			int, epoch seconds of the first column
+		step
+			int, seconds between columns
+		values
+			np.array, series x time moving averages
+		keys
+			list of (env, service, instance) tuples, one per row
+		"""
+		self.start = start
+		self.step = step
+		self.values = values
+		self.keys = keys
+		self.rows = dict([(key, row) for row, key in enumerate(keys)])
+		self._index = None
+
+	def __len__(self):
+		return len(self.keys)
+
+	@property
+	def index(self):
+		""" pandas.PeriodIndex shared by every row. """
+		if self._index is None:
+			self._index = pandas.PeriodIndex(
+					start=ctime(self.start), periods=self.values.shape[1])
+		return self._index
+
+	def row(self, key):
+		""" Returns the moving averages for (env, service, instance). """
+		return self.values[self.rows[key]]
+
+	def to_time_series(self):
+		""" Nested dict (env -> service -> instance) of pandas.TimeSeries,
+		as returned by extract_time_series().
+		"""
+		namespace_data = dict([(env, defaultdict(dict))
+				for env in 'production', 'staging'])
+		for row, (env, service, instance_name) in enumerate(self.keys):
+			namespace_data[env][service][instance_name] = pandas.TimeSeries(
+					data=self.values[row], index=self.index)
+		return namespace_data
+
+# Graphite names seen before, mapped to (env, service, instance).
+_PARSED_NAMES = dict()
+
+def _parse_name(name):
+	""" Cached leptoid.utils.parse_namespace_contents(). """
+	if name not in _PARSED_NAMES:
+		_PARSED_NAMES[name] = parse_namespace_contents(name)
+	return _PARSED_NAMES[name]
+
+@timed('graphite.extract')
+def extract_fleet_matrix(graphite_data):
+	"""
+	Aligns every series in a Graphite response on one time index, stacks them
+	into a single array and computes all moving averages at once.
+
+	Parameters
+	----------
+	graphite_data
+		list of series returned by call_graphite().
+
+	Returns: leptoid.graphite.FleetMatrix.
+	"""
+	graphite_data = [rawdata for rawdata in graphite_data
+			if len(rawdata['values'])]
+	if not graphite_data:
+		return FleetMatrix(0, DEFAULT_STEP, np.zeros((0, 0)), [])
+
+	step = graphite_data[0].get('step', DEFAULT_STEP)
+	start = min(rawdata['start'] for rawdata in graphite_data)
+	end = max(rawdata['start'] + len(rawdata['values']) * step
+			for rawdata in graphite_data)
+	raw = np.empty((len(graphite_data), (end - start) // step))
+	raw.fill(np.nan)
+
+	keys = []
+	for rawdata in graphite_data:
+		if rawdata.get('step', DEFAULT_STEP) != step:
+			LOG.warning("Skipping %s: step differs from %i." %
+					(rawdata['name'], step))
+			continue
+		offset = (rawdata['start'] - start) // step
+		raw[len(keys), offset:offset + len(rawdata['values'])] = \
+				rawdata['values']
+		keys.append(_parse_name(rawdata['name']))
+
+	return FleetMatrix(start, step, moving_average(raw[:len(keys)]), keys)
 
 def extract_time_series(graphite_data):
 	"""
 	Parses raw Graphite data into time series grouped by instance. All time
-	series are moving averages, with window size defined above.
+	series are moving averages, with window size defined above, and share a
+	single time index.
 
 	Parameters
 	----------
 	graphite_data
-		pickled obj returned from Graphite's /render API.
+		list of series returned by call_graphite().
 
 	Returns: dict with key=metric name, val=pandas.TimeSeries.
 	"""
+	return extract_fleet_matrix(graphite_data).to_time_series()
 
-	namespace_data = dict([(env, defaultdict(dict))
-			for env in 'production', 'staging'])
-	for rawdata in graphite_data:
+def moving_average(values, window=SERIES_WINDOW_SIZE):
+	"""
+	Trailing moving average along the last axis of values. Mirrors
+	pandas.rolling_mean(series, window, window).fillna(0): any window that
+	is incomplete or contains a missing (NaN) value averages to 0.
 
-		# Must convert epoch seconds to datetime string.
-		starttime = ctime(rawdata['start'])
+	Parameters
+	----------
+	values
+		np.array (1-D or 2-D) of raw Graphite values, NaN for missing data
+	window
+		int, number of points in each window
+
+	Returns: np.array with the same shape as values.
+	"""
+	values = np.asarray(values, dtype=float)
+	valid = ~np.isnan(values)
+	pad = np.zeros(values.shape[:-1] + (1,))
+	sums = np.concatenate(
+			[pad, np.cumsum(np.where(valid, values, 0.), axis=-1)], axis=-1)
+	counts = np.concatenate([pad, np.cumsum(valid, axis=-1)], axis=-1)
+
+	averages = np.zeros(values.shape)
+	if values.shape[-1] >= window:
+		window_sums = sums[..., window:] - sums[..., :-window]
+		window_counts = counts[..., window:] - counts[..., :-window]
+		averages[..., window - 1:] = np.where(
+				window_counts == window, window_sums / window, 0.)
+	return averages
+
+class RollingSeries(object):
+	"""
+	Fixed-size ring buffer holding the most recent points of a single Graphite
+	series, along with its moving average. Each timestamp maps to a fixed slot,
+	so windows returned by successive Graphite calls can overlap safely; newer
+	values simply overwrite older ones.
+	"""
+
+	def __init__(self, capacity, step=DEFAULT_STEP, window=SERIES_WINDOW_SIZE,
+			values=None, averages=None, end=None):
+		"""
+		Parameters
+		----------
+		capacity
+			int, number of points retained
+		step
+			int, seconds between points
+		window
+			int, moving average window size
+		values, averages
+			np.arrays of length ${capacity} to hold the buffer, e.g. rows of a
+			leptoid.store.HistoryStore. New arrays are allocated (and the
+			buffer starts empty) if they are not given.
+		end
+			int, end of the data already held in values and averages
+		"""
+		self.capacity = capacity
+		self.step = step
+		self.window = window
+		self.values = values
+		self.averages = averages
+		self.end = end			# epoch seconds just past the newest point
+		if values is None or averages is None:
+			self.values = np.empty(capacity)
+			self.averages = np.empty(capacity)
+			self.clear()
+
+	def clear(self):
+		""" Empties the buffer in place. """
+		self.values.fill(np.nan)
+		self.averages.fill(0.)
+		self.end = None
+
+	@property
+	def start(self):
+		""" Timestamp of the oldest point held in the buffer. """
+		return self.end - self.capacity * self.step
+
+	def _slots(self, first, count):
+		""" Ring buffer slots for ${count} points starting at ${first}. """
+		return (first // self.step + np.arange(count)) % self.capacity
+
+	def merge(self, start, step, values):
+		"""
+		Merges points returned by Graphite into the buffer, then refreshes the
+		moving average for every point that could have changed.
+
+		Parameters
+		----------
+		start
+			int, epoch seconds of the first value
+		step
+			int, seconds between values
+		values
+			iterable of floats (None or NaN for missing data)
+		"""
+		values = np.asarray(values, dtype=float)
+		if step != self.step:
+			LOG.warning("Step changed from %i to %i; resetting buffer." %
+					(self.step, step))
+			self.clear()
+			self.step = step
+		if not len(values):
+			return
+
+		start -= start % step
+		new_end = start + len(values) * step
+		changed = start
+		if self.end is None:
+			self.end = new_end
+		elif new_end > self.end:
+			# Clear slots that are about to be reused for newer timestamps.
+			gap = min((new_end - self.end) // step, self.capacity)
+			self.values[self._slots(new_end - gap * step, gap)] = np.nan
+			changed = min(changed, new_end - gap * step)
+			self.end = new_end
+
+		# Drop anything older than the window we retain.
+		skip = max(0, (self.start - start) // step)
+		if skip >= len(values):
+			return
+		start += skip * step
+		values = values[skip:]
+		self.values[self._slots(start, len(values))] = values
+
+		# Moving averages from the first changed point onward must be
+		# recomputed, using ${window} - 1 older values as context.
+		changed = max(changed, self.start)
+		context = min(self.window - 1, (changed - self.start) // step)
+		first = changed - context * step
+		count = (self.end - first) // step
+		slots = self._slots(first, count)
+		self.averages[slots[context:]] = moving_average(
+				self.values[slots], self.window)[context:]
 
-		# seriesidx provides timestamps for pandas.TimeSeries
+	def ordered_averages(self):
+		""" Returns the moving average as an np.array, oldest first. """
+		return self.averages[self._slots(self.start, self.capacity)]
+
+	def to_time_series(self):
+		""" Returns the moving average as a pandas.TimeSeries, oldest first. """
 		seriesidx = pandas.PeriodIndex(
-				start=starttime, periods=len(rawdata['values']))
-		tser = pandas.TimeSeries(data=rawdata['values'], index=seriesidx)
-		tser = pandas.rolling_mean(tser, SERIES_WINDOW_SIZE, SERIES_WINDOW_SIZE)
-		tser = tser.fillna(0)		# handle all nans
-
-		# Populate dict with pandas.TimeSeries for each service's instances.
-		# Finding instance in metric name by identifying substring with 'i-'.
-		env, service, instance_name = parse_namespace_contents(rawdata['name'])
-		namespace_data[env][service][instance_name] = tser
-	
-	return namespace_data
+				start=ctime(self.start), periods=self.capacity)
+		return pandas.TimeSeries(data=self.ordered_averages(), index=seriesidx)
+
+class GraphiteHistory(object):
+	"""
+	Keeps a RollingSeries for every (env, service, instance) returned by
+	Graphite for one metric. The first call backfills the full history; later
+	calls only request the points added since the last call.
+	"""
+
+	def __init__(self, history_minutes, update_minutes, store=None):
+		"""
+		Parameters
+		----------
+		history_minutes
+			int, length of history retained for each series
+		update_minutes
+			int, minimum window requested on incremental calls
+		store
+			leptoid.store.HistoryStore persisting the buffers between
+			restarts; buffers are only kept in memory if None
+		"""
+		self.history_seconds = history_minutes * 60
+		self.update_seconds = update_minutes * 60
+		self.store = store
+		self.buffers = dict()
+		self.loaded = store is None
+
+	def _load(self):
+		""" Reads buffers from the store the first time they are needed. """
+		if not self.loaded:
+			self.buffers = self.store.load()
+			self.loaded = True
+
+	def _new_buffer(self, key, step):
+		""" Allocates a buffer for a new series, in the store if possible. """
+		if self.store is not None and step == self.store.step:
+			return self.store.allocate(key)
+		return RollingSeries(self.history_seconds // step, step)
+
+	def render_params(self, api_params):
+		"""
+		Returns a copy of api_params requesting only the data missing from the
+		buffers. The full window in api_params is used until a backfill has
+		completed.
+		"""
+		self._load()
+		params = dict(api_params)
+		ends = [buf.end for buf in self.buffers.itervalues()
+				if buf.end is not None]
+		if ends:
+			newest = max(ends)
+			seconds = max(self.update_seconds, int(time() - newest) + 2 *
+					DEFAULT_STEP)
+			if seconds < self.history_seconds:
+				params['from'] = '-%is' % seconds
+		return params
+
+	def pairs(self):
+		""" Returns the set of (env, service) pairs with buffered data. """
+		self._load()
+		return set(key[:2] for key, buf in self.buffers.iteritems()
+				if buf.end is not None)
+
+	@timed('graphite.merge')
+	def update(self, graphite_data, evict=True):
+		"""
+		Merges a Graphite response into the buffers. Series missing from the
+		response belong to instances that no longer exist and are evicted.
+
+		Parameters
+		----------
+		graphite_data
+			list of dicts returned by call_graphite()
+		evict
+			bool, False when the response is known to be partial (e.g. a shard
+			failed), so missing series are kept
+		"""
+		self._load()
+		seen = set()
+		for rawdata in graphite_data:
+			key = parse_namespace_contents(rawdata['name'])
+			step = rawdata.get('step', DEFAULT_STEP)
+			if key not in self.buffers:
+				self.buffers[key] = self._new_buffer(key, step)
+			self.buffers[key].merge(rawdata['start'], step, rawdata['values'])
+			seen.add(key)
+
+		if evict:
+			for key in set(self.buffers) - seen:
+				LOG.info("Evicting history for %s:%s:%s" % key)
+				del self.buffers[key]
+				if self.store is not None:
+					self.store.release(key)
+		if self.store is not None:
+			self.store.flush()
+
+	def extract_fleet_matrix(self):
+		""" Same output as leptoid.graphite.extract_fleet_matrix(), built from
+		the buffered moving averages.
+		"""
+		self._load()
+		# Buffers that never merged a point have no end, and no data.
+		keys = [key for key, buf in self.buffers.iteritems()
+				if buf.end is not None]
+		if not keys:
+			return FleetMatrix(0, DEFAULT_STEP, np.zeros((0, 0)), [])
+
+		step = self.buffers[keys[0]].step
+		end = max(self.buffers[key].end for key in keys)
+		ncols = self.history_seconds // step
+		start = end - ncols * step
+		values = np.zeros((len(keys), ncols))
+		for row, key in enumerate(keys):
+			buf = self.buffers[key]
+			# Buffers that stopped short of ${end} are shifted left.
+			shift = (end - buf.end) // buf.step
+			if buf.step != step or shift >= ncols:
+				continue
+			values[row, :ncols - shift] = buf.ordered_averages()[shift:]
+		return FleetMatrix(start, step, values, keys)
 
+	def extract_time_series(self):
+		""" Same output as leptoid.graphite.extract_time_series(), built from
+		the buffered moving averages.
+		"""
+		return self.extract_fleet_matrix().to_time_series()
@@ -0,0 +1,164 @@
+"""
+Hierarchical forecasting: instead of one model per instance, utilization is
+summed per (environment, service), one model is fitted per aggregate, and each
+aggregate forecast is split back to its instances.
+
+Each instance gets a share of its aggregate, its mean utilization over the
+last ${share_window} points divided by the aggregate's, plus a bias correction:
+its mean error over the last ${bias_window} points when the aggregate's
+in-sample forecast is split the same way. Forecasting cost then grows with the
+number of services rather than the number of hosts.
+"""
+
+import numpy as np
+import pandas
+from collections import namedtuple, OrderedDict
+
+import logging
+LOG = logging.getLogger('hierarchy')
+
+from leptoid.metrics import METRICS
+from leptoid.forecasting import RECENT_DATA_WINDOW
+
+# Instance id used for aggregates, e.g. in model cache keys.
+AGGREGATE_ID = '*'
+
+# Points used for instance shares, and for their bias correction.
+SHARE_WINDOW = 60
+BIAS_WINDOW = 15
+
+class ServiceAggregate(namedtuple('ServiceAggregate',
+		'environment service instance_id utilization')):
+	""" Summed utilization of a service's instances in one environment,
+	forecast like a leptoid.ServiceQueue.
+	"""
+	__slots__ = ()
+
+	def get_first_timestamp(self):
+		""" Returns timestamp for the first utilization value. """
+		return self.utilization.index[0]
+
+def aggregate_keys(keys):
+	""" Returns the aggregate keys for a list of (env, service, instance_id)
+	keys, in order of first appearance.
+	"""
+	return list(OrderedDict(((env, service, AGGREGATE_ID), None)
+		for env, service, _ in keys))
+
+def _utilization_matrix(queues):
+	""" Returns (matrix, index) with every queue's utilization as a row,
+	right-aligned and padded with 0 like missing Graphite data.
+	"""
+	if hasattr(queues, 'utilization') and hasattr(queues, 'index'):
+		return queues.utilization, queues.index
+	series = [queue.utilization for queue in queues]
+	longest = max(series, key=len)
+	matrix = np.zeros((len(series), len(longest)))
+	for row, values in enumerate(series):
+		matrix[row, len(longest) - len(values):] = np.asarray(values,
+				dtype=float)
+	return matrix, getattr(longest, 'index', None)
+
+class Hierarchy(object):
+	""" Aggregates queues per (environment, service) and splits aggregate
+	forecasts back to instances.
+	"""
+
+	def __init__(self, share_window=SHARE_WINDOW, bias_window=BIAS_WINDOW):
+		"""
+		Parameters
+		----------
+		share_window
+			int, recent points used to compute each instance's share
+		bias_window
+			int, recent points used for each instance's bias correction
+		"""
+		self.share_window = share_window
+		self.bias_window = bias_window
+
+	@classmethod
+	def from_config(cls, model_config):
+		""" Builds a Hierarchy from model_config, or returns None unless
+		hierarchical forecasting is enabled.
+		"""
+		if not model_config or not model_config.get('hierarchical'):
+			return None
+		return cls(model_config.get('share_window', SHARE_WINDOW),
+				model_config.get('bias_window', BIAS_WINDOW))
+
+	def aggregate(self, queues, keys):
+		"""
+		Sums utilization per (environment, service).
+
+		Parameters
+		----------
+		queues
+			list of leptoid.ServiceQueues, or a leptoid.FleetQueues
+		keys
+			list of (env, service, instance_id) tuples, one per queue
+
+		Returns a tuple with the utilization matrix, a list of
+		ServiceAggregates and, for each aggregate, the rows of its instances.
+		"""
+		matrix, index = _utilization_matrix(queues)
+		groups = OrderedDict()
+		for row, (env, service, _) in enumerate(keys):
+			groups.setdefault((env, service), []).append(row)
+
+		aggregates = []
+		for (env, service), rows in groups.iteritems():
+			total = matrix[rows].sum(axis=0)
+			if index is not None:
+				total = pandas.TimeSeries(data=total, index=index)
+			aggregates.append(ServiceAggregate(env, service, AGGREGATE_ID,
+				total))
+		METRICS.gauge('forecasting.aggregates', len(aggregates))
+		LOG.info("Aggregated %i instances into %i services." %
+				(len(keys), len(aggregates)))
+		return matrix, aggregates, groups.values()
+
+	def split(self, matrix, groups, forecasts):
+		"""
+		Splits aggregate forecasts back to instances.
+
+		Parameters
+		----------
+		matrix
+			np.array, utilization with one row per instance
+		groups
+			list with the instance rows of each aggregate
+		forecasts
+			list of (in_sample_forecast, util_estimate) tuples, one per
+			aggregate
+
+		Returns a list of (in_sample_forecast, util_estimate) tuples, one per
+		instance, with (None, None) where the aggregate had no forecast or the
+		instance no recent data.
+		"""
+		results = [(None, None)] * len(matrix)
+		for rows, (in_sample, estimate) in zip(groups, forecasts):
+			if in_sample is None or estimate is None:
+				continue
+			values = matrix[rows]
+			in_sample = np.asarray(in_sample, dtype=float)
+			estimate = np.asarray(estimate, dtype=float)
+
+			# Shares of the aggregate's recent load; equal if it had none.
+			recent = values[:, -1 * self.share_window:].mean(axis=1)
+			if recent.sum() > 0:
+				shares = recent / recent.sum()
+			else:
+				shares = np.repeat(1. / len(rows), len(rows))
+
+			width = min(len(in_sample), values.shape[1])
+			fitted = shares[:, np.newaxis] * in_sample[-1 * width:]
+			errors = values[:, -1 * width:] - fitted
+			bias = np.nan_to_num(
+					errors[:, -1 * self.bias_window:].mean(axis=1))
+			for idx, row in enumerate(rows):
+				# Dormant instances get no forecast, as in leptoid.forecasting.
+				if not values[idx, -1 * RECENT_DATA_WINDOW:].any():
+					continue
+				results[row] = (fitted[idx] + bias[idx],
+						np.maximum(shares[idx] * estimate + bias[idx], 0.))
+		return results
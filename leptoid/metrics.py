@@ -0,0 +1,293 @@
+"""
+Lightweight timers, counters and gauges for the stages of a scaling pass,
+sent to carbon (Graphite's backend) in batches.
+
+Measurements are aggregated in memory and sent when flush() is called (once
+per pass by the run script), or when the last flush is older than the flush
+interval. Timers are reported as <name>.count, <name>.total and <name>.max
+(seconds), counters as their sum and gauges as their last value. Every datapoint
+in a flush carries the same timestamp.
+
+Metrics are off until configure() is given an enabled metrics_config; while
+off, timers are a shared no-op and nothing is recorded.
+
+    from leptoid.metrics import METRICS
+
+    with METRICS.timer('graphite.fetch'):
+        ...
+    METRICS.incr('deploy.timeouts')
+"""
+
+import socket
+import struct
+import cPickle
+import threading
+from time import time
+from functools import wraps
+
+import logging
+LOG = logging.getLogger('metrics')
+
+# Defaults for carbon: plaintext listens on 2003, pickle on 2004.
+CARBON_HOST = 'localhost'
+CARBON_PORTS = {'plaintext': 2003, 'pickle': 2004}
+METRIC_PREFIX = 'leptoid'
+
+# Seconds between automatic flushes, and the largest UDP payload sent.
+FLUSH_INTERVAL = 60
+MAX_DATAGRAM = 8192
+
+class CarbonSink(object):
+	"""
+	Sends datapoints to carbon with the plaintext protocol (over UDP or TCP)
+	or the pickle protocol (over TCP). Send failures are logged and the batch
+	dropped; they never reach the caller.
+	"""
+
+	def __init__(self, host=CARBON_HOST, port=None, protocol='plaintext',
+			transport='udp'):
+		"""
+		Parameters
+		----------
+		host
+			str, carbon host
+		port
+			int, carbon port (defaults to the protocol's standard port)
+		protocol
+			str, 'plaintext' or 'pickle'
+		transport
+			str, 'udp' or 'tcp'; pickle requires tcp
+		"""
+		if protocol not in CARBON_PORTS:
+			raise Exception("Unknown carbon protocol %s." % protocol)
+		if transport not in ('udp', 'tcp'):
+			raise Exception("Unknown carbon transport %s." % transport)
+		if protocol == 'pickle' and transport != 'tcp':
+			raise Exception("Carbon only accepts pickled metrics over TCP.")
+		self.address = (host, port or CARBON_PORTS[protocol])
+		self.protocol = protocol
+		self.transport = transport
+		self.socket = None
+
+	@classmethod
+	def from_config(cls, metrics_config):
+		""" Builds a sink from metrics_config, or returns None if metrics are
+		disabled.
+		"""
+		if not metrics_config or not metrics_config.get('enabled'):
+			return None
+		return cls(metrics_config.get('host', CARBON_HOST),
+				metrics_config.get('port'),
+				metrics_config.get('protocol', 'plaintext'),
+				metrics_config.get('transport', 'udp'))
+
+	def _encode(self, datapoints):
+		""" Returns the list of payloads to send for datapoints. """
+		if self.protocol == 'pickle':
+			payload = cPickle.dumps([(path, (timestamp, value))
+				for path, value, timestamp in datapoints], protocol=2)
+			return [struct.pack('!L', len(payload)) + payload]
+
+		lines = ["%s %s %i\n" % datapoint for datapoint in datapoints]
+		if self.transport == 'tcp':
+			return [''.join(lines)]
+		# Keep each datagram small enough to avoid fragmentation.
+		payloads, current = [], ''
+		for line in lines:
+			if current and len(current) + len(line) > MAX_DATAGRAM:
+				payloads.append(current)
+				current = ''
+			current += line
+		return payloads + [current]
+
+	def send(self, datapoints):
+		"""
+		Sends datapoints to carbon.
+
+		Parameters
+		----------
+		datapoints
+			list of (path, value, timestamp) tuples
+		"""
+		if not datapoints:
+			return
+		try:
+			if self.socket is None:
+				if self.transport == 'udp':
+					self.socket = socket.socket(socket.AF_INET,
+							socket.SOCK_DGRAM)
+				else:
+					self.socket = socket.create_connection(self.address, 5)
+			for payload in self._encode(datapoints):
+				if self.transport == 'udp':
+					self.socket.sendto(payload, self.address)
+				else:
+					self.socket.sendall(payload)
+		except socket.error, e:
+			LOG.warning("Could not send %i metrics to carbon: %s" %
+					(len(datapoints), e))
+			self.close()
+
+	def close(self):
+		""" Closes the socket; the next send reconnects. """
+		if self.socket is not None:
+			self.socket.close()
+			self.socket = None
+
+class MemorySink(object):
+	""" Keeps every datapoint sent to it, for tests. """
+
+	def __init__(self):
+		self.datapoints = []
+
+	def send(self, datapoints):
+		self.datapoints.extend(datapoints)
+
+	def close(self):
+		pass
+
+	def values(self):
+		""" Returns a dict of the last value sent for every path. """
+		return dict((path, value) for path, value, _ in self.datapoints)
+
+class _NullTimer(object):
+	""" Timer used while metrics are off. """
+	__slots__ = ()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		return False
+
+NULL_TIMER = _NullTimer()
+
+class _Timer(object):
+	""" Context manager recording its duration under name. """
+	__slots__ = ('client', 'name', 'started')
+
+	def __init__(self, client, name):
+		self.client = client
+		self.name = name
+
+	def __enter__(self):
+		self.started = time()
+		return self
+
+	def __exit__(self, *exc_info):
+		self.client.timing(self.name, time() - self.started)
+		return False
+
+class MetricsClient(object):
+	""" Aggregates measurements between flushes and hands them to a sink. """
+
+	def __init__(self, sink=None, prefix=METRIC_PREFIX,
+			flush_interval=FLUSH_INTERVAL):
+		"""
+		Parameters
+		----------
+		sink
+			CarbonSink, MemorySink or None (metrics off)
+		prefix
+			str, prepended to every metric name
+		flush_interval
+			int, seconds after which a measurement triggers a flush
+		"""
+		self.sink = sink
+		self.prefix = prefix
+		self.flush_interval = flush_interval
+		self.lock = threading.Lock()
+		self.send_lock = threading.Lock()
+		self.timers = dict()
+		self.counters = dict()
+		self.gauges = dict()
+		self.last_flush = time()
+
+	@property
+	def enabled(self):
+		return self.sink is not None
+
+	def configure(self, metrics_config):
+		""" Points the client at the sink described by metrics_config,
+		turning metrics off if it is missing or disabled.
+		"""
+		if self.sink is not None:
+			self.sink.close()
+		self.sink = CarbonSink.from_config(metrics_config)
+		self.prefix = (metrics_config or {}).get('prefix', METRIC_PREFIX)
+		self.flush_interval = (metrics_config or {}).get('flush_interval',
+				FLUSH_INTERVAL)
+		with self.lock:
+			self.timers, self.counters, self.gauges = dict(), dict(), dict()
+
+	def timer(self, name):
+		""" Returns a context manager timing its block under name. """
+		if self.sink is None:
+			return NULL_TIMER
+		return _Timer(self, name)
+
+	def timing(self, name, seconds):
+		""" Records a duration in seconds. """
+		if self.sink is None:
+			return
+		with self.lock:
+			count, total, longest = self.timers.get(name, (0, 0., 0.))
+			self.timers[name] = (count + 1, total + seconds,
+					max(longest, seconds))
+		self._maybe_flush()
+
+	def incr(self, name, value=1):
+		""" Adds value to a counter. """
+		if self.sink is None:
+			return
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + value
+		self._maybe_flush()
+
+	def gauge(self, name, value):
+		""" Records the current value of a gauge. """
+		if self.sink is None:
+			return
+		with self.lock:
+			self.gauges[name] = value
+		self._maybe_flush()
+
+	def _maybe_flush(self):
+		if time() - self.last_flush >= self.flush_interval:
+			self.flush()
+
+	def flush(self):
+		""" Sends everything recorded since the last flush. """
+		if self.sink is None:
+			return
+		now = time()
+		with self.lock:
+			timers, counters, gauges = self.timers, self.counters, self.gauges
+			self.timers, self.counters, self.gauges = dict(), dict(), dict()
+			self.last_flush = now
+
+		datapoints = []
+		path = lambda name: '%s.%s' % (self.prefix, name)
+		for name, (count, total, longest) in timers.iteritems():
+			datapoints += [(path(name + '.count'), count, now),
+					(path(name + '.total'), total, now),
+					(path(name + '.max'), longest, now)]
+		for name, value in counters.iteritems():
+			datapoints.append((path(name), value, now))
+		for name, value in gauges.iteritems():
+			datapoints.append((path(name), value, now))
+		with self.send_lock:
+			self.sink.send(datapoints)
+
+# Process-wide client, off until configured.
+METRICS = MetricsClient()
+
+def timed(name):
+	""" Decorator timing every call to a function under name. """
+	def decorate(function):
+		@wraps(function)
+		def wrapper(*args, **kwargs):
+			with METRICS.timer(name):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorate
@@ -0,0 +1,114 @@
+"""
+Cache of fitted forecasting models keyed by (env, service, instance_id). Most
+passes only add a minute or two to each instance's history, so a cached model
+can be brought up to date with the new points instead of being re-estimated
+from scratch. Models are fully refit on a schedule, or sooner if their recent
+residuals drift away from those seen at fitting time.
+"""
+
+import numpy as np
+
+import logging
+LOG = logging.getLogger('model_cache')
+
+# Number of recent residuals checked for drift.
+DRIFT_WINDOW = 15
+
+class CachedModel(object):
+	""" Chosen model form, fitted parameters and final state for a single
+	instance.
+	"""
+
+	def __init__(self, form, params, sigma2, state=None, fitted=None,
+			last_index=None):
+		"""
+		Parameters
+		----------
+		form
+			str, model form (e.g. 'AAN')
+		params
+			dict with fitted smoothing parameters
+		sigma2
+			float, residual variance when the model was fitted
+		state
+			tuple with the model's final states, if the backend can reuse them
+		fitted
+			np.array, one-step ahead forecasts for the current series
+		last_index
+			index of the last observation absorbed into state
+		"""
+		self.form = form
+		self.params = params
+		self.sigma2 = sigma2
+		self.state = state
+		self.fitted = fitted
+		self.last_index = last_index
+		self.residuals = np.array([])
+		self.passes = 0
+
+class ModelCache(object):
+	"""
+	Holds a CachedModel per instance and decides when a model needs a full
+	re-estimation.
+	"""
+
+	def __init__(self, refit_passes=60, drift_ratio=4.0):
+		"""
+		Parameters
+		----------
+		refit_passes
+			int, passes between full re-estimations of a model
+		drift_ratio
+			float, ratio of recent mean squared residuals to the fitted
+			variance above which a model is re-estimated early
+		"""
+		self.refit_passes = refit_passes
+		self.drift_ratio = drift_ratio
+		self.models = dict()
+
+	@classmethod
+	def from_config(cls, model_config):
+		""" Builds a cache from model_config, or returns None if warm starts
+		are disabled.
+		"""
+		if not model_config or not model_config.get('warm_start'):
+			return None
+		return cls(model_config.get('refit_passes', 60),
+				model_config.get('drift_ratio', 4.0))
+
+	def __len__(self):
+		return len(self.models)
+
+	def __contains__(self, key):
+		return key in self.models
+
+	def get(self, key):
+		""" Returns the cached model for key if it can still be reused, and
+		None if it is missing or due for a full re-estimation.
+		"""
+		entry = self.models.get(key)
+		if entry is not None and entry.passes >= self.refit_passes:
+			LOG.debug("Scheduled refit for %s:%s:%s" % key)
+			entry = None
+		return entry
+
+	def put(self, key, entry):
+		""" Stores a freshly fitted model. """
+		self.models[key] = entry
+
+	def has_drifted(self, entry, residuals):
+		""" Checks recent residuals against the model's fitted variance. """
+		recent = np.asarray(residuals)[-DRIFT_WINDOW:]
+		if not len(recent):
+			return False
+		return np.mean(recent ** 2) > self.drift_ratio * entry.sigma2
+
+	def retain(self, keys):
+		""" Evicts every model whose key is not in keys, e.g. instances that
+		no longer appear in Graphite.
+		"""
+		stale = set(self.models) - set(keys)
+		for key in stale:
+			del self.models[key]
+		if stale:
+			LOG.info("Evicted %i cached models." % len(stale))
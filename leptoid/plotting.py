@@ -0,0 +1,183 @@
+"""
+Background rendering of utilization forecast plots. Forecasts are queued as
+plain arrays and rendered by a daemon thread, so scaling decisions never wait
+on R's bitmap device or on disk writes.
+
+The queue is bounded: when it is full the oldest jobs are dropped. Plots are
+also rate-limited per instance.
+"""
+
+import datetime
+import threading
+import numpy as np
+from time import time
+from collections import deque, namedtuple
+
+import logging
+LOG = logging.getLogger('plotting')
+
+from leptoid.utils import R
+from leptoid.metrics import METRICS
+
+PLOT_DIRECTORY = '/var/leptoid/img/'
+PLOT_SIGNIFICANCE_THRESHOLD = 1E-5
+
+# Plot queue defaults: maximum queued jobs, and minimum seconds between two
+# plots of the same instance.
+PLOT_QUEUE_SIZE = 100
+PLOT_MIN_INTERVAL = 900
+
+# Everything needed to render one forecast plot.
+PlotJob = namedtuple('PlotJob', 'service instance_id utilization ' +
+		'in_sample_forecast util_estimate first_timestamp created')
+
+def render_plot(job):
+	"""
+	Plots observed utilization, the in-sample forecast and the utilization
+	forecast with R's graphics functions.
+
+	Parameters
+	----------
+	job
+		PlotJob with the forecast to render
+
+	Returns nothing, but saves a plot to disk with a timestamp.
+	"""
+	n = job.created
+	with R.lock:
+		robjects = R.robjects
+		observed = robjects.FloatVector(np.asarray(job.utilization,
+			dtype=float))
+		fitted = robjects.FloatVector(np.asarray(job.in_sample_forecast))
+		estimate = robjects.FloatVector(np.asarray(job.util_estimate))
+		nobs = len(observed)
+		ahead = robjects.IntVector(range(nobs + 1, nobs + len(estimate) + 1))
+		robjects.r['bitmap']('%s%s-%s-%i-%i-%i-%i:%i.jpg' %
+				(PLOT_DIRECTORY, job.service, job.instance_id, n.year,
+					n.month, n.day, n.hour, n.minute),
+				width=1400, height=800, units='px', type='jpeg')
+		robjects.r['plot'](observed, type='l',
+				xlim=robjects.IntVector([1, nobs + len(estimate)]),
+				main="Util forecast for %s:%s" % (job.service, job.instance_id),
+				xlab="Minutes elapsed since %s" % job.first_timestamp,
+				ylab="Utilization")
+		robjects.r['lines'](fitted, col='blue')
+		robjects.r['lines'](ahead, estimate, col='red')
+		robjects.r['dev.off']()
+
+def _copy(values):
+	""" Copies a forecast array, which may be None. """
+	if values is None:
+		return None
+	return np.array(values, dtype=float, copy=True)
+
+class ForecastPlotter(object):
+	"""
+	Bounded queue of forecast plots, drained by a background thread.
+	"""
+
+	def __init__(self, queue_size=PLOT_QUEUE_SIZE,
+			min_interval=PLOT_MIN_INTERVAL, renderer=render_plot):
+		"""
+		Parameters
+		----------
+		queue_size
+			int, maximum number of queued plots; older plots are dropped
+		min_interval
+			int, minimum seconds between plots of the same instance
+		renderer
+			callable taking a PlotJob
+		"""
+		self.jobs = deque(maxlen=queue_size)
+		self.min_interval = min_interval
+		self.renderer = renderer
+		self.condition = threading.Condition()
+		self.last_plotted = dict()
+		self.dropped = 0
+		self.thread = None
+
+	@classmethod
+	def from_config(cls, plot_config):
+		""" Builds a plotter from plot_config, or returns None if plotting is
+		disabled.
+		"""
+		if not plot_config or not plot_config.get('enabled'):
+			return None
+		return cls(plot_config.get('queue_size', PLOT_QUEUE_SIZE),
+				plot_config.get('min_interval', PLOT_MIN_INTERVAL))
+
+	def submit(self, queue, in_sample_forecast, util_estimate):
+		"""
+		Queues a forecast for plotting. Empty forecasts and instances plotted
+		within the last ${min_interval} seconds are skipped.
+
+		Parameters
+		----------
+		queue
+			leptoid.ServiceQueue the forecast was generated for
+		in_sample_forecast, util_estimate
+			np.arrays returned by leptoid.forecasting.forecast()
+
+		Returns True if the plot was queued.
+		"""
+		# Let's avoid empty plots
+		if util_estimate is None or \
+				np.max(util_estimate) <= PLOT_SIGNIFICANCE_THRESHOLD:
+			return False
+
+		key = (queue.service, queue.instance_id)
+		now = time()
+		if now - self.last_plotted.get(key, -1 * self.min_interval) < \
+				self.min_interval:
+			return False
+
+		# Copies, so queued jobs don't keep whole fleet matrices alive.
+		job = PlotJob(queue.service, queue.instance_id,
+				np.array(queue.utilization, dtype=float, copy=True),
+				_copy(in_sample_forecast), _copy(util_estimate),
+				queue.get_first_timestamp(), datetime.datetime.now())
+		with self.condition:
+			if len(self.jobs) == self.jobs.maxlen:
+				# The dropped instance may be plotted again next pass.
+				oldest = self.jobs[0]
+				self.last_plotted.pop((oldest.service, oldest.instance_id),
+						None)
+				self.dropped += 1
+				METRICS.incr('plotting.dropped')
+				LOG.debug("Plot queue full; dropping oldest plot.")
+			self.jobs.append(job)
+			self.last_plotted[key] = now
+			self.condition.notify()
+
+		if self.thread is None:
+			self.thread = threading.Thread(target=self._run, name='plotter')
+			self.thread.daemon = True
+			self.thread.start()
+		return True
+
+	def _render(self, job):
+		""" Renders a job, logging (rather than raising) any failure. """
+		try:
+			with METRICS.timer('plotting.render'):
+				self.renderer(job)
+		except Exception, e:
+			LOG.error("Could not plot %s:%s." % (job.service, job.instance_id))
+			LOG.error(e)
+
+	def _run(self):
+		""" Background loop rendering queued plots. """
+		while True:
+			with self.condition:
+				while not self.jobs:
+					self.condition.wait()
+				job = self.jobs.popleft()
+			self._render(job)
+
+	def drain(self):
+		""" Renders every queued plot in the calling thread. """
+		while True:
+			with self.condition:
+				if not self.jobs:
+					return
+				job = self.jobs.popleft()
+			self._render(job)
@@ -0,0 +1,127 @@
+"""
+Multi-resolution view of utilization history for model fitting. Fitting on
+days of minute-level data costs time and memory in proportion to the series
+length, yet only the recent past drives a short-horizon forecast; older data
+matters for the daily pattern.
+
+CompactView keeps the last ${recent_minutes} at minute resolution and
+downsamples the full history to ${coarse_minutes} means. A daily profile is
+built from the coarse means (the average of each time-of-day slot over the
+days available, centered on zero) and subtracted from the recent minutes.
+Models are fitted to that short, deseasonalized series, and the profile is
+added back to their in-sample and out-of-sample forecasts. With the defaults,
+three days of minutes (4320 points) are fitted as 360, while the daily pattern
+comes from 96 slots of 15 minutes.
+"""
+
+import numpy as np
+
+import logging
+LOG = logging.getLogger('resolution')
+
+from leptoid.graphite import DEFAULT_STEP
+
+# Defaults: minutes kept at full resolution, minutes per coarse point, and the
+# length of the seasonal cycle.
+RECENT_MINUTES = 360
+COARSE_MINUTES = 15
+SEASON_MINUTES = 1440
+
+class CompactView(object):
+	""" Short, deseasonalized series to fit, and the seasonal component to
+	add back to forecasts.
+	"""
+
+	def __init__(self, recent_minutes=RECENT_MINUTES,
+			coarse_minutes=COARSE_MINUTES, season_minutes=SEASON_MINUTES,
+			step=DEFAULT_STEP):
+		"""
+		Parameters
+		----------
+		recent_minutes
+			int, minutes of full-resolution data models are fitted to
+		coarse_minutes
+			int, minutes averaged into each point of the seasonal profile
+		season_minutes
+			int, length of the seasonal cycle (a day)
+		step
+			int, seconds between points of the full-resolution data
+		"""
+		self.recent = max(1, recent_minutes * 60 // step)
+		self.factor = max(1, coarse_minutes * 60 // step)
+		self.slots = max(1, season_minutes // coarse_minutes)
+
+	@classmethod
+	def from_config(cls, model_config):
+		""" Builds a view from model_config, or returns None unless
+		compact_view is enabled.
+		"""
+		if not model_config or not model_config.get('compact_view'):
+			return None
+		return cls(model_config.get('recent_minutes', RECENT_MINUTES),
+				model_config.get('coarse_minutes', COARSE_MINUTES),
+				model_config.get('season_minutes', SEASON_MINUTES))
+
+	def downsample(self, matrix):
+		""" Means over blocks of ${coarse_minutes}, aligned on the newest
+		point; a partial oldest block is dropped.
+		"""
+		nblocks = matrix.shape[1] // self.factor
+		blocks = matrix[:, matrix.shape[1] - nblocks * self.factor:]
+		return blocks.reshape(len(matrix), nblocks, self.factor).mean(axis=2)
+
+	def profile(self, matrix):
+		"""
+		Daily profile of every row of matrix: one value per time-of-day slot,
+		centered on zero. The last slot holds the block with the newest
+		point. Rows with less than a full cycle of history get a flat profile.
+		"""
+		coarse = self.downsample(matrix)
+		ncycles = coarse.shape[1] // self.slots
+		if not ncycles:
+			return np.zeros((len(matrix), self.slots))
+		cycles = coarse[:, -1 * ncycles * self.slots:].reshape(len(matrix),
+				ncycles, self.slots)
+		profile = cycles.mean(axis=1)
+		return profile - profile.mean(axis=1)[:, np.newaxis]
+
+	def seasonal(self, profile, offsets):
+		"""
+		Profile values at points ${offsets} steps after the newest point (0 is
+		the newest point, negative offsets are in the past).
+		"""
+		blocks = (np.asarray(offsets) + self.factor - 1) // self.factor
+		return profile[:, (self.slots - 1 + blocks) % self.slots]
+
+	def prepare(self, matrix, horizon):
+		"""
+		Builds the series to fit.
+
+		Parameters
+		----------
+		matrix
+			np.array, hosts x time utilization at full resolution
+		horizon
+			int, forecast horizon in points
+
+		Returns a tuple with the deseasonalized recent points (hosts x
+		recent), and the seasonal components over those points and over the
+		horizon.
+		"""
+		width = min(self.recent, matrix.shape[1])
+		profile = self.profile(matrix)
+		past = self.seasonal(profile, np.arange(1 - width, 1))
+		ahead = self.seasonal(profile, np.arange(1, horizon + 1))
+		return matrix[:, -1 * width:] - past, past, ahead
+
+	@staticmethod
+	def restore(fitted, mean, past, ahead, width):
+		"""
+		Adds the seasonal components back to one row's forecasts. The
+		in-sample forecast is padded with NaN to ${width} points, so it lines
+		up with the full-resolution series.
+		"""
+		fitted = np.asarray(fitted, dtype=float) + past[-1 * len(fitted):]
+		padding = np.repeat(np.nan, max(0, width - len(fitted)))
+		return (np.concatenate([padding, fitted]),
+				np.asarray(mean, dtype=float) + ahead[:len(mean)])
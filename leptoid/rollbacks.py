@@ -0,0 +1,163 @@
+"""
+Tracks recent upscales so instances that run into trouble again soon after
+can be rolled back instead of upscaled further.
+
+Deployments are indexed by instance id, so finding an instance's deployment
+doesn't scan every recorded deployment, and a heap ordered by expiry time lets
+old deployments be dropped as they age out of their environment's rollback
+window, whether or not their instances are ever looked up again.
+"""
+
+import heapq
+import datetime
+import threading
+
+import logging
+LOG = logging.getLogger('rollbacks')
+
+# Seconds after an upscale during which it may be rolled back.
+ROLLBACK_LIMITS = {'production': 3600, 'staging': 600}
+
+class RollbackTracker(object):
+	"""
+	Dict-like map from a deployment's instance ids (a tuple) to its
+	leptoid.utils.RollbackDetails, with an instance id index and an expiry
+	heap.
+	"""
+
+	def __init__(self, limits=None, clock=datetime.datetime.now):
+		"""
+		Parameters
+		----------
+		limits
+			dict mapping environments to seconds during which a deployment
+			may be rolled back
+		clock
+			callable returning the current datetime
+		"""
+		self.limits = dict(limits or ROLLBACK_LIMITS)
+		self.clock = clock
+		self.lock = threading.Lock()
+		self.deployments = dict()		# instance ids -> RollbackDetails
+		self.index = dict()				# instance id -> instance ids
+		self.expiry = []				# (expires, sequence, ids, details)
+		self.sequence = 0
+
+	@staticmethod
+	def _key(instance_ids):
+		""" Returns instance_ids as a tuple; a single id may be a string. """
+		if isinstance(instance_ids, basestring):
+			return (instance_ids,)
+		return tuple(instance_ids)
+
+	def _limit(self, environment):
+		""" Rollback window for environment; the longest one if unknown. """
+		if environment in self.limits:
+			seconds = self.limits[environment]
+		else:
+			seconds = max(self.limits.values() or [0])
+		return datetime.timedelta(seconds=seconds)
+
+	def _remove(self, key):
+		""" Drops a deployment and its index entries. Call with the lock. """
+		self.deployments.pop(key, None)
+		for iid in key:
+			if self.index.get(iid) == key:
+				del self.index[iid]
+
+	def record(self, instance_ids, details, environment=None):
+		"""
+		Remembers a deployment, replacing any earlier deployment of the same
+		instances.
+
+		Parameters
+		----------
+		instance_ids
+			tuple of instance ids launched by the deployment (or a single id)
+		details
+			leptoid.utils.RollbackDetails
+		environment
+			str, environment whose rollback window applies
+
+		Deployments without instance ids (None, e.g. in noop mode) aren't
+		recorded.
+		"""
+		if not instance_ids:
+			return
+		self.expire()
+		key = self._key(instance_ids)
+		with self.lock:
+			for iid in key:
+				previous = self.index.get(iid)
+				if previous is not None and previous != key:
+					self._remove(previous)
+			self.deployments[key] = details
+			for iid in key:
+				self.index[iid] = key
+			self.sequence += 1
+			heapq.heappush(self.expiry, (details.time +
+				self._limit(environment), self.sequence, key, details))
+
+	def expire(self, now=None):
+		""" Drops deployments whose rollback window has passed. Returns the
+		number dropped.
+		"""
+		now = now or self.clock()
+		dropped = 0
+		with self.lock:
+			while self.expiry and self.expiry[0][0] < now:
+				_, _, key, details = heapq.heappop(self.expiry)
+				# Skip heap entries for deployments replaced since.
+				if self.deployments.get(key) is details:
+					self._remove(key)
+					dropped += 1
+		if dropped:
+			LOG.debug("Dropped %i expired deployments." % dropped)
+		return dropped
+
+	def find(self, instance_id, environment):
+		"""
+		Returns the RollbackDetails of the deployment that launched
+		instance_id if it is still within environment's rollback window, and
+		None otherwise.
+		"""
+		now = self.clock()
+		self.expire(now)
+		with self.lock:
+			key = self.index.get(instance_id)
+			if key is None:
+				return None
+			details = self.deployments[key]
+			if details.time + self._limit(environment) < now:
+				self._remove(key)
+				return None
+			return details
+
+	def __contains__(self, item):
+		""" Accepts a deployment's instance ids or a single instance id. """
+		with self.lock:
+			return item in self.index or self._key(item) in self.deployments
+
+	def __getitem__(self, instance_ids):
+		return self.deployments[self._key(instance_ids)]
+
+	def __setitem__(self, instance_ids, details):
+		self.record(instance_ids, details)
+
+	def __delitem__(self, instance_ids):
+		key = self._key(instance_ids)
+		with self.lock:
+			if key not in self.deployments:
+				raise KeyError(instance_ids)
+			self._remove(key)
+
+	def __len__(self):
+		return len(self.deployments)
+
+	def keys(self):
+		return self.deployments.keys()
+
+	def update(self, deployments):
+		""" Records every deployment in a dict of instance ids to details. """
+		for instance_ids, details in deployments.iteritems():
+			self.record(instance_ids, details)
@@ -7,14 +7,25 @@ import numpy as np
 import logging
 import datetime
 
+import leptoid.config as configuration
 import leptoid.deploy as deploy
 import leptoid.graphite as graphite
 import leptoid.utils as utils
-from leptoid.service_queue import generate_service_queues
+from leptoid.service_queue import generate_fleet_queues
+from leptoid.store import HistoryStore
+from leptoid.rollbacks import RollbackTracker, ROLLBACK_LIMITS
+from leptoid.capacity import CapacityPlanner
+from leptoid.sharding import ShardCoordinator, target_pair
 from leptoid.deploy_api import find_instance_ids
+from leptoid.metrics import METRICS, timed
 
 LOG = logging.getLogger('scaler')
 
+# Config sections only read when the scaler starts.
+RESTART_SECTIONS = ('graphite_shards', 'deploy_executor', 'model_config',
+		'forecast_pool', 'change_detection', 'plot_config', 'metrics_config',
+		'incremental_config', 'capacity_config', 'sharding_config')
+
 class LeptoidScaler(object):
 	"""
 	LeptoidScaler aggregates
@@ -28,43 +39,226 @@ class LeptoidScaler(object):
 		"""
 		Reads configs from local YAML file. Posibility of consolidating these.
 		"""
-		# Scaling limits.
-		config = utils.fetch_yaml(scaling_config)
-		self.api_params = config['render_config']
-		self.upscale_limits = config['upscale_limits']
-		self.downscale_limits = config['downscale_limits']
-		self.upscale_time_horizon = config['upscale_time_horizon']
-		self.downscale_time_horizon = config['downscale_time_horizon']
+		# Scaling limits. Thresholds are re-read by refresh_config().
+		self.settings = configuration.load(scaling_config)
+		config = self.settings.snapshot()
+		self.config_version = self.settings.version
+		self._apply_config(config)
+		self.fetcher = graphite.ShardedFetcher.from_config(
+				config.get('graphite_shards'))
 
-		# Target namespaces
+		# Target namespaces. With sharding, self.targets only keeps the
+		# targets of (environment, service) pairs this worker leases.
+		self.all_targets = metric_targets
 		self.targets = metric_targets 
 		LOG.debug("Targets:")
 		LOG.debug(self.targets)
+		self.coordinator = ShardCoordinator.from_config(
+				config.get('sharding_config'))
+
+		# Recent upscales, by instance id, until their rollback window ends.
+		self.rollback_limit = dict(ROLLBACK_LIMITS)
+		self.tracker = RollbackTracker(self.rollback_limit)
+
+		# KBS commands run in the background when the executor is enabled;
+		# their callbacks update the tracker from worker threads.
+		self.executor = deploy.DeployExecutor.from_config(
+				config.get('deploy_executor'))
 
-		self.recent_deploys = dict()
-		self.rollback_limit = {'production': 3600, 'staging': 600}
+		# With a capacity planner, instances move straight to the size their
+		# forecast needs instead of one step at a time.
+		self.planner = CapacityPlanner.from_config(
+				config.get('capacity_config'))
 
 		# Configs for forecasting
 		self.model_config = config['model_config']
+		self.pool_config = config.get('forecast_pool', {})
+		self.detection_config = config.get('change_detection', {})
+		self.plot_config = config.get('plot_config', {})
+		self.metrics_config = config.get('metrics_config', {})
 
+		# Pass scheduling. Behind schedule, hosts whose utilization is between
+		# the downscale limit and defer_ratio * upscale limit are deferred.
+		self.scheduler_config = config.get('pass_scheduler', {})
+		self.deferred = set()
+
+		# Rolling per-series buffers, used to fetch Graphite data incrementally.
+		self.history = None
+		incremental = config.get('incremental_config')
+		if incremental and incremental['enabled']:
+			self.history = dict([(metric, graphite.GraphiteHistory(
+				incremental['history_minutes'], incremental['update_minutes'],
+				HistoryStore.from_config(incremental, metric)))
+				for metric in ('arrival_rates', 'service_times')])
+
+	@property
+	def recent_deploys(self):
+		""" leptoid.rollbacks.RollbackTracker of recent upscales. """
+		return self.tracker
+
+	@recent_deploys.setter
+	def recent_deploys(self, deployments):
+		""" Replaces the tracked upscales with a dict of instance ids to
+		leptoid.utils.RollbackDetails.
+		"""
+		self.tracker = RollbackTracker(self.rollback_limit)
+		self.tracker.update(deployments)
+
+	def _apply_config(self, config):
+		""" Takes the settings that can change between passes from config. """
+		self.api_params = config['render_config']
+		self.upscale_limits = config['upscale_limits']
+		self.downscale_limits = config['downscale_limits']
+		self.upscale_time_horizon = config['upscale_time_horizon']
+		self.downscale_time_horizon = config['downscale_time_horizon']
+		self.defer_ratio = config.get('pass_scheduler', {}).get(
+				'defer_ratio', 0.8)
+
+	def refresh_config(self):
+		"""
+		Takes a fresh snapshot of the scaling config at the start of a pass.
+		If the file changed, scaling limits, time horizons, render options,
+		the defer ratio and noop mode take effect immediately; changes to
+		other sections (pools, executors, stores) need a restart.
+
+		Returns True if the config was reloaded.
+		"""
+		previous = self.settings.config
+		config = self.settings.snapshot()
+		if self.settings.version == self.config_version:
+			return False
+		self.config_version = self.settings.version
+		self._apply_config(config)
+		restart = [section for section in RESTART_SECTIONS
+				if previous.get(section) != config.get(section)]
+		if restart:
+			LOG.warning("Changes to %s take effect after a restart." %
+					', '.join(restart))
+		return True
+
+	def refresh_shards(self):
+		"""
+		Renews this worker's leases at the start of a pass, and narrows
+		self.targets to the (environment, service) pairs it owns. Does nothing
+		unless sharding is enabled.
+
+		Returns the set of pairs owned, or None without sharding.
+		"""
+		if self.coordinator is None:
+			return None
+		pairs = dict((target, target_pair(target))
+				for targets in self.all_targets.itervalues()
+				for target in targets)
+		owned = self.coordinator.refresh(pairs.values())
+		self.targets = dict((metric, [target for target in targets
+			if pairs[target] in owned])
+			for metric, targets in self.all_targets.iteritems())
+		METRICS.gauge('scaler.owned_pairs', len(owned))
+		return owned
+
+	@timed('scaler.query')
 	def query_graphite_targets(self):
 		"""
 		Queries arrival rate and service time data for all targets stored
 		in self.targets (attached to LeptoidScaler) and extracts data from
 		Graphite's response. 
 
-		Returns: list of leptoid.ServiceQueues with utilization populated.
+		Returns: leptoid.FleetQueues with utilization populated; iterating it
+		yields a ServiceQueue-like view per host.
 		"""
 
 		# Retrieve arrival rates and service times from Graphite.
-		raw_rates = graphite.call_graphite(self.targets['arrival_rates'],
-				self.api_params)
-		raw_times = graphite.call_graphite(self.targets['service_times'],
-				self.api_params)
-		arrival_rates = graphite.extract_time_series(raw_rates)
-		service_times = graphite.extract_time_series(raw_times)
+		if self.history:
+			arrival_rates = self._query_incremental('arrival_rates')
+			service_times = self._query_incremental('service_times')
+		else:
+			raw_rates = self._call_graphite(self.targets['arrival_rates'],
+					self.api_params)
+			raw_times = self._call_graphite(self.targets['service_times'],
+					self.api_params)
+			arrival_rates = graphite.extract_fleet_matrix(raw_rates)
+			service_times = graphite.extract_fleet_matrix(raw_times)
+
+		return generate_fleet_queues(arrival_rates, service_times)
+
+	def _query_incremental(self, metric):
+		"""
+		Requests only the data missing from the rolling buffers for ${metric},
+		merges it in, and returns the buffered series. Targets of pairs with
+		nothing buffered yet (e.g. pairs this worker just took over) are
+		requested with the full window instead.
+		"""
+		history = self.history[metric]
+		params = history.render_params(self.api_params)
+		targets, backfill = self.targets[metric], []
+		if params != self.api_params:
+			buffered = history.pairs()
+			backfill = [target for target in targets
+					if target_pair(target) not in buffered]
+			targets = [target for target in targets if target not in backfill]
+
+		raw_data, complete = [], True
+		for subset, subset_params in ((targets, params),
+				(backfill, self.api_params)):
+			if not subset:
+				continue
+			raw_data.extend(self._call_graphite(subset, subset_params,
+				self.api_params))
+			complete = complete and (self.fetcher is None or
+					not self.fetcher.failed)
+		# Keep buffers for series whose shard failed this pass.
+		history.update(raw_data, evict=complete)
+		return history.extract_fleet_matrix()
+
+	def _call_graphite(self, targets, api_params, backfill_params=None):
+		""" Fetches targets in concurrent shards if sharded fetching is
+		enabled, and in a single /render call otherwise. Shards that failed
+		on the previous call are fetched with ${backfill_params}, if given.
+		"""
+		if not targets:
+			# A worker may own no pairs for a metric.
+			return []
+		if self.fetcher is not None:
+			return self.fetcher.fetch(targets, api_params, backfill_params)
+		return graphite.call_graphite(targets, api_params)
+
+	def defer_low_priority(self, queues, behind=True):
+		"""
+		Drops low-priority hosts from queues so a pass running behind schedule
+		only forecasts hosts likely to need scaling: hosts whose latest
+		utilization is above their downscale limit and below defer_ratio times
+		their upscale limit. Hosts deferred on the previous pass are kept.
+
+		Parameters
+		----------
+		queues
+			leptoid.FleetQueues, modified in place
+		behind
+			bool, whether the pass is behind schedule; if not, nothing is
+			deferred
+
+		Returns the number of hosts deferred.
+		"""
+		if not behind or not len(queues) or not len(queues.index):
+			self.deferred = set()
+			return 0
+
+		recent = queues.utilization[:, -1]
+		upper = np.array([self.upscale_limits.get(service, np.inf)
+			for service in queues.service]) * self.defer_ratio
+		lower = np.array([self.downscale_limits.get(service, -np.inf)
+			for service in queues.service])
+		deferred_before = np.array([iid in self.deferred
+			for iid in queues.instance_id], dtype=bool)
+		defer = (recent > lower) & (recent < upper) & ~deferred_before
 
-		return generate_service_queues(arrival_rates, service_times)
+		self.deferred = set(queues.instance_id[defer])
+		METRICS.gauge('scaler.deferred', int(defer.sum()))
+		if defer.any():
+			LOG.info("Behind schedule; deferring %i of %i hosts." %
+					(defer.sum(), len(queues)))
+			queues.select(~defer)
+		return int(defer.sum())
 
 	def evaluate_instance(self, queue, estimated_util):
 		"""
@@ -91,23 +285,32 @@ class LeptoidScaler(object):
 		# Track the deployment id of any scaling events.
 		# TODO: automate build id selection proces
 		if max_upscale_value > upscale_limit:
-			self.upscale_instance(queue)
+			METRICS.incr('scaler.upscales')
+			self.upscale_instance(queue,
+					estimated_util[:self.upscale_time_horizon])
 		elif max_downscale_value < downscale_limit:
-			self.downscale_instance(queue)
+			METRICS.incr('scaler.downscales')
+			self.downscale_instance(queue,
+					estimated_util[:self.downscale_time_horizon])
 		else:
+			METRICS.incr('scaler.no_action')
 			LOG.info("No action taken for %s:%s" %
 					(queue.service, queue.instance_id))
 
-	def upscale_instance(self, queue):
+	def upscale_instance(self, queue, estimated_util=None):
 		""" Increases the size of the instance associated with queue. Steps:
 		(1)		log
 		(2)		check whether instance was recently deployed
-		(3)		if so, deploy.rollback; if not, call deploy.upscale
+		(3)		if so, deploy.rollback; if not, resize to the planner's target
+				or call deploy.upscale
 
 		Parameters
 		----------
 		queue
 			leptoid.ServiceQueue object with instance information.
+		estimated_util
+			forecasted utilization over the upscale horizon, used to size
+			the instance if a capacity planner is configured
 		"""
 
 		upscale_limit = self.upscale_limits[queue.service]
@@ -118,53 +321,124 @@ class LeptoidScaler(object):
 		# downscaled and ran into utilization problems.
 		rollback_details = self._find_rollback_candidates(queue)
 		if rollback_details:
-			deploy.rollback(queue, rollback_details.build_id)
+			METRICS.incr('scaler.rollbacks')
+			self._deploy(queue, deploy.rollback,
+					(queue, rollback_details.build_id))
+		elif self._planned(queue, estimated_util):
+			target = self.planner.upscale_target(queue, estimated_util,
+					upscale_limit)
+			if target is None:
+				LOG.info("No larger instance type for %s:%s" %
+						(queue.service, queue.instance_id))
+				return
+			self._deploy(queue, deploy.resize, (queue, target),
+					self._record_upscale)
 		else:
-			deploy_id = deploy.upscale(queue)
-			instances = find_instance_ids(deploy_id)
-			self.recent_deploys[instances] = utils.RollbackDetails(
-					time=datetime.datetime.now(), build_id=deploy_id)
+			self._deploy(queue, deploy.upscale, (queue,),
+					self._record_upscale)
+
+	def _planned(self, queue, estimated_util):
+		""" Whether queue's new size comes from the capacity planner. """
+		return self.planner is not None and estimated_util is not None and \
+				queue.instance_size in self.planner.capacities
+
+	def _record_upscale(self, job):
+		""" Completion callback for upscales: remembers the deployment so it
+		can be rolled back.
+		"""
+		if job.error is not None:
+			return
+		queue = job.args[0]
+		utils.INSTANCE_SIZES.invalidate(queue.environment, queue.instance_id)
+		instances = find_instance_ids(job.deploy_id)
+		if not instances:
+			# Noop and failed deploys have no build to roll back to.
+			LOG.info("No instances found for deployment %s of %s." %
+					(job.deploy_id, queue.instance_id))
+			return
+		self.tracker.record(instances, utils.RollbackDetails(
+			time=datetime.datetime.now(), build_id=job.deploy_id),
+			queue.environment)
 	
-	def downscale_instance(self, queue):
+	def downscale_instance(self, queue, estimated_util=None):
 		""" Decreases the size of the instance associated with queue.
 
 		Parameters
 		----------
 		queue
 			leptoid.ServiceQueue object with instance information.
+		estimated_util
+			forecasted utilization over the downscale horizon, used to size
+			the instance if a capacity planner is configured
 		"""
 
 		downscale_limit = self.downscale_limits[queue.service]
 		LOG.info("Utilization for %s:%s never exceeds %0.2f" %
 				(queue.service, queue.instance_id, downscale_limit))
-		_ = deploy.downscale(queue)
-
-	def _find_rollback_candidates(self, queue):
-		""" Traverse recent deployments and find instances that can be rolled
-		back.
-
-		Returns the rollback details of any instance candidate if a match is
-		found; otherwise returns None.
-		"""
-		matching_ids = self._find_matching_ids(queue)
-
-		# If we find matching ids, check that deployment's time. Otherwise
-		# return an empty list.
-		if matching_ids:
-			ids = matching_ids[0]
-			details = self.recent_deploys[ids]
-			horizon = datetime.timedelta(
-					seconds=self.rollback_limit[queue.environment])
-			if details.time + horizon < datetime.datetime.now(): 
-				details = None			# return null if the horizon has passed
-				del self.recent_deploys[ids]	# delete expired rollbacks
+		if self._planned(queue, estimated_util):
+			target = self.planner.downscale_target(queue, estimated_util,
+					self.upscale_limits[queue.service])
+			if target is None:
+				LOG.info("No smaller instance type for %s:%s" %
+						(queue.service, queue.instance_id))
+				return
+			self._deploy(queue, deploy.resize, (queue, target),
+					self._record_downscale)
 		else:
-			details = matching_ids
+			self._deploy(queue, deploy.downscale, (queue,),
+					self._record_downscale)
+
+	def _record_downscale(self, job):
+		""" Completion callback for downscales. """
+		queue = job.args[0]
+		utils.INSTANCE_SIZES.invalidate(queue.environment, queue.instance_id)
 
-		return details
+	def _deploy(self, queue, function, args, callback=None):
+		"""
+		Runs a leptoid.deploy function for queue's instance: in the background
+		if the deploy executor is enabled, and in the calling thread otherwise.
+
+		With sharding, only instances of pairs this worker leases are deployed,
+		and the lease is checked again when the command runs. The pair keeps
+		its lease until the deploy's callback has run.
+
+		Returns the leptoid.deploy.DeployJob, or None if the instance belongs
+		to another worker.
+		"""
+		if self.coordinator is not None:
+			pair = (queue.environment, queue.service)
+			if not self.coordinator.owns(pair):
+				METRICS.incr('scaler.unowned')
+				LOG.warning("Not deploying %s:%s; %s:%s isn't leased by %s." %
+						(queue.service, queue.instance_id, queue.environment,
+							queue.service, self.coordinator.worker_id))
+				return None
+			function, callback = self.coordinator.guard(pair, function,
+					callback)
 
-	def _find_matching_ids(self, queue):
-		""" Identifies all instances launched as part of a deployment id. """
-		return [tuple(id_list)
-				for id_list in self.recent_deploys.keys() for iid in id_list 
-				if iid == queue.instance_id]
+		if self.executor is not None:
+			return self.executor.submit(queue.instance_id, function, args,
+					callback)
+
+		job = deploy.DeployJob(queue.instance_id, function, args, None)
+		if callback is not None:
+			job.callbacks.append(callback)
+		job.run()
+		job.finished.set()
+		return job
+
+	def wait_for_deploys(self, timeout=None):
+		""" Blocks until background deployments finish, or for at most
+		${timeout} seconds. Returns True if none are left in flight.
+		"""
+		if self.executor is None:
+			return True
+		return self.executor.wait(timeout)
+
+	def _find_rollback_candidates(self, queue):
+		""" Looks up the recent deployment that launched queue's instance.
+
+		Returns the rollback details if that deployment is still within its
+		environment's rollback window; otherwise returns None.
+		"""
+		return self.tracker.find(queue.instance_id, queue.environment)
@@ -0,0 +1,169 @@
+"""
+Runs scaling passes on fixed wall-clock boundaries (e.g. the top of every
+minute) instead of sleeping a fixed time between passes, so the cadence doesn't
+drift as passes get slower.
+
+Each pass is measured against its deadline. A pass that starts too long after
+its boundary skips it and waits for the next one rather than piling up, and
+passes that follow an overrun can shed low-priority work (see
+leptoid.scaler.LeptoidScaler.defer_low_priority).
+"""
+
+from math import ceil
+from time import time, sleep
+from collections import deque
+
+import logging
+LOG = logging.getLogger('scheduler')
+
+# Defaults: seconds between pass boundaries, seconds after its boundary by
+# which a pass should be done, and how late a pass may start before its
+# boundary is skipped (as a fraction of the interval).
+PASS_INTERVAL = 60
+MAX_LAG_FRACTION = 0.25
+
+# Number of recent passes kept for lag and duration statistics.
+STATS_HISTORY = 60
+
+class ScheduledPass(object):
+	""" Timing of a single pass relative to its boundary and deadline. """
+
+	def __init__(self, number, boundary, started, deadline, behind, clock):
+		"""
+		Parameters
+		----------
+		number
+			int, pass number
+		boundary
+			float, wall-clock time the pass was scheduled for
+		started
+			float, wall-clock time the pass actually started
+		deadline
+			float, wall-clock time by which the pass should be done
+		behind
+			bool, whether the previous pass overran its deadline
+		clock
+			callable returning the current time
+		"""
+		self.number = number
+		self.boundary = boundary
+		self.started = started
+		self.deadline = deadline
+		self.behind = behind
+		self.clock = clock
+
+	@property
+	def lag(self):
+		""" Seconds between the pass's boundary and its start. """
+		return self.started - self.boundary
+
+	def elapsed(self):
+		""" Seconds since the pass started. """
+		return self.clock() - self.started
+
+	def remaining(self):
+		""" Seconds left before the deadline (negative once overrun). """
+		return self.deadline - self.clock()
+
+	def overrun(self):
+		""" Whether the pass is past its deadline. """
+		return self.remaining() < 0
+
+class PassScheduler(object):
+	"""
+	Hands out passes aligned to multiples of ${interval} seconds and keeps
+	lag, duration and overrun statistics.
+	"""
+
+	def __init__(self, interval=PASS_INTERVAL, deadline=None, max_lag=None,
+			clock=time, sleeper=sleep):
+		"""
+		Parameters
+		----------
+		interval
+			int, seconds between pass boundaries
+		deadline
+			int, seconds after its boundary by which a pass should be done
+			(defaults to the interval)
+		max_lag
+			int, seconds a pass may start after its boundary; later passes
+			skip to the next boundary
+		clock, sleeper
+			callables used to read the time and to wait
+		"""
+		self.interval = interval
+		self.deadline = deadline or interval
+		self.max_lag = max_lag if max_lag is not None else \
+				interval * MAX_LAG_FRACTION
+		self.clock = clock
+		self.sleeper = sleeper
+		self.next_boundary = None
+		self.passes = 0
+		self.skipped = 0
+		self.overruns = 0
+		self.overran = False
+		self.lags = deque(maxlen=STATS_HISTORY)
+		self.durations = deque(maxlen=STATS_HISTORY)
+
+	@classmethod
+	def from_config(cls, scheduler_config):
+		""" Builds a scheduler from scheduler_config (which may be empty). """
+		scheduler_config = scheduler_config or {}
+		return cls(scheduler_config.get('interval', PASS_INTERVAL),
+				scheduler_config.get('deadline'),
+				scheduler_config.get('max_lag'))
+
+	def _align(self, now):
+		""" Returns the first boundary at or after now. """
+		return ceil(now / float(self.interval)) * self.interval
+
+	def next_pass(self):
+		"""
+		Waits for the next boundary and starts a pass. Boundaries that were
+		missed by more than ${max_lag} seconds are skipped.
+
+		Returns a ScheduledPass.
+		"""
+		now = self.clock()
+		boundary = self.next_boundary
+		if boundary is None:
+			boundary = self._align(now)
+		elif now - boundary > self.max_lag:
+			missed = boundary
+			boundary = self._align(now)
+			skipped = int(round((boundary - missed) / self.interval))
+			self.skipped += skipped
+			LOG.warning("Running %is behind schedule; skipping %i passes." %
+					(now - missed, skipped))
+
+		if boundary > now:
+			self.sleeper(boundary - now)
+			now = self.clock()
+		self.next_boundary = boundary + self.interval
+
+		self.passes += 1
+		current = ScheduledPass(self.passes, boundary, now,
+				boundary + self.deadline, self.overran, self.clock)
+		self.lags.append(current.lag)
+		return current
+
+	def finish(self, current):
+		""" Records a pass's duration and whether it overran its deadline. """
+		self.durations.append(current.elapsed())
+		self.overran = current.overrun()
+		if self.overran:
+			self.overruns += 1
+			LOG.warning("Pass %i overran its deadline by %0.1fs." %
+					(current.number, -1 * current.remaining()))
+
+	def stats(self):
+		""" Returns a dict with pass counts and recent lag and duration
+		statistics, in seconds.
+		"""
+		lags = list(self.lags) or [0.]
+		durations = list(self.durations) or [0.]
+		return {'passes': self.passes, 'skipped': self.skipped,
+				'overruns': self.overruns, 'lag_last': lags[-1],
+				'lag_max': max(lags), 'lag_mean': sum(lags) / len(lags),
+				'duration_last': durations[-1],
+				'duration_max': max(durations)}
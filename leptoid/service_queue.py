@@ -2,14 +2,18 @@
 for modeling with queuing theory.
 """
 from __future__ import division
+import copy
 import numpy as np
 import pandas
+from time import ctime
 from boto.exception import EC2ResponseError
 
 import logging
 LOG = logging.getLogger('service_queue')
 
-from leptoid.utils import fetch_yaml, get_instance_size
+import leptoid.config as configuration
+from leptoid.utils import get_instance_size, INSTANCE_SIZES
+from leptoid.metrics import METRICS, timed
 
 class ServiceQueue(object):
 	"""
@@ -45,20 +49,13 @@ class ServiceQueue(object):
 		"""
 		Attaches utilization forecast, checks to make sure length is consistent.
 		"""
-		serieslen = fetch_yaml('leptoid/model_config.yml')['horizon']
-
-		if serieslen != len(util_forecast):
-			raise Exception(
-					"Utilization forecast does not have correct length.")
-		else:
-			self.util_forecast = util_forecast
+		_check_forecast_length(util_forecast)
+		self.util_forecast = util_forecast
 
 	def add_instance_size(self):
 		""" Attach instance size to ServiceQueue object. Will raise a
 		boto.EC2ConnectionError if the instance does not exist.
 		"""
-		LOG.info("\tRetrieving size for %s in %s" %
-				(self.instance_id, self.environment))
 		self.instance_size = get_instance_size(
 				self.environment, self.instance_id)
 
@@ -66,6 +63,198 @@ class ServiceQueue(object):
 		""" Returns timestamp for the first utilization value. """
 		return self.utilization.index[0]
 
+def _check_forecast_length(util_forecast):
+	""" Raises an Exception if a forecast doesn't match the model horizon. """
+	serieslen = configuration.CONFIG.current()['model_config']['horizon']
+
+	if serieslen != len(util_forecast):
+		raise Exception(
+				"Utilization forecast does not have correct length.")
+
+class QueueView(object):
+	"""
+	Lightweight view of one host in a FleetQueues. Exposes the same attributes
+	as ServiceQueue, reading them from the fleet's shared arrays.
+	"""
+	__slots__ = ('fleet', 'row', 'util_forecast')
+
+	def __init__(self, fleet, row):
+		self.fleet = fleet
+		self.row = row
+
+	@property
+	def environment(self):
+		return self.fleet.environment[self.row]
+
+	@property
+	def service(self):
+		return self.fleet.service[self.row]
+
+	@property
+	def instance_id(self):
+		return self.fleet.instance_id[self.row]
+
+	@property
+	def legacy(self):
+		return self.fleet.legacy[self.row]
+
+	@property
+	def instance_size(self):
+		return self.fleet.instance_size[self.row]
+
+	def _series(self, metric):
+		""" pandas.TimeSeries over one row of a fleet metric, without
+		copying the data.
+		"""
+		return pandas.TimeSeries(data=metric[self.row], index=self.fleet.index,
+				copy=False)
+
+	@property
+	def service_time(self):
+		return self._series(self.fleet.service_time)
+
+	@property
+	def arrival_rate(self):
+		return self._series(self.fleet.arrival_rate)
+
+	@property
+	def utilization(self):
+		return self._series(self.fleet.utilization)
+
+	@property
+	def residency_time(self):
+		return self._series(self.fleet.residency_time)
+
+	def add_util_forecast(self, util_forecast):
+		"""
+		Attaches utilization forecast, checks to make sure length is consistent.
+		"""
+		_check_forecast_length(util_forecast)
+		self.util_forecast = util_forecast
+
+	def get_first_timestamp(self):
+		""" Returns timestamp for the first utilization value. """
+		return self.fleet.index[0]
+
+class FleetQueues(object):
+	"""
+	Columnar store of queuing statistics for every host in the fleet. Metrics
+	are kept as contiguous hosts x time float arrays, and host metadata as
+	compact arrays; iterating yields QueueViews with the ServiceQueue
+	interface.
+	"""
+
+	def __init__(self, arrival_rates, service_times):
+		"""
+		Parameters
+		----------
+		arrival_rates
+			leptoid.graphite.FleetMatrix with arrival rates
+		service_times
+			leptoid.graphite.FleetMatrix with service times; only hosts
+			present in both matrices are kept
+		"""
+		if arrival_rates.step != service_times.step and len(arrival_rates) \
+				and len(service_times):
+			raise Exception("Data must have the same step.")
+
+		# Align both metrics on the time window they share.
+		step = arrival_rates.step
+		start = max(arrival_rates.start, service_times.start)
+		end = min(matrix.start + matrix.values.shape[1] * step
+				for matrix in (arrival_rates, service_times))
+		ncols = max(0, (end - start) // step)
+		keys = [key for key in arrival_rates.keys if key in service_times.rows]
+
+		def columns(matrix):
+			offset = (start - matrix.start) // step
+			rows = [matrix.rows[key] for key in keys]
+			return np.ascontiguousarray(
+					matrix.values[rows, offset:offset + ncols], dtype=float)
+
+		# Basic metrics.
+		self.arrival_rate = columns(arrival_rates)
+		self.service_time = columns(service_times)
+		self._compute_metrics()
+		self.index = pandas.PeriodIndex(
+				start=ctime(start), periods=ncols)
+
+		# Box information
+		self.environment = np.array([key[0] for key in keys], dtype=str)
+		self.service = np.array([key[1] for key in keys], dtype=str)
+		self.instance_id = np.array([key[2] for key in keys], dtype=str)
+		self.legacy = np.array([service[:4] != "kbs." for service in
+			self.service], dtype=bool)
+		self.instance_size = np.empty(len(keys), dtype=object)
+
+	def _compute_metrics(self):
+		""" Utilization and residency time for the whole fleet at once. """
+		self.utilization = np.multiply(self.service_time, self.arrival_rate)
+		self.residency_time = self.service_time / (
+				1 - self.utilization * self.service_time)
+
+	def __len__(self):
+		return len(self.instance_id)
+
+	def __getitem__(self, row):
+		return QueueView(self, row)
+
+	def __iter__(self):
+		for row in xrange(len(self)):
+			yield QueueView(self, row)
+
+	def select(self, mask):
+		""" Keeps only the hosts where mask is True. """
+		for name in ('arrival_rate', 'service_time', 'utilization',
+				'residency_time', 'environment', 'service', 'instance_id',
+				'legacy', 'instance_size'):
+			setattr(self, name, getattr(self, name)[mask])
+
+	def subset(self, mask):
+		""" Returns a FleetQueues with only the hosts where mask is True,
+		leaving this one intact.
+		"""
+		fleet = copy.copy(self)
+		fleet.select(mask)
+		return fleet
+
+	@timed('service_queue.instance_sizes')
+	def add_instance_sizes(self):
+		""" Attach instance sizes to every host, dropping hosts that no longer
+		exist in EC2.
+		"""
+		for env in set(self.environment):
+			try:
+				INSTANCE_SIZES.refresh(env)
+			except EC2ResponseError, e:
+				LOG.error("Could not retrieve instance sizes for %s." % env)
+				LOG.error(e)
+
+		exists = np.ones(len(self), dtype=bool)
+		for row in xrange(len(self)):
+			try:
+				self.instance_size[row] = get_instance_size(
+						self.environment[row], self.instance_id[row])
+			except EC2ResponseError, e:
+				LOG.error("\tInstance %s does not exist! Continuing..." %
+						self.instance_id[row])
+				LOG.error(e)
+				exists[row] = False
+		if not exists.all():
+			self.select(exists)
+
+def generate_fleet_queues(arrival_rates, service_times):
+	""" Builds a FleetQueues with instance sizes from the FleetMatrix objects
+	produced by leptoid.graphite.extract_fleet_matrix.
+
+	Returns a leptoid.FleetQueues; iterating it yields a QueueView per host.
+	"""
+	with METRICS.timer('service_queue.build'):
+		fleet = FleetQueues(arrival_rates, service_times)
+	fleet.add_instance_sizes()
+	METRICS.gauge('service_queue.hosts', len(fleet))
+	return fleet
+
 def generate_service_queues(arrival_rates, service_times):
 	""" Method for converting nested dictionaries with Graphite time series
 	into leptoid.ServiceQueues with host information (environment, utilization,
@@ -85,6 +274,13 @@ def generate_service_queues(arrival_rates, service_times):
 
 	# Extract service time and arrival rate for each service instance.
 	for env in arrival_rates.keys():
+		# Fetch every instance size in this environment with one call;
+		# single lookups remain as a fallback.
+		try:
+			INSTANCE_SIZES.refresh(env)
+		except EC2ResponseError, e:
+			LOG.error("Could not retrieve instance sizes for %s." % env)
+			LOG.error(e)
 		for service in arrival_rates[env].keys():
 			for instance in arrival_rates[env][service].keys():
 				try:
@@ -0,0 +1,356 @@
+"""
+Horizontal sharding of the scaler. Several leptoid workers, on one machine or
+on several, split the (environment, service) pairs between them:
+
+(1)		every worker heartbeats into a shared LeaseStore, which tells the
+		workers who is alive;
+(2)		a consistent-hash ring over the live workers assigns each pair to one
+		worker, so a worker joining or leaving only moves its share of pairs;
+(3)		a worker only queries, forecasts and scales the pairs it holds an
+		unexpired lease on. Leases are renewed every pass and released when
+		the ring hands a pair to another worker, which can only acquire it
+		once it is released or has expired.
+
+A worker that stops stops renewing; its heartbeat and leases expire after
+${lease_ttl} seconds and the remaining workers take its pairs over. Deploys
+are checked against the lease right before they run, and a pair with deploys
+queued or running keeps its lease (renewed while KBS runs) until they finish,
+so no instance is scaled by two workers at once.
+
+The LeaseStore keeps leases in SQLite, which serves local runs and workers
+sharing a filesystem; any store with the same methods can replace it.
+"""
+
+import os
+import socket
+import sqlite3
+import threading
+from bisect import bisect
+from hashlib import md5
+from time import time
+
+import logging
+LOG = logging.getLogger('sharding')
+
+from leptoid.graphite import TARGET_PATTERN
+from leptoid.namespaces import GRAPHITE_TO_KBS_MAP
+
+# Defaults: seconds a lease or heartbeat lasts, and points per worker on the
+# hash ring.
+LEASE_TTL = 180
+RING_REPLICAS = 64
+
+def target_pair(target):
+	""" Returns the (environment, service) pair a Graphite target belongs to,
+	named as on leptoid.ServiceQueues, or the target itself if it doesn't
+	name one.
+	"""
+	match = TARGET_PATTERN.search(target)
+	if match is None:
+		return target
+	env, service = match.groups()
+	return (env.lower(), GRAPHITE_TO_KBS_MAP.get(service, service))
+
+def _shard_name(pair):
+	""" String naming a pair in the lease store and on the ring. """
+	if isinstance(pair, tuple):
+		return ':'.join(pair)
+	return pair
+
+class HashRing(object):
+	""" Consistent-hash ring mapping shard names to workers. """
+
+	def __init__(self, workers, replicas=RING_REPLICAS):
+		"""
+		Parameters
+		----------
+		workers
+			list of strs, worker ids
+		replicas
+			int, points per worker on the ring
+		"""
+		self.points = sorted((self._hash('%s#%i' % (worker, replica)), worker)
+				for worker in workers for replica in xrange(replicas))
+		self.hashes = [point for point, _ in self.points]
+
+	@staticmethod
+	def _hash(name):
+		return int(md5(name).hexdigest()[:16], 16)
+
+	def owner(self, name):
+		""" Returns the worker owning name, or None for an empty ring. """
+		if not self.points:
+			return None
+		idx = bisect(self.hashes, self._hash(name)) % len(self.points)
+		return self.points[idx][1]
+
+class LeaseStore(object):
+	"""
+	Time-limited leases and worker heartbeats in a SQLite database. Every
+	change runs in its own immediate transaction, so several processes can
+	share one database file.
+	"""
+
+	def __init__(self, path, clock=time):
+		"""
+		Parameters
+		----------
+		path
+			str, SQLite database file (created if missing)
+		clock
+			callable returning the current time
+		"""
+		self.path = path
+		self.clock = clock
+		self.lock = threading.Lock()
+		directory = os.path.dirname(path)
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.connection = sqlite3.connect(path, timeout=30,
+				isolation_level=None, check_same_thread=False)
+		self.connection.execute("CREATE TABLE IF NOT EXISTS leases ("
+				"shard TEXT PRIMARY KEY, owner TEXT, expires REAL)")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS workers ("
+				"worker TEXT PRIMARY KEY, expires REAL)")
+
+	def _transaction(self, statements):
+		""" Runs (sql, args) statements in one immediate transaction.
+		Returns the number of rows changed by each.
+		"""
+		with self.lock:
+			cursor = self.connection.cursor()
+			cursor.execute("BEGIN IMMEDIATE")
+			try:
+				changed = []
+				for sql, args in statements:
+					cursor.execute(sql, args)
+					changed.append(cursor.rowcount)
+				cursor.execute("COMMIT")
+			except Exception:
+				cursor.execute("ROLLBACK")
+				raise
+			return changed
+
+	def heartbeat(self, worker, ttl):
+		""" Marks worker alive for ${ttl} seconds. """
+		self._transaction([("INSERT OR REPLACE INTO workers VALUES (?, ?)",
+			(worker, self.clock() + ttl))])
+
+	def live_workers(self):
+		""" Returns the ids of workers whose heartbeat hasn't expired. """
+		with self.lock:
+			rows = self.connection.execute("SELECT worker FROM workers "
+					"WHERE expires > ?", (self.clock(),)).fetchall()
+		return sorted(row[0] for row in rows)
+
+	def acquire(self, shard, worker, ttl):
+		"""
+		Takes or renews the lease on shard for ${ttl} seconds.
+
+		Returns the lease's expiry time, or None if another worker holds an
+		unexpired lease.
+		"""
+		now = self.clock()
+		expires = now + ttl
+		changed = self._transaction([
+			("INSERT OR IGNORE INTO leases VALUES (?, '', 0)", (shard,)),
+			("UPDATE leases SET owner = ?, expires = ? WHERE shard = ? AND "
+				"(owner = ? OR expires <= ?)",
+				(worker, expires, shard, worker, now))])
+		return expires if changed[1] else None
+
+	def release(self, shard, worker):
+		""" Gives up worker's lease on shard, if it holds one. """
+		self._transaction([("UPDATE leases SET owner = '', expires = 0 "
+			"WHERE shard = ? AND owner = ?", (shard, worker))])
+
+	def leave(self, worker):
+		""" Drops worker's heartbeat. """
+		self._transaction([("DELETE FROM workers WHERE worker = ?",
+			(worker,))])
+
+class ShardCoordinator(object):
+	"""
+	Decides which (environment, service) pairs this worker handles, and
+	keeps leases on them. A pair with deploys queued or running keeps its
+	lease, renewed while the command runs, until they finish, even if the
+	ring has moved it to another worker.
+	"""
+
+	def __init__(self, store, worker_id=None, lease_ttl=LEASE_TTL,
+			replicas=RING_REPLICAS, clock=time):
+		"""
+		Parameters
+		----------
+		store
+			LeaseStore shared by every worker
+		worker_id
+			str, unique id for this worker (defaults to host:pid)
+		lease_ttl
+			int, seconds a lease lasts; should cover a few passes
+		replicas
+			int, points per worker on the hash ring
+		clock
+			callable returning the current time
+		"""
+		self.store = store
+		self.worker_id = worker_id or '%s:%i' % (socket.gethostname(),
+				os.getpid())
+		self.lease_ttl = lease_ttl
+		self.replicas = replicas
+		self.clock = clock
+		# Seconds between lease renewals while a deploy runs.
+		self.renew_interval = lease_ttl / 3.
+		self.lock = threading.Lock()
+		self.leases = dict()		# pair -> lease expiry
+		self.assigned = set()		# pairs the ring gives this worker
+		self.busy = dict()			# pair -> deploys queued or running
+
+	@classmethod
+	def from_config(cls, sharding_config):
+		""" Builds a coordinator from sharding_config, or returns None if
+		sharding is disabled.
+		"""
+		if not sharding_config or not sharding_config.get('enabled'):
+			return None
+		return cls(LeaseStore(sharding_config['lease_store']),
+				sharding_config.get('worker_id'),
+				sharding_config.get('lease_ttl', LEASE_TTL),
+				sharding_config.get('replicas', RING_REPLICAS))
+
+	def refresh(self, pairs):
+		"""
+		Heartbeats, then takes or renews the leases on the pairs the ring
+		assigns to this worker and releases the others, except pairs with
+		deploys queued or running, whose leases are renewed until they
+		finish. Pairs still leased by another worker are skipped until that
+		lease is released or expires.
+
+		Parameters
+		----------
+		pairs
+			iterable of every (environment, service) pair
+
+		Returns the set of pairs assigned to this worker that it holds
+		leases on.
+		"""
+		self.store.heartbeat(self.worker_id, self.lease_ttl)
+		ring = HashRing(self.store.live_workers(), self.replicas)
+
+		with self.lock:
+			previous = dict(self.leases)
+			busy = set(self.busy)
+		assigned = set(pair for pair in set(pairs)
+				if ring.owner(_shard_name(pair)) == self.worker_id)
+		leases = dict()
+		for pair in assigned | (busy & set(previous)):
+			shard = _shard_name(pair)
+			expires = self.store.acquire(shard, self.worker_id,
+					self.lease_ttl)
+			if expires is None:
+				LOG.info("%s is still leased by another worker." % shard)
+				continue
+			leases[pair] = expires
+			if pair not in assigned:
+				LOG.info("Keeping %s until its deploys finish." % shard)
+		for pair in set(previous) - set(leases):
+			self.store.release(_shard_name(pair), self.worker_id)
+
+		owned = assigned & set(leases)
+		if owned != self.assigned & set(previous):
+			LOG.info("Worker %s now owns %i pairs." % (self.worker_id,
+				len(owned)))
+		with self.lock:
+			self.leases = leases
+			self.assigned = assigned
+		return owned
+
+	def _leased(self, pair):
+		""" Whether this worker holds an unexpired lease on pair. """
+		with self.lock:
+			return self.leases.get(pair, 0) > self.clock()
+
+	def owns(self, pair):
+		""" Whether new work on pair belongs to this worker: the ring assigns
+		it here and its lease is held.
+		"""
+		return pair in self.assigned and self._leased(pair)
+
+	def renew(self, pair):
+		""" Extends this worker's lease on pair. Returns True if it still
+		holds it.
+		"""
+		expires = self.store.acquire(_shard_name(pair), self.worker_id,
+				self.lease_ttl)
+		with self.lock:
+			if expires is None:
+				self.leases.pop(pair, None)
+				return False
+			self.leases[pair] = expires
+			return True
+
+	def _renew_until(self, pair, done):
+		""" Renews the lease on pair every ${renew_interval} seconds until
+		done is set.
+		"""
+		while not done.wait(self.renew_interval):
+			if not self.renew(pair):
+				LOG.error("Lost the lease on %s during a deploy." %
+						_shard_name(pair))
+				return
+
+	def guard(self, pair, function, callback=None):
+		"""
+		Holds pair for a leptoid.deploy function: the pair keeps its lease
+		from now until callback has run, and the function only starts if the
+		lease is still held (deploys can wait in a queue for a while). While
+		it runs, the lease is renewed in the background, so it outlasts KBS
+		timeouts longer than ${lease_ttl}.
+
+		Parameters
+		----------
+		pair
+			(environment, service) the deploy belongs to
+		function
+			callable, the deploy to run
+		callback
+			callable taking the finished leptoid.deploy.DeployJob, or None
+
+		Returns the wrapped function and callback. The callback must run
+		once the deploy finishes or is dropped, as DeployJob callbacks do.
+		"""
+		with self.lock:
+			self.busy[pair] = self.busy.get(pair, 0) + 1
+
+		def guarded(*args, **kwargs):
+			if not self._leased(pair):
+				raise Exception("Lease on %s lost before deploying." %
+						_shard_name(pair))
+			done = threading.Event()
+			renewer = threading.Thread(target=self._renew_until,
+					args=(pair, done), name='lease')
+			renewer.daemon = True
+			renewer.start()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				done.set()
+
+		def finished(job):
+			with self.lock:
+				self.busy[pair] -= 1
+				if not self.busy[pair]:
+					del self.busy[pair]
+			if callback is not None:
+				callback(job)
+
+		return guarded, finished
+
+	def release(self):
+		""" Gives up every lease and leaves the ring, e.g. on shutdown. """
+		with self.lock:
+			leases, self.leases = self.leases, dict()
+			self.assigned = set()
+		for pair in leases:
+			self.store.release(_shard_name(pair), self.worker_id)
+		self.store.leave(self.worker_id)
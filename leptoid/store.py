@@ -0,0 +1,188 @@
+"""
+On-disk history for leptoid.graphite.GraphiteHistory, so a restart doesn't
+have to backfill days of data for every host from Graphite.
+
+Each metric is stored as two memory-mapped .npy files, one row per series
+(raw values and moving averages, in ring-buffer order), plus a small JSON
+index mapping (env, service, instance) keys to rows and recording where each
+series ends. RollingSeries buffers are views onto the mapped rows, so merges
+write straight into the files, and reopening a store maps the files without
+copying them. After a restart, GraphiteHistory.render_params() only requests
+the gap since the last write.
+"""
+
+import os
+import json
+import numpy as np
+
+import logging
+LOG = logging.getLogger('store')
+
+from leptoid.graphite import RollingSeries, DEFAULT_STEP, SERIES_WINDOW_SIZE
+
+# Rows allocated when a store is created; files double in size when full.
+INITIAL_ROWS = 64
+
+class HistoryStore(object):
+	"""
+	Memory-mapped RollingSeries buffers for one metric.
+	"""
+
+	def __init__(self, directory, name, capacity, step=DEFAULT_STEP,
+			window=SERIES_WINDOW_SIZE):
+		"""
+		Parameters
+		----------
+		directory
+			str, directory holding the store's files (created if missing)
+		name
+			str, metric name used in file names (e.g. 'arrival_rates')
+		capacity
+			int, points retained per series
+		step
+			int, seconds between points
+		window
+			int, moving average window size
+
+		Files are opened on first use. Stores written with a different
+		capacity, step or window are discarded.
+		"""
+		self.capacity = capacity
+		self.step = step
+		self.window = window
+		self.directory = directory
+		self.paths = dict((part, os.path.join(directory, '%s.%s' % (name,
+			part))) for part in ('values.npy', 'averages.npy', 'index.json'))
+		self.rows = dict()			# key -> row
+		self.series = dict()		# key -> RollingSeries
+		self.free = []
+		self.values = None
+		self.averages = None
+
+	@classmethod
+	def from_config(cls, incremental_config, name):
+		""" Builds a store from incremental_config, or returns None if no
+		store_directory is configured.
+		"""
+		directory = (incremental_config or {}).get('store_directory')
+		if not directory:
+			return None
+		return cls(directory, name,
+				incremental_config['history_minutes'] * 60 // DEFAULT_STEP)
+
+	def _map(self, mode, rows=None, suffix=''):
+		""" Memory-maps the values and averages files. """
+		shape = None if rows is None else (rows, self.capacity)
+		return [np.lib.format.open_memmap(self.paths[part] + suffix,
+			mode=mode, dtype=float, shape=shape)
+			for part in ('values.npy', 'averages.npy')]
+
+	def _open(self):
+		""" Maps an existing store. Returns False if there is none, or if it
+		doesn't match this store's layout.
+		"""
+		if not all(os.path.exists(path) for path in self.paths.itervalues()):
+			return False
+		try:
+			with open(self.paths['index.json']) as infile:
+				index = json.load(infile)
+			values, averages = self._map('r+')
+		except (IOError, ValueError), e:
+			LOG.warning("Could not open history store: %s" % e)
+			return False
+		if (index['capacity'], index['step'], index['window']) != \
+				(self.capacity, self.step, self.window) or \
+				values.shape != averages.shape or \
+				values.shape[1] != self.capacity:
+			LOG.info("History store layout changed; starting over.")
+			return False
+
+		self.values, self.averages = values, averages
+		for key, row, end in index['series']:
+			key = tuple(key)
+			self.rows[key] = row
+			self.series[key] = RollingSeries(self.capacity, self.step,
+					self.window, values[row], averages[row], end)
+		used = set(self.rows.itervalues())
+		self.free = [row for row in xrange(len(values)) if row not in used]
+		LOG.info("Reopened history for %i series." % len(self.series))
+		return True
+
+	def _create(self, rows):
+		""" Starts an empty store with room for ${rows} series. """
+		self.values, self.averages = self._map('w+', rows)
+		self.rows, self.series = dict(), dict()
+		self.free = range(rows)
+		self.flush()
+
+	def _grow(self):
+		""" Doubles the number of rows, remapping every buffer. New files are
+		written alongside the old ones, then renamed over them.
+		"""
+		rows = len(self.values)
+		values, averages = self._map('w+', 2 * rows, '.tmp')
+		values[:rows] = self.values
+		averages[:rows] = self.averages
+		for part, mapped in (('values.npy', values),
+				('averages.npy', averages)):
+			mapped.flush()
+			os.rename(self.paths[part] + '.tmp', self.paths[part])
+
+		self.values, self.averages = values, averages
+		for key, row in self.rows.iteritems():
+			self.series[key].values = values[row]
+			self.series[key].averages = averages[row]
+		self.free += range(rows, 2 * rows)
+		LOG.info("Grew history store to %i rows." % (2 * rows))
+
+	def open(self):
+		""" Maps the store's files, creating them if needed. """
+		if self.values is not None:
+			return
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		if not self._open():
+			self._create(INITIAL_ROWS)
+
+	def load(self):
+		""" Returns a dict of the stored RollingSeries, keyed like
+		GraphiteHistory.buffers.
+		"""
+		self.open()
+		return dict(self.series)
+
+	def allocate(self, key):
+		""" Returns an empty RollingSeries for key, backed by a free row. """
+		self.open()
+		if key in self.series:
+			return self.series[key]
+		if not self.free:
+			self._grow()
+		row = self.free.pop(0)
+		series = RollingSeries(self.capacity, self.step, self.window,
+				self.values[row], self.averages[row])
+		series.clear()
+		self.rows[key] = row
+		self.series[key] = series
+		return series
+
+	def release(self, key):
+		""" Frees the row held by key. """
+		row = self.rows.pop(key, None)
+		if row is not None:
+			del self.series[key]
+			self.free.append(row)
+
+	def flush(self):
+		""" Writes mapped rows to disk and replaces the index. """
+		self.open()
+		self.values.flush()
+		self.averages.flush()
+		index = {'capacity': self.capacity, 'step': self.step,
+				'window': self.window,
+				'series': [(list(key), row, self.series[key].end)
+					for key, row in self.rows.iteritems()]}
+		temporary = self.paths['index.json'] + '.tmp'
+		with open(temporary, 'w') as outfile:
+			json.dump(index, outfile)
+		os.rename(temporary, self.paths['index.json'])
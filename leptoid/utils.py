@@ -1,9 +1,10 @@
 """ Various utility functions for Leptoid. """
 
 import yaml
+import threading
 import numpy as np
+from time import time
 from collections import namedtuple
-from boto.ec2.connection import EC2Connection
 
 import logging
 LOG = logging.getLogger('utils')
@@ -19,15 +20,131 @@ RollbackDetails = namedtuple('RollbackDetails', 'time build_id')
 # Tuple for storing service names, SVN and/or Jenkins ids.
 ServiceRevisionIds = namedtuple('ServiceRevisionIds', 'name date svn jenkins')
 
-# Hash with EC2 connections for production & staging.
-EC2CONN = {
-		'production': EC2Connection(
+# Serializes calls into the embedded R interpreter, which isn't thread-safe.
+R_LOCK = threading.RLock()
+
+# Seconds an instance's type is cached before it is looked up again.
+INSTANCE_SIZE_TTL = 3600
+
+class LazyClients(object):
+	"""
+	Dict-like collection of clients that are only created when first used.
+	Assigning a key replaces its client, e.g. with a stand-in for tests.
+	"""
+
+	def __init__(self, factories):
+		"""
+		Parameters
+		----------
+		factories
+			dict mapping keys to callables that create each client
+		"""
+		self.factories = factories
+		self.clients = dict()
+		self.lock = threading.Lock()
+
+	def __getitem__(self, key):
+		with self.lock:
+			if key not in self.clients:
+				LOG.debug("Creating client for %s" % key)
+				self.clients[key] = self.factories[key]()
+			return self.clients[key]
+
+	def __setitem__(self, key, client):
+		with self.lock:
+			self.clients[key] = client
+
+	def __contains__(self, key):
+		return key in self.factories or key in self.clients
+
+	def keys(self):
+		return list(set(self.factories) | set(self.clients))
+
+	def reset(self):
+		""" Drops every client (and override); they are recreated on use. """
+		with self.lock:
+			self.clients = dict()
+
+def _ec2_factory(access_key, secret_key):
+	""" Returns a callable opening an EC2Connection with the given keys. """
+	def connect():
+		from boto.ec2.connection import EC2Connection
+		return EC2Connection(access_key, secret_key)
+	return connect
+
+# Hash with EC2 connections for production & staging, opened on first use.
+EC2CONN = LazyClients({
+		'production': _ec2_factory(
 			AWS_ACCESS_KEY_ID_PROD, AWS_SECRET_ACCESS_KEY_PROD),
-		'staging': EC2Connection(
-			AWS_ACCESS_KEY_ID_STAG, AWS_SECRET_ACCESS_KEY_STAG)}
+		'staging': _ec2_factory(
+			AWS_ACCESS_KEY_ID_STAG, AWS_SECRET_ACCESS_KEY_STAG)})
+
+class RRuntime(object):
+	"""
+	Starts R through rpy2 the first time it is needed, and imports R packages
+	on demand. override() swaps in stand-ins, so tests never start R.
+	"""
+
+	def __init__(self, lock=R_LOCK):
+		"""
+		Parameters
+		----------
+		lock
+			threading.RLock serializing every call into R
+		"""
+		self.lock = lock
+		self._robjects = None
+		self.packages = dict()
+
+	@property
+	def robjects(self):
+		""" The rpy2.robjects module, with numpy conversion enabled. """
+		with self.lock:
+			if self._robjects is None:
+				LOG.info("Starting R.")
+				import rpy2.robjects
+				import rpy2.robjects.numpy2ri
+				rpy2.robjects.numpy2ri.activate()
+				self._robjects = rpy2.robjects
+			return self._robjects
+
+	def package(self, name):
+		""" Returns the R package ${name}, importing it on first use. """
+		with self.lock:
+			if name not in self.packages:
+				robjects = self.robjects
+				from rpy2.robjects.packages import importr
+				self.packages[name] = importr(name)
+			return self.packages[name]
+
+	def override(self, robjects=None, **packages):
+		""" Replaces rpy2.robjects and/or R packages, e.g. with Mocks. """
+		with self.lock:
+			if robjects is not None:
+				self._robjects = robjects
+			self.packages.update(packages)
+
+	def reset(self):
+		""" Forgets R and every package; they are loaded again on use. """
+		with self.lock:
+			self._robjects = None
+			self.packages = dict()
+
+	def after_fork(self):
+		"""
+		Gives a forked process its own lock and runtime. A thread of the
+		parent (plotter, deploy executor) may hold the lock at fork time, and
+		it is never released in the child.
+		"""
+		self.lock = threading.RLock()
+		self.reset()
+
+R = RRuntime()
 
 def fetch_yaml(filename):
-	""" Retrieve YAML contents. """
+	""" Retrieve YAML contents. Parses the file on every call; the scaling
+	config is cached by leptoid.config instead.
+	"""
 
 	with open(filename, 'r') as infile:
 		payload = yaml.load(infile)
@@ -109,8 +226,66 @@ def parse_namespace_contents(namespace):
 		raise Exception("Service or instance name not identified for %s" %
 				namespace)
 
+class InstanceSizeCache(object):
+	"""
+	Caches instance types for every environment. One bulk describe call per
+	environment fills the cache; ids it doesn't know about fall back to a
+	single get_instance_attribute call. Entries expire after ${ttl} seconds,
+	and are invalidated whenever leptoid resizes an instance.
+	"""
+
+	def __init__(self, connections, ttl=INSTANCE_SIZE_TTL):
+		"""
+		Parameters
+		----------
+		connections
+			dict mapping environment names to boto EC2Connections
+		ttl
+			int, seconds before a cached instance type expires
+		"""
+		self.connections = connections
+		self.ttl = ttl
+		self.sizes = dict()			# (env, instance_id) -> (size, time)
+		self.refreshed = dict()		# env -> time of the last bulk call
+
+	def refresh(self, env):
+		""" Fetches every instance type in env with a single describe call,
+		unless the last bulk call is still fresh.
+		"""
+		if time() - self.refreshed.get(env, 0) < self.ttl:
+			return
+
+		LOG.info("Retrieving instance sizes for %s" % env)
+		now = time()
+		for reservation in self.connections[env].get_all_instances():
+			for instance in reservation.instances:
+				self.sizes[(env, instance.id)] = (instance.instance_type, now)
+		self.refreshed[env] = now
+
+	def get(self, env, instance_id):
+		"""
+		Returns the type of instance_id. Raises boto.EC2ResponseError if the
+		instance does not exist in the environment.
+		"""
+		entry = self.sizes.get((env, instance_id))
+		if entry is not None and time() - entry[1] < self.ttl:
+			return entry[0]
+
+		LOG.info("\tRetrieving size for %s in %s" % (instance_id, env))
+		size = self.connections[env].get_instance_attribute(
+				instance_id, 'instanceType')['instanceType']
+		self.sizes[(env, instance_id)] = (size, time())
+		return size
+
+	def invalidate(self, env, instance_id):
+		""" Forgets the cached type of an instance. """
+		self.sizes.pop((env, instance_id), None)
+
+INSTANCE_SIZES = InstanceSizeCache(EC2CONN)
+
 def get_instance_size(env, instance_id):
 	""" Wrapper for Boto call to obtain instance information from $env.
+	Served from INSTANCE_SIZES whenever possible.
 
 	Parameters
 	----------
@@ -122,5 +297,4 @@ def get_instance_size(env, instance_id):
 	Returns size of the instance, if it exists. Raises boto.EC2ConnectionError
 	if instance does not exist in the environment.
 	"""
-	return EC2CONN[env].get_instance_attribute(
-				instance_id, 'instanceType')['instanceType']
+	return INSTANCE_SIZES.get(env, instance_id)
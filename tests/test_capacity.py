@@ -0,0 +1,49 @@
+""" Unit test for the capacity planner. """
+
+import numpy as np
+from unittest import TestCase
+from mock import Mock
+
+from leptoid.capacity import CapacityPlanner
+
+class TestCapacityPlanner(TestCase):
+
+	def setUp(self):
+		self.planner = CapacityPlanner(headroom=0.8, recent_points=2)
+
+	def queue(self, instance_size, utilization):
+		return Mock(service='kbs.KRS', instance_id='i-deadbeef',
+				instance_size=instance_size,
+				arrival_rate=np.array([10., 10., 10.]),
+				service_time=np.array([utilization / 10.] * 3))
+
+	def test_upscale_target(self):
+		""" A saturated instance moves past the next size in one step. """
+		queue = self.queue('m1.small', 0.5)
+		# 2.5 units of capacity needed at 0.7 utilization.
+		self.assertEqual(self.planner.upscale_target(queue,
+			np.array([1.2, 1.75]), 0.7), 'm1.large')
+		# Observed utilization counts as well as the forecast.
+		self.assertEqual(self.planner.upscale_target(self.queue('m1.small',
+			3.), np.array([0.8]), 0.7), 'm1.xlarge')
+		# Nothing is larger than the largest type of a family.
+		self.assertEqual(self.planner.upscale_target(self.queue('c1.xlarge',
+			0.5), np.array([0.9]), 0.7), None)
+
+	def test_downscale_target(self):
+		""" Downscales keep utilization under the headroom, and move one size
+		at a time unless multi-step downscaling is enabled.
+		"""
+		queue = self.queue('m1.xlarge', 0.05)
+		self.assertEqual(self.planner.downscale_target(queue,
+			np.array([0.05, 0.1]), 0.7), 'm1.large')
+		self.planner.multi_step_downscale = True
+		self.assertEqual(self.planner.downscale_target(queue,
+			np.array([0.05, 0.1]), 0.7), 'm1.medium')
+		self.assertEqual(self.planner.downscale_target(self.queue('m1.small',
+			0.05), np.array([0.1]), 0.7), None)
+
+	def test_unknown_type(self):
+		""" Unknown instance types aren't planned. """
+		self.assertEqual(self.planner.target(self.queue('t1.micro', 0.5),
+			np.array([0.9]), 0.7), None)
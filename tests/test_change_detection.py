@@ -0,0 +1,68 @@
+""" Unit test for change detection ahead of forecasting. """
+
+import numpy as np
+from unittest import TestCase
+from mock import Mock
+from pandas import TimeSeries, PeriodIndex
+from numpy.testing import assert_allclose
+
+from leptoid.change_detection import ChangeDetector
+
+KEY = ('staging', 'kbs.KRS', 'i-deadbeef')
+
+class TestChangeDetector(TestCase):
+
+	def setUp(self):
+		self.detector = ChangeDetector(interval=3.0, drift=0.5, threshold=4.0,
+				max_age=10)
+		self.values = 0.5 + 0.01 * np.sin(np.arange(100))
+
+	def queue(self, values, start=0):
+		index = PeriodIndex(start='2013-01-01 00:00', periods=len(values),
+				freq='T')[start:]
+		return Mock(utilization=TimeSeries(values[start:], index=index))
+
+	def fit(self, queue):
+		""" Forecast with a flat mean, and as flat a fit. """
+		nobs = len(queue.utilization)
+		forecast = (np.repeat(0.5, nobs), np.repeat(0.5, 5))
+		self.assertEqual(self.detector.check([queue], [KEY]), [None])
+		self.assertEqual(self.detector.reasons[KEY], 'new')
+		self.detector.update([queue], [KEY], [forecast])
+
+	def test_reuse(self):
+		""" Points matching the forecast shift it forward instead. """
+		self.fit(self.queue(self.values[:98]))
+		result = self.detector.check([self.queue(self.values, 2)], [KEY])[0]
+		self.assertEqual(self.detector.reasons[KEY], 'shifted')
+		assert_allclose(result[1], np.repeat(0.5, 5))
+		self.assertEqual(len(result[0]), 98)
+
+		self.detector.check([self.queue(self.values, 2)], [KEY])
+		self.assertEqual(self.detector.reasons[KEY], 'unchanged')
+
+	def test_interval(self):
+		""" A point outside the prediction interval triggers a refit. """
+		self.fit(self.queue(self.values[:98]))
+		values = self.values.copy()
+		values[-1] = 0.9
+		self.assertEqual(self.detector.check([self.queue(values, 2)], [KEY]),
+				[None])
+		self.assertEqual(self.detector.reasons[KEY], 'interval')
+		# Refit hosts are new until their forecast is stored again.
+		self.detector.check([self.queue(values, 2)], [KEY])
+		self.assertEqual(self.detector.reasons[KEY], 'new')
+
+	def test_cusum(self):
+		""" A small persistent shift inside the interval triggers a refit. """
+		self.fit(self.queue(self.values[:96]))
+		values = self.values.copy()
+		values[-4:] = 0.515
+		self.detector.check([self.queue(values, 4)], [KEY])
+		self.assertEqual(self.detector.reasons[KEY], 'cusum')
+
+	def test_age(self):
+		""" Forecasts are refit once the horizon is used up. """
+		self.fit(self.queue(self.values[:90]))
+		self.detector.check([self.queue(self.values, 10)], [KEY])
+		self.assertEqual(self.detector.reasons[KEY], 'age')
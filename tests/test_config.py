@@ -0,0 +1,45 @@
+""" Unit test for the cached scaling configuration. """
+
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+import leptoid.config as config
+
+class TestConfigFile(TestCase):
+
+	def setUp(self):
+		self.directory = mkdtemp()
+		self.path = os.path.join(self.directory, 'scaling_config.yml')
+		self.write('noop: True\n', 100)
+		self.config = config.ConfigFile(self.path)
+
+	def tearDown(self):
+		rmtree(self.directory)
+
+	def write(self, contents, mtime):
+		with open(self.path, 'w') as outfile:
+			outfile.write(contents)
+		os.utime(self.path, (mtime, mtime))
+
+	def test_cached_until_changed(self):
+		""" The file is only parsed again once its mtime changes. """
+		first = self.config.snapshot()
+		self.assertTrue(first['noop'])
+		self.assertTrue(self.config.snapshot() is first)
+		self.assertEqual(self.config.version, 1)
+
+		self.write('noop: False\n', 200)
+		self.assertTrue(self.config.current() is first)
+		self.assertFalse(self.config.snapshot()['noop'])
+		self.assertEqual(self.config.version, 2)
+
+	def test_keeps_last_good_config(self):
+		""" Broken or missing files leave the last snapshot in place. """
+		first = self.config.snapshot()
+		self.write('noop: [True\n', 200)
+		self.assertTrue(self.config.snapshot() is first)
+		os.remove(self.path)
+		self.assertTrue(self.config.snapshot() is first)
+		self.assertEqual(self.config.version, 1)
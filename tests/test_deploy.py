@@ -1,6 +1,10 @@
+import os
 from unittest import TestCase
-from mock import Mock
-from subprocess import PIPE
+from mock import Mock, patch
+from subprocess import PIPE, Popen
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import time
 
 import leptoid.deploy as deploy
 from leptoid.service_queue import ServiceQueue
@@ -37,7 +41,13 @@ class TestDeploy(TestCase):
 		self.assertEqual(down_call,
 				'kbs d n --legacy -t m1.small staging proctoring_application' +
 				' proctoring_application:100')
-	
+
+		# Check a resize straight to a given instance type.
+		resize_call = deploy._build_kbs_resize(queue, 'm1', 'xlarge', 100)
+		self.assertEqual(resize_call,
+				'kbs d n --legacy -t m1.xlarge staging proctoring_application' +
+				' proctoring_application:100')
+
 	def test_build_kbs_rollback(self):
 		""" Testing rollback command. """
 		rollback_call = deploy._build_kbs_rollback(100)
@@ -64,3 +74,71 @@ class TestDeploy(TestCase):
 		#deploy.subprocess.Popen.assert_called_with(
 		#		args=kbs_cmd.split(' '), stdout=PIPE)
 
+
+FAKE_KBS = """#!/bin/sh
+sleep ${FAKE_KBS_DELAY:-0}
+echo "Deployment 12345 started..."
+"""
+
+class TestDeployExecutor(TestCase):
+	""" Runs deployments against a fake kbs script on PATH. """
+
+	def setUp(self):
+		self.directory = mkdtemp()
+		script = os.path.join(self.directory, 'kbs')
+		with open(script, 'w') as kbs:
+			kbs.write(FAKE_KBS)
+		os.chmod(script, 0755)
+		self.environ = patch.dict(os.environ, {'PATH': self.directory +
+			os.pathsep + os.environ['PATH'], 'FAKE_KBS_DELAY': '0'})
+		self.environ.start()
+		# Earlier tests replace Popen with a Mock; use the real one here.
+		self.patches = [self.environ,
+				patch.object(deploy.subprocess, 'Popen', Popen),
+				patch.object(deploy, 'NOOP_MODE', False)]
+		for patcher in self.patches[1:]:
+			patcher.start()
+
+	def tearDown(self):
+		for patcher in self.patches:
+			patcher.stop()
+		rmtree(self.directory)
+
+	def test_call_kbs_timeout(self):
+		""" Slow KBS commands should be killed after their timeout. """
+		self.assertEqual(deploy._call_kbs('kbs d rollback 100', 5), 12345)
+		os.environ['FAKE_KBS_DELAY'] = '10'
+		started = time()
+		self.assertRaises(Exception, deploy._call_kbs, 'kbs d rollback 100',
+				0.5)
+		self.assertTrue(time() - started < 5)
+
+	def test_executor(self):
+		""" Commands for the same instance should be combined, and callbacks
+		should see the deployment id, or that their request was superseded.
+		"""
+		os.environ['FAKE_KBS_DELAY'] = '0.5'
+		executor = deploy.DeployExecutor(workers=2, timeout=5)
+		deploy_ids = []
+		superseded = []
+		callback = lambda job: deploy_ids.append(job.deploy_id)
+		record_superseded = lambda job: superseded.append(job)
+		queue = Mock(instance_id='i-deadbeef')
+		run = lambda queue, timeout: deploy._call_kbs('kbs d rollback 1',
+				timeout)
+
+		first = executor.submit(queue.instance_id, run, (queue,), callback)
+		second = executor.submit(queue.instance_id, run, (queue,),
+				record_superseded)
+		other = executor.submit('i-beefdead', run, (queue,), callback)
+		self.assertTrue(first is second)
+		self.assertFalse(first is other)
+		self.assertEqual(executor.pending(), 2)
+		self.assertEqual(len(superseded), 1)
+		self.assertTrue(superseded[0].superseded_by is first)
+		self.assertTrue(superseded[0].error is not None)
+		self.assertEqual(superseded[0].deploy_id, None)
+
+		self.assertTrue(executor.wait(5))
+		self.assertEqual(deploy_ids, [12345, 12345])
+		self.assertEqual(executor.pending(), 0)
@@ -1,6 +1,9 @@
 """ Unit test for checking API calls. """
 
+import json
+import threading
 from unittest import TestCase
+from mock import Mock
 import leptoid.deploy_api as depapi
 
 class TestDeploymentAPICalls(TestCase):
@@ -23,3 +26,100 @@ class TestDeploymentAPICalls(TestCase):
 		reservation = {'build_id': 100}
 		self.assertTrue(depapi.match_deploy_id(100, reservation))
 		self.assertFalse(depapi.match_deploy_id(999, reservation))
+
+class TestBuildCatalog(TestCase):
+
+	def setUp(self):
+		self.builds = [
+				{'application_name': 'kbs.KRS', 'created_at': '2012-09-01',
+					'services': [{'svn_rev': '100'}]},
+				{'application_name': 'kbs.KRS', 'created_at': '2012-09-02',
+					'services': [{'svn_rev': '101'}],
+					'manifests': {'jenkins_job_id': '7'},
+					'reservation': {'build_id': 1000, 'servers': [
+						{'aws_instance_id': 'i-deadbeef'}]}}]
+		self.response = Mock()
+		self.response.read.return_value = json.dumps(self.builds)
+		self.response.info.return_value.getheader.return_value = None
+		depapi.open_build_info = Mock(return_value=self.response)
+		self.catalog = depapi.BuildCatalog(refresh_interval=60)
+
+	def test_indexes(self):
+		""" Lookups by service, deployment id and instance id. """
+		revs = self.catalog.find_revisions('kbs.KRS')
+		self.assertEqual([rev.svn for rev in revs], [100, 101])
+		self.assertEqual(revs[1].jenkins, 7)
+		self.assertEqual(self.catalog.find_reservation(1000)['build_id'], 1000)
+		self.assertEqual(
+				self.catalog.find_instance_reservation('i-deadbeef')['build_id'],
+				1000)
+
+	def test_refresh_interval(self):
+		""" The build list is only downloaded once per interval, unless an
+		unknown deployment is requested (at most once per forced interval).
+		"""
+		self.catalog.find_revisions('kbs.KRS')
+		self.catalog.find_revisions('knewmena')
+		self.assertEqual(depapi.open_build_info.call_count, 1)
+
+		# Forced downloads are rate-limited, and skipped for noop ids.
+		self.assertEqual(self.catalog.find_reservation(9999), None)
+		self.assertEqual(depapi.open_build_info.call_count, 1)
+		self.catalog.attempted -= self.catalog.forced_interval
+		self.assertEqual(self.catalog.find_reservation(9999), None)
+		self.assertEqual(depapi.open_build_info.call_count, 2)
+		self.catalog.attempted -= self.catalog.forced_interval
+		self.assertEqual(self.catalog.find_reservation(-1), None)
+		self.assertEqual(depapi.open_build_info.call_count, 2)
+
+	def test_unavailable(self):
+		""" While the build API is down, the last good indexes are used and
+		downloads back off until the next refresh interval.
+		"""
+		self.catalog.find_revisions('kbs.KRS')
+		depapi.open_build_info.side_effect = depapi.urllib2.URLError('down')
+		self.catalog.attempted -= 60
+		for _ in xrange(3):
+			self.assertEqual(len(self.catalog.find_revisions('kbs.KRS')), 2)
+			self.assertEqual(self.catalog.find_reservation(9999), None)
+		self.assertEqual(depapi.open_build_info.call_count, 2)
+		self.assertFalse(self.catalog.available)
+
+	def test_concurrent_refresh(self):
+		""" Readers never see partial indexes, and concurrent refreshes
+		share one download.
+		"""
+		self.catalog.find_revisions('kbs.KRS')
+		indexes = self.catalog.indexes
+		self.catalog.attempted -= 60
+		threads = [threading.Thread(target=self.catalog.refresh)
+				for _ in xrange(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(depapi.open_build_info.call_count, 2)
+		self.assertFalse(self.catalog.indexes is indexes)
+		self.assertEqual(len(self.catalog.find_revisions('kbs.KRS')), 2)
+
+class TestTokenManager(TestCase):
+
+	def setUp(self):
+		depapi.build_auth_token = Mock(side_effect=['token-1', 'token-2'])
+		self.tokens = depapi.TokenManager(ttl=3600, margin=300)
+		self.tokens._settings = {}
+
+	def test_token_reuse(self):
+		""" Tokens are reused until they near expiry. """
+		self.assertEqual(self.tokens.get(), 'token-1')
+		self.assertEqual(self.tokens.get(), 'token-1')
+		self.tokens.expires -= 3400
+		self.assertEqual(self.tokens.get(), 'token-2')
+
+	def test_invalidate(self):
+		""" Rejected tokens are replaced; stale rejections are ignored. """
+		self.tokens.get()
+		self.tokens.invalidate('token-0')
+		self.assertEqual(self.tokens.get(), 'token-1')
+		self.tokens.invalidate('token-1')
+		self.assertEqual(self.tokens.get(), 'token-2')
@@ -0,0 +1,58 @@
+""" Unit test for the numpy forecasting backend. """
+
+import numpy as np
+from unittest import TestCase
+from numpy.testing import assert_allclose
+
+import leptoid.ets as ets
+
+class TestETS(TestCase):
+
+	def setUp(self):
+		rng = np.random.RandomState(0)
+		self.flat = 0.5 + 0.01 * rng.randn(200)
+		self.trend = np.linspace(0.1, 0.6, 200)
+
+	def test_batch_fit(self):
+		""" Every row should be fitted and forecast in one call. """
+		output = ets.forecast_batch(np.vstack([self.flat, self.trend]), 15)
+		self.assertEqual(output.mean.shape, (2, 15))
+		self.assertEqual(output.fitted.shape, (2, 200))
+
+		# Level series stay level, trending series keep trending.
+		assert_allclose(output.mean[0], 0.5, atol=0.02)
+		self.assertTrue(output.mean[1, -1] > self.trend[-1])
+
+		# The simplest model wins when nothing else fits better.
+		fit = ets.fit(np.ones((1, 50)))
+		self.assertEqual(fit.method[0], 'ETS(A,N,N)')
+
+	def test_forecast_attributes(self):
+		""" Rows should expose the attributes of R's forecast objects. """
+		output = ets.forecast_batch(np.vstack([self.flat, self.trend]), 15)
+		row = output.row(1)
+		assert_allclose(row.rx2('mean'), output.mean[1])
+		assert_allclose(row.rx2('residuals'), self.trend - row.rx2('fitted'))
+		self.assertRaises(KeyError, row.rx2, 'upper')
+
+	def test_model_type(self):
+		""" Restricting the model form restricts the candidates. """
+		fit = ets.fit(self.trend[np.newaxis, :], 'ANN')
+		self.assertTrue((fit.beta == 0).all())
+		self.assertRaises(Exception, ets.fit, self.trend, 'MAM')
+
+	def test_no_trend(self):
+		""" Models without a trend forecast flat, whatever the early data. """
+		series = np.concatenate([np.linspace(0., 10., 20),
+			np.repeat(10., 80)])
+		fit = ets.fit(series[np.newaxis, :], 'ANN')
+		self.assertEqual(fit.trend[0], 0.)
+		mean = fit.forecast(10).mean[0]
+		assert_allclose(mean, mean[0])
+		assert_allclose(mean[0], 10., atol=0.1)
+
+		level, trend, _ = ets.smooth(np.repeat(10., 5), fit.alpha[0], 0.,
+				1., fit.level[0], 0.5)
+		self.assertEqual(trend, 0.)
+		assert_allclose(ets.forecast_states(level, 0.5, 1., 5, 0.),
+				np.repeat(level, 5))
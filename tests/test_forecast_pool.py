@@ -0,0 +1,80 @@
+""" Unit test for the forecasting process pool. """
+
+import numpy as np
+from unittest import TestCase
+from mock import Mock
+from time import ctime
+from pandas import TimeSeries, PeriodIndex
+
+import leptoid.forecast_pool as fp
+
+class TestForecastPool(TestCase):
+
+	def setUp(self):
+		seriesidx = PeriodIndex(start=ctime(10000), periods=10)
+		self.queue = Mock(service='kbs.KRS', instance_id='i-deadbeef',
+				utilization=TimeSeries(data=range(10), index=seriesidx))
+
+	def test_forecast_task(self):
+		""" Tasks should carry the queue details needed for forecasting. """
+		task = fp.ForecastTask('staging', self.queue.service,
+				self.queue.instance_id, self.queue.utilization, None)
+		self.assertEqual(task.get_first_timestamp(),
+				self.queue.utilization.index[0])
+
+	def test_serial_forecast(self):
+		""" A single-worker pool runs in process and absorbs failures. """
+		fp._forecast_task = Mock(return_value=(('fitted', 'mean'), None))
+		pool = fp.ForecastPool(workers=1)
+		self.assertEqual(pool.forecast([self.queue]), [('fitted', 'mean')])
+
+		fp._forecast_task.side_effect = Exception("R error")
+		self.assertEqual(pool.forecast([self.queue]), [(None, None)])
+
+	def test_cached_models(self):
+		""" Models returned by workers are kept for the next pass, and models
+		for instances that disappeared are evicted.
+		"""
+		fp._forecast_task = Mock(return_value=(('fitted', 'mean'), 'model'))
+		pool = fp.ForecastPool(workers=1, model_config={'warm_start': True})
+		pool.forecast([self.queue])
+		key = (self.queue.environment, 'kbs.KRS', 'i-deadbeef')
+		self.assertEqual(pool.cache.models[key], 'model')
+
+		pool.forecast([])
+		self.assertEqual(len(pool.cache), 0)
+
+	def test_change_detection(self):
+		""" Hosts without new points keep their forecast. """
+		fitted = np.arange(10, dtype=float)
+		fp._forecast_task = Mock(return_value=((fitted, np.ones(3)), None))
+		pool = fp.ForecastPool(workers=1,
+				detection_config={'enabled': True})
+		first = pool.forecast([self.queue])
+		second = pool.forecast([self.queue])
+		self.assertEqual(fp._forecast_task.call_count, 1)
+		self.assertTrue(second[0][1] is first[0][1])
+
+	def test_hierarchical_change_detection(self):
+		""" A service is refit from all its instances when any changed. """
+		seriesidx = PeriodIndex(start=ctime(10000), periods=10)
+		queues = [Mock(environment='staging', service='kbs.KRS',
+			instance_id=iid, utilization=TimeSeries(data=np.arange(10.),
+				index=seriesidx)) for iid in ('i-deadbeef', 'i-beefdead')]
+		pool = fp.ForecastPool(workers=1, model_config={'hierarchical': True},
+				detection_config={'enabled': True})
+		pool._forecast_queues = Mock(side_effect=lambda aggregates, keys:
+				[(np.arange(10.) * 2, np.repeat(9., 5))] * len(aggregates))
+		pool.hierarchy.aggregate = Mock(wraps=pool.hierarchy.aggregate)
+		pool.forecast(queues)
+
+		# One instance jumps, the other has no new points.
+		changed = np.append(np.arange(10.), 100.)
+		queues[0].utilization = TimeSeries(data=changed,
+				index=PeriodIndex(start=ctime(10000), periods=11))
+		results = pool.forecast(queues)
+		self.assertEqual(pool._forecast_queues.call_count, 2)
+		refit_keys = pool.hierarchy.aggregate.call_args[0][1]
+		self.assertEqual([key[2] for key in refit_keys],
+				['i-deadbeef', 'i-beefdead'])
+		self.assertTrue(all(result[1] is not None for result in results))
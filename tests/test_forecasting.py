@@ -12,16 +12,19 @@ class TestForecasting(TestCase):
 
 	def setUp(self):
 		""" Building test case scaffolding. """
-		fore.forecast = Mock()
-		fore.graphics = Mock()
+		self.forecast = Mock()
+		fore.R.override(forecast=self.forecast, graphics=Mock())
 		self.config_file = Mock()
 		seriesidx = PeriodIndex(start=ctime(10000), periods=10)
 		self.tseries = TimeSeries(data=range(10), index=seriesidx)
 
+	def tearDown(self):
+		fore.R.reset()
+
 	def test_forecast_utilization(self):
 		""" Test whether forecast methods are called. """
 		_ = fore._forecast_utilization(self.tseries)
-		fore.forecast.ets.assert_called_with(self.tseries, model='ZZZ')
+		self.forecast.ets.assert_called_with(self.tseries, model='ZZZ')
 
 	def test_get_forecast_attr(self):
 		""" Check whether attributes are retrieved properly. """
@@ -2,10 +2,14 @@
 
 import leptoid.graphite as g
 import leptoid.namespaces as ns
+from leptoid.targets import TARGETS
 from leptoid.scaler import LeptoidScaler
 
+import socket
+from mock import patch
 from unittest import TestCase
-from numpy import arange
+from StringIO import StringIO
+from numpy import arange, isnan
 from time import ctime
 from pandas import TimeSeries
 
@@ -41,3 +45,167 @@ class TestGraphite(TestCase):
 		self.assertTrue(isinstance(namespace_data, dict))
 		self.assertTrue(isinstance(tser, TimeSeries))
 		self.assertTrue(len(tser) == 10)
+
+	def test_rolling_series_merge(self):
+		""" Overlapping merges should match a moving average computed over
+		the full series.
+		"""
+		values = arange(20, dtype=float)
+		buf = g.RollingSeries(capacity=10, step=60)
+		buf.merge(0, 60, values[:12])
+		buf.merge(600, 60, values[10:16])
+		buf.merge(840, 60, values[14:20])
+
+		self.assertEqual(buf.end, 1200)
+		tser = buf.to_time_series()
+		expected = g.moving_average(values)[10:]
+		self.assertTrue(len(tser) == 10)
+		self.assertTrue((tser.values == expected).all())
+
+	def test_empty_buffers(self):
+		""" Buffers that never merged a point are left out of the history. """
+		history = g.GraphiteHistory(10, 5)
+		history.update([{'start': 60, 'step': 60, 'values': [],
+			'name': "Knewton.Staging.Webservice-KRS.i-beefdead"}])
+		self.assertEqual(history.extract_fleet_matrix().keys, [])
+		self.assertEqual(history.render_params({'from': '-10min'}),
+				{'from': '-10min'})
+
+		history.update([{'start': 60, 'step': 60,
+			'values': arange(5, dtype=float),
+			'name': "Knewton.Staging.Webservice-KRS.i-deadbeef"},
+			{'start': 60, 'step': 60, 'values': [],
+				'name': "Knewton.Staging.Webservice-KRS.i-beefdead"}])
+		fleet = history.extract_fleet_matrix()
+		self.assertEqual(fleet.keys, [('staging', 'kbs.KRS', 'i-deadbeef')])
+
+	def test_raw_parser(self):
+		""" Raw responses should parse the same regardless of how they are
+		split into chunks.
+		"""
+		response = ("scale(Knewton.Staging.Webservice-KRS.i-deadbeef,0.016666)"
+				",60,300,60|1.0,None,3.5,4\n"
+				"Knewton.Staging.Webservice-KRS.i-beefdead,60,180,60|None,2\n")
+		for chunk_size in (1, 7, 4096):
+			series = g.parse_raw(StringIO(response), chunk_size)
+			self.assertEqual(len(series), 2)
+			self.assertEqual(series[0]['name'],
+					"scale(Knewton.Staging.Webservice-KRS.i-deadbeef,0.016666)")
+			self.assertEqual(series[0]['step'], 60)
+			self.assertEqual(list(series[0]['values'][[0, 2, 3]]),
+					[1.0, 3.5, 4.0])
+			self.assertTrue(isnan(series[0]['values'][1]))
+			self.assertTrue(isnan(series[1]['values'][0]))
+			self.assertEqual(series[1]['values'][1], 2.0)
+
+	def test_fleet_matrix(self):
+		""" Series should be aligned on one index and averaged together. """
+		fake_data = [
+				{'start': 60, 'step': 60, 'values': arange(10, dtype=float),
+					'name': "Knewton.Staging.Webservice-KRS.i-deadbeef"},
+				{'start': 180, 'step': 60, 'values': arange(8, dtype=float),
+					'name': "Knewton.Staging.Webservice-KRS.i-beefdead"}]
+		fleet = g.extract_fleet_matrix(fake_data)
+		self.assertEqual(fleet.values.shape, (2, 10))
+		self.assertEqual(list(fleet.row(
+			('staging', 'kbs.KRS', 'i-deadbeef'))),
+			list(g.moving_average(arange(10, dtype=float))))
+		# The second series starts two steps later.
+		self.assertEqual(list(fleet.values[1, 6:]), [2.0, 3.0, 4.0, 5.0])
+
+	def test_shard_targets(self):
+		""" Targets should be grouped by service, in order. """
+		targets = TARGETS['arrival_rates']
+		shards = g.shard_targets(targets)
+		self.assertEqual(sum(len(shard) for shard in shards), len(targets))
+		self.assertTrue(all(len(shard) == 2 for shard in shards))
+		self.assertTrue('Production' in shards[0][0])
+		self.assertTrue('Staging' in shards[0][1])
+		self.assertEqual(len(g.shard_targets(targets, 'environment')), 2)
+
+	def test_sharded_fetch(self):
+		""" Shards should be retried on their own and merged, and connections
+		should be reused.
+		"""
+		FakeConnection.created = []
+		FakeConnection.failures = {'Webservice-Course': 1,
+				'Webservice-KRS': 10}
+		targets = TARGETS['service_times']
+		fetcher = g.ShardedFetcher(workers=3, retries=2)
+		with patch('leptoid.graphite.httplib.HTTPSConnection', FakeConnection):
+			series = fetcher.fetch(targets, {'format': 'raw', 'from': '-1h'})
+
+		# Every shard but KRS comes back, Course after one retry.
+		self.assertEqual(len(series), len(targets) - 2)
+		self.assertEqual(len(fetcher.failed), 1)
+		self.assertTrue('Webservice-KRS' in fetcher.failed[0][0])
+		self.assertEqual(list(series[0]['values']), [1.0, 2.0])
+		# One connection per worker, plus one for each failed request.
+		self.assertTrue(len(FakeConnection.created) <= 3 + 1 + 3)
+
+	def test_shard_backfill(self):
+		""" Unparseable responses fail their shard, which is fetched with the
+		backfill window on the next call.
+		"""
+		FakeConnection.created = []
+		FakeConnection.failures = {}
+		FakeConnection.garbled = {'Webservice-KRS': 1}
+		FakeConnection.paths = []
+		targets = TARGETS['service_times']
+		fetcher = g.ShardedFetcher(workers=1, retries=0)
+		recent = {'format': 'raw', 'from': '-5min'}
+		full = {'format': 'raw', 'from': '-3d'}
+		with patch('leptoid.graphite.httplib.HTTPSConnection', FakeConnection):
+			series = fetcher.fetch(targets, recent, full)
+			self.assertEqual(len(series), len(targets) - 2)
+			self.assertTrue(any(connection.closed
+				for connection in FakeConnection.created))
+			self.assertFalse('-3d' in ''.join(FakeConnection.paths))
+
+			FakeConnection.paths = []
+			series = fetcher.fetch(targets, recent, full)
+		self.assertEqual(len(series), len(targets))
+		backfilled = [path for path in FakeConnection.paths if '-3d' in path]
+		self.assertEqual(len(backfilled), 1)
+		self.assertTrue('Webservice-KRS' in backfilled[0])
+		self.assertEqual(fetcher.incomplete, set())
+
+class FakeConnection(object):
+	""" Stands in for httplib.HTTPSConnection, answering /render calls with
+	one raw series per target. Targets mentioning a key in failures raise
+	socket errors that many times.
+	"""
+
+	created = []
+	failures = {}
+	garbled = {}
+	paths = []
+
+	def __init__(self, host, timeout=None):
+		FakeConnection.created.append(self)
+		self.path = None
+		self.closed = False
+
+	def request(self, method, path):
+		self.path = path
+		FakeConnection.paths.append(path)
+
+	def getresponse(self):
+		targets = self.path.split('&target=')[1:]
+		for key, remaining in self.failures.items():
+			if remaining and key in targets[0]:
+				self.failures[key] -= 1
+				raise socket.error("Connection reset")
+		for key, remaining in self.garbled.items():
+			if remaining and key in targets[0]:
+				self.garbled[key] -= 1
+				response = StringIO("garbled|1.0\n")
+				response.status = 200
+				return response
+		response = StringIO(''.join("%s,0,120,60|1.0,2.0\n" % target
+			for target in targets))
+		response.status = 200
+		return response
+
+	def close(self):
+		self.closed = True
@@ -0,0 +1,44 @@
+""" Unit test for hierarchical forecasting. """
+
+import numpy as np
+from unittest import TestCase
+from mock import Mock
+from numpy.testing import assert_allclose
+
+from leptoid.hierarchy import Hierarchy, aggregate_keys, AGGREGATE_ID
+
+KEYS = [('staging', 'kbs.KRS', 'i-deadbeef'),
+		('staging', 'knewmena', 'i-beefdead'),
+		('staging', 'kbs.KRS', 'i-00000000')]
+
+class TestHierarchy(TestCase):
+
+	def setUp(self):
+		self.hierarchy = Hierarchy(share_window=4, bias_window=2)
+		self.utilization = np.array([[0.3] * 4, [0.5] * 4, [0.1] * 4])
+		self.queues = [Mock(utilization=row) for row in self.utilization]
+
+	def test_aggregate(self):
+		""" Instances are summed per (environment, service). """
+		matrix, aggregates, groups = self.hierarchy.aggregate(self.queues,
+				KEYS)
+		self.assertEqual(groups, [[0, 2], [1]])
+		self.assertEqual([aggregate.service for aggregate in aggregates],
+				['kbs.KRS', 'knewmena'])
+		assert_allclose(aggregates[0].utilization, [0.4] * 4)
+		self.assertEqual(aggregate_keys(KEYS),
+				[('staging', 'kbs.KRS', AGGREGATE_ID),
+				('staging', 'knewmena', AGGREGATE_ID)])
+
+	def test_split(self):
+		""" Aggregate forecasts are split by share, with a bias correction. """
+		matrix, aggregates, groups = self.hierarchy.aggregate(self.queues,
+				KEYS)
+		# The KRS fit runs 0.04 low; knewmena has no forecast.
+		forecasts = [(np.repeat(0.36, 4), np.array([0.8, 0.8])),
+				(None, None)]
+		results = self.hierarchy.split(matrix, groups, forecasts)
+		assert_allclose(results[0][0], [0.3] * 4)
+		assert_allclose(results[0][1], [0.63, 0.63])
+		assert_allclose(results[2][1], [0.21, 0.21])
+		self.assertEqual(results[1], (None, None))
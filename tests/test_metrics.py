@@ -0,0 +1,82 @@
+""" Unit test for per-stage instrumentation. """
+
+import socket
+import struct
+import cPickle
+from unittest import TestCase
+
+import leptoid.metrics as metrics
+
+class TestMetricsClient(TestCase):
+
+	def setUp(self):
+		self.sink = metrics.MemorySink()
+		self.client = metrics.MetricsClient(self.sink, prefix='test')
+
+	def test_disabled(self):
+		""" Without a sink nothing is recorded. """
+		client = metrics.MetricsClient()
+		self.assertTrue(client.timer('stage') is metrics.NULL_TIMER)
+		client.incr('count')
+		client.flush()
+		self.assertEqual(client.counters, {})
+
+	def test_aggregation(self):
+		""" Timers, counters and gauges are aggregated between flushes. """
+		for seconds in (1., 3.):
+			self.client.timing('stage', seconds)
+		with self.client.timer('other'):
+			pass
+		self.client.incr('count')
+		self.client.incr('count', 2)
+		self.client.gauge('hosts', 10)
+		self.client.gauge('hosts', 12)
+		self.client.flush()
+
+		values = self.sink.values()
+		self.assertEqual(values['test.stage.count'], 2)
+		self.assertEqual(values['test.stage.total'], 4.)
+		self.assertEqual(values['test.stage.max'], 3.)
+		self.assertEqual(values['test.other.count'], 1)
+		self.assertEqual(values['test.count'], 3)
+		self.assertEqual(values['test.hosts'], 12)
+
+		# Everything is reset after a flush.
+		self.client.flush()
+		self.assertEqual(len(self.sink.datapoints), len(values))
+
+class TestCarbonSink(TestCase):
+
+	def test_plaintext_udp(self):
+		""" Plaintext datapoints arrive as carbon lines. """
+		server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		server.bind(('127.0.0.1', 0))
+		server.settimeout(5)
+		sink = metrics.CarbonSink('127.0.0.1', server.getsockname()[1])
+		sink.send([('leptoid.stage', 1.5, 1000), ('leptoid.count', 3, 1000)])
+		self.assertEqual(server.recv(4096),
+				"leptoid.stage 1.5 1000\nleptoid.count 3 1000\n")
+		sink.close()
+		server.close()
+
+	def test_pickle_tcp(self):
+		""" Pickled datapoints are length-prefixed (path, (time, value))
+		tuples.
+		"""
+		server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		server.bind(('127.0.0.1', 0))
+		server.listen(1)
+		sink = metrics.CarbonSink('127.0.0.1', server.getsockname()[1],
+				protocol='pickle', transport='tcp')
+		sink.send([('leptoid.stage', 1.5, 1000)])
+		connection, _ = server.accept()
+		connection.settimeout(5)
+		length = struct.unpack('!L', connection.recv(4))[0]
+		payload = cPickle.loads(connection.recv(length))
+		self.assertEqual(payload, [('leptoid.stage', (1000, 1.5))])
+		sink.close()
+		connection.close()
+		server.close()
+
+	def test_pickle_requires_tcp(self):
+		self.assertRaises(Exception, metrics.CarbonSink, protocol='pickle')
@@ -0,0 +1,30 @@
+""" Unit test for the forecasting model cache. """
+
+import numpy as np
+from unittest import TestCase
+
+from leptoid.model_cache import ModelCache, CachedModel
+
+class TestModelCache(TestCase):
+
+	def setUp(self):
+		self.cache = ModelCache(refit_passes=2, drift_ratio=4.0)
+		self.key = ('staging', 'kbs.KRS', 'i-deadbeef')
+		self.entry = CachedModel('ANN', {'alpha': 0.1}, sigma2=1.0)
+		self.cache.put(self.key, self.entry)
+
+	def test_refit_schedule(self):
+		""" Models are handed out until they are due for a refit. """
+		self.assertTrue(self.cache.get(self.key) is self.entry)
+		self.entry.passes = 2
+		self.assertTrue(self.cache.get(self.key) is None)
+
+	def test_drift(self):
+		""" Large recent residuals should trigger a refit. """
+		self.assertFalse(self.cache.has_drifted(self.entry, np.ones(20)))
+		self.assertTrue(self.cache.has_drifted(self.entry, 3 * np.ones(20)))
+
+	def test_eviction(self):
+		""" Only instances still reported by Graphite are kept. """
+		self.cache.retain([('staging', 'kbs.KRS', 'i-beefdead')])
+		self.assertFalse(self.key in self.cache)
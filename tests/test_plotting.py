@@ -0,0 +1,53 @@
+""" Unit test for background forecast plotting. """
+
+import numpy as np
+from unittest import TestCase
+from mock import Mock
+
+import leptoid.plotting as plotting
+
+class TestForecastPlotter(TestCase):
+
+	def setUp(self):
+		self.renderer = Mock()
+		self.plotter = plotting.ForecastPlotter(queue_size=2, min_interval=900,
+				renderer=self.renderer)
+		# Keep jobs queued so the test can drain them itself.
+		self.plotter.thread = Mock()
+		self.estimate = np.array([0.5] * 10)
+		self.fleet = np.ones((3, 20))
+
+	def queue(self, instance_id):
+		return Mock(service='kbs.KRS', instance_id=instance_id,
+				utilization=self.fleet[0])
+
+	def test_rate_limit(self):
+		""" Each instance is plotted at most once per interval. """
+		self.assertTrue(self.plotter.submit(
+			self.queue('i-deadbeef'), None, self.estimate))
+		self.assertFalse(self.plotter.submit(
+			self.queue('i-deadbeef'), None, self.estimate))
+		self.assertFalse(self.plotter.submit(
+			self.queue('i-beefdead'), None, np.zeros(10)))
+
+	def test_drop_oldest(self):
+		""" A full queue drops its oldest jobs. """
+		for instance_id in ('i-00000001', 'i-00000002', 'i-00000003'):
+			self.plotter.submit(self.queue(instance_id), None, self.estimate)
+		self.assertEqual(self.plotter.dropped, 1)
+
+		self.plotter.drain()
+		rendered = [call[0][0].instance_id
+				for call in self.renderer.call_args_list]
+		self.assertEqual(rendered, ['i-00000002', 'i-00000003'])
+
+		# The dropped instance isn't rate-limited.
+		self.assertTrue(self.plotter.submit(self.queue('i-00000001'), None,
+			self.estimate))
+
+	def test_copies(self):
+		""" Queued jobs don't hold views into the fleet matrix. """
+		self.plotter.submit(self.queue('i-deadbeef'), None, self.estimate)
+		job = self.plotter.jobs[0]
+		self.assertFalse(np.may_share_memory(job.utilization, self.fleet))
+		self.assertFalse(job.util_estimate is self.estimate)
@@ -0,0 +1,51 @@
+""" Unit test for the multi-resolution view used for fitting. """
+
+import numpy as np
+from unittest import TestCase
+from numpy.testing import assert_allclose
+
+import leptoid.forecasting as fore
+from leptoid.resolution import CompactView
+
+class TestCompactView(TestCase):
+
+	def setUp(self):
+		# Three days of minutes with a daily cycle and a constant level.
+		self.view = CompactView(recent_minutes=360, coarse_minutes=15)
+		minutes = np.arange(3 * 1440)
+		self.daily = 0.1 * np.sin(2 * np.pi * minutes / 1440.)
+		self.matrix = np.vstack([0.5 + self.daily,
+			np.repeat(0.3, len(minutes))])
+
+	def test_downsample(self):
+		""" Coarse points are block means aligned on the newest point. """
+		coarse = self.view.downsample(np.arange(32.)[np.newaxis])
+		assert_allclose(coarse, [[9., 24.]])
+
+	def test_prepare(self):
+		""" The fitted series is short and free of the daily cycle. """
+		fit, past, ahead = self.view.prepare(self.matrix, 15)
+		self.assertEqual(fit.shape, (2, 360))
+		self.assertEqual(ahead.shape, (2, 15))
+		self.assertTrue(np.abs(fit[0] - 0.5).max() < 0.01)
+		assert_allclose(fit[1], 0.3)
+
+		in_sample, estimate = self.view.restore(fit[0], np.repeat(0.5, 15),
+				past[0], ahead[0], self.matrix.shape[1])
+		self.assertEqual(len(in_sample), self.matrix.shape[1])
+		assert_allclose(in_sample[-360:], self.matrix[0, -360:])
+		self.assertTrue(np.isnan(in_sample[0]))
+		# The next 15 minutes start the next day's cycle.
+		self.assertTrue(np.abs(estimate - 0.5 - self.daily[:15]).max() < 0.01)
+
+	def test_forecast_fleet(self):
+		""" The numpy backend fits the compact view. """
+		queue = type('Queue', (object,), {'environment': 'staging',
+			'service': 'kbs.KRS', 'instance_id': 'i-deadbeef',
+			'utilization': self.matrix[0]})
+		config = {'backend': 'numpy', 'model_type': 'ANN', 'horizon': 15,
+				'compact_view': True}
+		in_sample, estimate = fore.forecast_fleet([queue], config)[0]
+		self.assertEqual(len(in_sample), self.matrix.shape[1])
+		self.assertEqual(len(estimate), 15)
+		self.assertTrue(np.abs(estimate - 0.5 - self.daily[:15]).max() < 0.02)
@@ -0,0 +1,62 @@
+""" Unit test for rollback tracking. """
+
+import datetime
+from unittest import TestCase
+
+from leptoid.rollbacks import RollbackTracker
+from leptoid.utils import RollbackDetails
+
+class TestRollbackTracker(TestCase):
+
+	def setUp(self):
+		self.now = datetime.datetime(2013, 6, 1, 12)
+		self.tracker = RollbackTracker({'production': 3600, 'staging': 600},
+				clock=lambda: self.now)
+
+	def details(self, minutes_ago, build_id=1):
+		return RollbackDetails(
+				time=self.now - datetime.timedelta(minutes=minutes_ago),
+				build_id=build_id)
+
+	def test_find(self):
+		""" Every instance of a deployment maps back to it. """
+		details = self.details(15)
+		self.tracker.record(('i-deadbeef', 'i-beefdead'), details,
+				'production')
+		self.assertTrue(self.tracker.find('i-beefdead', 'production')
+				is details)
+		self.assertTrue('i-deadbeef' in self.tracker)
+		self.assertEqual(self.tracker.find('i-01234567', 'production'), None)
+		# Outside staging's shorter rollback window.
+		self.assertEqual(self.tracker.find('i-deadbeef', 'staging'), None)
+		self.assertEqual(len(self.tracker), 0)
+
+	def test_no_instances(self):
+		""" Deployments without instance ids aren't recorded. """
+		self.tracker.record(None, self.details(5), 'production')
+		self.tracker.record((), self.details(5), 'production')
+		self.assertEqual(len(self.tracker), 0)
+
+	def test_expire(self):
+		""" Deployments age out without being looked up again. """
+		self.tracker.record('i-deadbeef', self.details(5), 'staging')
+		self.tracker.record('i-beefdead', self.details(5), 'production')
+		self.now += datetime.timedelta(minutes=10)
+		self.assertEqual(self.tracker.expire(), 1)
+		self.assertFalse('i-deadbeef' in self.tracker)
+		self.assertTrue('i-beefdead' in self.tracker)
+		self.assertEqual(self.tracker.index.keys(), ['i-beefdead'])
+
+	def test_replace(self):
+		""" Redeploying an instance replaces its earlier deployment. """
+		self.tracker.record(('i-deadbeef', 'i-beefdead'), self.details(50),
+				'production')
+		latest = self.details(1, 2)
+		self.tracker.record(('i-deadbeef',), latest, 'production')
+		self.assertTrue(self.tracker.find('i-deadbeef', 'production')
+				is latest)
+		self.assertEqual(self.tracker.find('i-beefdead', 'production'), None)
+		self.now += datetime.timedelta(minutes=15)
+		self.tracker.expire()
+		self.assertTrue(self.tracker.find('i-deadbeef', 'production')
+				is latest)
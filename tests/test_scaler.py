@@ -3,9 +3,13 @@ from unittest import TestCase
 from mock import Mock
 import numpy as np
 import datetime
+from time import time
 
 import leptoid.scaler as scaler
 from leptoid.namespaces import NAMESPACES
+from leptoid.graphite import FleetMatrix, GraphiteHistory
+from leptoid.service_queue import FleetQueues
+from leptoid.capacity import CapacityPlanner
 
 class TestLeptoidScaler(TestCase):
 
@@ -29,12 +33,22 @@ class TestLeptoidScaler(TestCase):
 		scaler.find_instance_ids = Mock()
 		scaler.find_instance_ids.return_value = ('i-deadbeef')
 		self.scaler.evaluate_instance(queue, estimated_util)
-		scaler.deploy.upscale.assert_called_with(queue)
+		self.assertTrue(self.scaler.wait_for_deploys(5))
+		scaler.deploy.upscale.assert_called_with(queue, **self.deploy_kwargs())
+		self.assertTrue(('i-deadbeef') in self.scaler.recent_deploys)
 
 		# Downscale call.
 		estimated_util = np.array([0.01] * 4)
 		self.scaler.evaluate_instance(queue, estimated_util)
-		scaler.deploy.downscale.assert_called_with(queue)
+		self.assertTrue(self.scaler.wait_for_deploys(5))
+		scaler.deploy.downscale.assert_called_with(queue,
+				**self.deploy_kwargs())
+
+	def deploy_kwargs(self):
+		""" Keyword arguments the scaler passes to leptoid.deploy calls. """
+		if self.scaler.executor is None:
+			return {}
+		return {'timeout': self.scaler.executor.timeout}
 
 	def test_rollback_candidate_check(self):
 		""" Testing scaler._find_rollback_candidates. """
@@ -51,3 +65,103 @@ class TestLeptoidScaler(TestCase):
 		# Testing positive (but expired) rollback candidates.
 		self.assertFalse(self.scaler._find_rollback_candidates(
 			Mock(instance_id = 'i-00000000', environment='production')))
+
+	def test_defer_low_priority(self):
+		""" Behind schedule, hosts well inside their limits are deferred, but
+		never twice in a row.
+		"""
+		keys = [('production', 'knewmena', 'i-%i' % idx) for idx in range(3)]
+		arrival_rates = FleetMatrix(0, 60, np.ones((3, 4)), keys)
+		# Latest utilizations: above, inside and below the scaling limits.
+		service_times = FleetMatrix(0, 60, np.array([[0.9] * 4, [0.4] * 4,
+			[0.1] * 4]), keys)
+		self.scaler.upscale_limits = {'knewmena': 0.7}
+		self.scaler.downscale_limits = {'knewmena': 0.2}
+		self.scaler.defer_ratio = 0.8
+
+		fleet = FleetQueues(arrival_rates, service_times)
+		self.assertEqual(self.scaler.defer_low_priority(fleet, False), 0)
+		self.assertEqual(self.scaler.defer_low_priority(fleet), 1)
+		self.assertEqual(list(fleet.instance_id), ['i-0', 'i-2'])
+
+		fleet = FleetQueues(arrival_rates, service_times)
+		self.assertEqual(self.scaler.defer_low_priority(fleet), 0)
+		self.assertEqual(len(fleet), 3)
+
+	def test_planned_upscale(self):
+		""" With a capacity planner, instances are resized in one step. """
+		scaler.deploy.resize = Mock()
+		scaler.find_instance_ids = Mock(return_value=('i-deadbeef',))
+		self.scaler.planner = CapacityPlanner()
+		self.scaler.upscale_limits = {'knewmena': 0.7}
+		self.scaler.upscale_time_horizon = 2
+		queue = Mock(service='knewmena', instance_id='i-deadbeef',
+				environment='production', instance_size='m1.small',
+				arrival_rate=np.ones(5), service_time=np.repeat(0.5, 5))
+
+		self.scaler.evaluate_instance(queue, np.array([1.2, 1.75, 9.]))
+		self.assertTrue(self.scaler.wait_for_deploys(5))
+		scaler.deploy.resize.assert_called_with(queue, 'm1.large',
+				**self.deploy_kwargs())
+		self.assertTrue('i-deadbeef' in self.scaler.recent_deploys)
+
+	def test_sharded_deploy(self):
+		""" Instances of pairs leased by another worker aren't deployed. """
+		scaler.deploy.upscale = Mock()
+		self.scaler.coordinator = Mock(worker_id='worker-a')
+		self.scaler.coordinator.owns.return_value = False
+		queue = Mock(service='knewmena', instance_id='i-deadbeef',
+				environment='production')
+		self.assertEqual(self.scaler._deploy(queue, scaler.deploy.upscale,
+			(queue,)), None)
+		self.assertFalse(scaler.deploy.upscale.called)
+		self.scaler.coordinator.owns.assert_called_with(
+				('production', 'knewmena'))
+
+	def test_noop_upscale(self):
+		""" Upscales without a known build (noop mode) aren't tracked. """
+		scaler.deploy.upscale = Mock(return_value=-1)
+		scaler.find_instance_ids = Mock(return_value=None)
+		self.scaler.recent_deploys = {}
+		queue = Mock(service='knewmena', instance_id='i-deadbeef',
+				environment='production')
+		self.scaler.upscale_instance(queue)
+		self.assertTrue(self.scaler.wait_for_deploys(5))
+		scaler.find_instance_ids.assert_called_with(-1)
+		# The callback itself runs without raising.
+		job = Mock(error=None, deploy_id=-1, args=(queue,))
+		self.scaler._record_upscale(job)
+		self.assertEqual(len(self.scaler.recent_deploys), 0)
+
+	def test_backfill_new_pairs(self):
+		""" Pairs taken over after a rebalance get the full history, while
+		pairs already buffered only get the newest minutes.
+		"""
+		krs = "*.Production.Webservice-KRS.Instance.*.proxy_service_time_avg"
+		knewmena = ("*.Production.Application-Knewmena.Instance.*."
+				"proxy_service_time_avg")
+		names = {krs: "Knewton.Production.Webservice-KRS.i-deadbeef",
+				knewmena: "Knewton.Production.Application-Knewmena.i-beefdead"}
+		calls = []
+		def call_graphite(targets, api_params, backfill_params=None):
+			calls.append((targets, api_params['from']))
+			return [{'start': int(time()) - 600, 'step': 60,
+				'values': np.ones(10), 'name': names[target]}
+				for target in targets]
+		self.scaler._call_graphite = call_graphite
+		self.scaler.fetcher = None
+		self.scaler.api_params = {'format': 'raw', 'from': '-3d'}
+		self.scaler.history = {'service_times': GraphiteHistory(4320, 5)}
+
+		self.scaler.targets = {'service_times': [krs]}
+		self.scaler._query_incremental('service_times')
+		self.assertEqual(calls, [([krs], '-3d')])
+
+		calls[:] = []
+		self.scaler.targets = {'service_times': [krs, knewmena]}
+		fleet = self.scaler._query_incremental('service_times')
+		self.assertEqual(len(calls), 2)
+		self.assertEqual(calls[0][0], [krs])
+		self.assertNotEqual(calls[0][1], '-3d')
+		self.assertEqual(calls[1], ([knewmena], '-3d'))
+		self.assertEqual(len(fleet.keys), 2)
@@ -0,0 +1,63 @@
+""" Unit test for deadline-based pass scheduling. """
+
+from unittest import TestCase
+
+from leptoid.scheduler import PassScheduler
+
+class FakeClock(object):
+	""" Clock that only moves when slept on or advanced. """
+
+	def __init__(self, now):
+		self.now = now
+
+	def __call__(self):
+		return self.now
+
+	def sleep(self, seconds):
+		self.now += seconds
+
+class TestPassScheduler(TestCase):
+
+	def setUp(self):
+		self.clock = FakeClock(1005.)
+		self.scheduler = PassScheduler(interval=60, deadline=50, max_lag=15,
+				clock=self.clock, sleeper=self.clock.sleep)
+
+	def test_boundaries(self):
+		""" Passes start on interval boundaries regardless of duration. """
+		first = self.scheduler.next_pass()
+		self.assertEqual(first.started, 1020)
+		self.clock.now += 30
+		self.scheduler.finish(first)
+
+		second = self.scheduler.next_pass()
+		self.assertEqual(second.started, 1080)
+		self.assertEqual(second.lag, 0)
+		self.assertFalse(second.behind)
+		self.assertEqual(second.remaining(), 50)
+
+	def test_overrun(self):
+		""" Late passes start immediately, or skip their boundary if they are
+		too late.
+		"""
+		first = self.scheduler.next_pass()
+		self.clock.now += 70
+		self.scheduler.finish(first)
+		self.assertEqual(self.scheduler.overruns, 1)
+
+		# Ten seconds late: still within max_lag.
+		second = self.scheduler.next_pass()
+		self.assertEqual(second.lag, 10)
+		self.assertTrue(second.behind)
+
+		# Finishing at 1190 misses the 1140 boundary entirely.
+		self.clock.now += 100
+		self.scheduler.finish(second)
+		third = self.scheduler.next_pass()
+		self.assertEqual(third.started, 1200)
+		self.assertEqual(self.scheduler.skipped, 1)
+
+		stats = self.scheduler.stats()
+		self.assertEqual(stats['passes'], 3)
+		self.assertEqual(stats['lag_max'], 10)
+		self.assertEqual(stats['duration_max'], 100)
@@ -2,7 +2,8 @@
 
 import numpy as np
 from unittest import TestCase
-from leptoid.service_queue import ServiceQueue
+from leptoid.graphite import FleetMatrix
+from leptoid.service_queue import ServiceQueue, FleetQueues
 from numpy.testing import assert_equal
 
 class TestServiceQueue(TestCase):
@@ -21,3 +22,38 @@ class TestServiceQueue(TestCase):
 		# residency_time
 		rtime = self.service_time / (1 - util * self.service_time)
 		assert_equal(rtime, self.service_queue.residency_time)
+
+class TestFleetQueues(TestCase):
+
+	def setUp(self):
+		keys = [('staging', 'kbs.KRS', 'i-deadbeef'),
+				('staging', 'knewmena', 'i-beefdead')]
+		arrival_rates = FleetMatrix(0, 60, np.array(
+			[[5., 5., 5., 5.], [1., 1., 1., 1.]]), keys)
+		# Service times start a step later and lack the second host.
+		service_times = FleetMatrix(60, 60, np.array([[1., 2., 3., 4.]]),
+				keys[:1])
+		self.fleet = FleetQueues(arrival_rates, service_times)
+
+	def test_alignment(self):
+		""" Only hosts and times present in both metrics are kept. """
+		self.assertEqual(len(self.fleet), 1)
+		assert_equal(self.fleet.arrival_rate, [[5., 5., 5.]])
+		assert_equal(self.fleet.service_time, [[1., 2., 3.]])
+
+	def test_fleet_metrics(self):
+		""" Utilization and residency time are computed for every host. """
+		util = np.multiply(self.fleet.service_time, self.fleet.arrival_rate)
+		assert_equal(util, self.fleet.utilization)
+		rtime = self.fleet.service_time / (
+				1 - util * self.fleet.service_time)
+		assert_equal(rtime, self.fleet.residency_time)
+
+	def test_queue_view(self):
+		""" Views expose the ServiceQueue interface. """
+		queue = self.fleet[0]
+		self.assertEqual(queue.service, 'kbs.KRS')
+		self.assertEqual(queue.instance_id, 'i-deadbeef')
+		self.assertFalse(queue.legacy)
+		assert_equal(queue.utilization.values, [5., 10., 15.])
+		self.assertEqual(queue.get_first_timestamp(), self.fleet.index[0])
@@ -0,0 +1,152 @@
+""" Unit test for sharding the scaler across workers. """
+
+import os
+import threading
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import sleep
+from unittest import TestCase
+
+from leptoid.deploy import DeployExecutor
+
+from leptoid.sharding import HashRing, LeaseStore, ShardCoordinator, \
+		target_pair
+
+PAIRS = [(env, 'service%i' % idx) for idx in xrange(40)
+		for env in ('production', 'staging')]
+
+class TestHashRing(TestCase):
+
+	def test_balance(self):
+		""" Every worker gets a share of the names. """
+		ring = HashRing(['a', 'b', 'c'])
+		owners = [ring.owner('name%i' % idx) for idx in xrange(3000)]
+		for worker in ('a', 'b', 'c'):
+			self.assertTrue(500 < owners.count(worker) < 1500)
+		self.assertEqual(HashRing([]).owner('name'), None)
+
+	def test_stability(self):
+		""" Removing a worker only moves its own names. """
+		before = HashRing(['a', 'b', 'c'])
+		after = HashRing(['a', 'b'])
+		for idx in xrange(1000):
+			name = 'name%i' % idx
+			if before.owner(name) != 'c':
+				self.assertEqual(before.owner(name), after.owner(name))
+
+class TestShardCoordinator(TestCase):
+
+	def setUp(self):
+		self.directory = mkdtemp()
+		self.now = 1000.
+		clock = lambda: self.now
+		self.store = LeaseStore(os.path.join(self.directory, 'leases.db'),
+				clock=clock)
+		self.workers = [ShardCoordinator(self.store, name, lease_ttl=180,
+			clock=clock) for name in ('worker-a', 'worker-b')]
+
+	def tearDown(self):
+		rmtree(self.directory)
+
+	def refresh(self):
+		""" Runs a pass on every worker; the first pass of a new ring lets
+		workers release pairs that now belong to others.
+		"""
+		for _ in xrange(2):
+			owned = [worker.refresh(PAIRS) for worker in self.workers]
+		return owned
+
+	def test_split(self):
+		""" Live workers split the pairs without overlap. """
+		first, second = self.refresh()
+		self.assertEqual(first & second, set())
+		self.assertEqual(first | second, set(PAIRS))
+		self.assertTrue(first and second)
+		self.assertTrue(self.workers[0].owns(list(first)[0]))
+		self.assertFalse(self.workers[0].owns(list(second)[0]))
+
+	def test_leased_pairs(self):
+		""" A pair stays with its lease holder until it is released. """
+		first = self.workers[0].refresh(PAIRS)
+		self.assertEqual(first, set(PAIRS))
+		second = self.workers[1].refresh(PAIRS)
+		self.assertEqual(second, set())
+		first = self.workers[0].refresh(PAIRS)
+		second = self.workers[1].refresh(PAIRS)
+		self.assertEqual(first & second, set())
+		self.assertEqual(first | second, set(PAIRS))
+
+	def test_rebalance(self):
+		""" A stopped worker's pairs move once its leases expire, and right
+		away if it releases them.
+		"""
+		self.refresh()
+		self.now += 100
+		self.assertNotEqual(self.workers[0].refresh(PAIRS), set(PAIRS))
+		self.now += 100
+		self.assertEqual(self.workers[0].refresh(PAIRS), set(PAIRS))
+
+		first, second = self.refresh()
+		self.assertTrue(second)
+		self.workers[1].release()
+		self.assertEqual(self.workers[0].refresh(PAIRS), set(PAIRS))
+		self.assertEqual(self.store.live_workers(), ['worker-a'])
+
+	def test_guard(self):
+		""" Deploys fail once the lease is gone. """
+		pair = list(self.workers[0].refresh(PAIRS))[0]
+		deploy, _ = self.workers[0].guard(pair, lambda queue, timeout: queue)
+		self.assertEqual(deploy('queue', timeout=5), 'queue')
+		self.now += 200
+		self.assertRaises(Exception, deploy, 'queue', timeout=5)
+
+	def test_deploy_in_flight(self):
+		""" A pair moved to another worker while a deploy runs keeps its
+		lease, renewed past its TTL, until the deploy finishes.
+		"""
+		first, second = self.workers
+		self.assertEqual(first.refresh(PAIRS), set(PAIRS))
+		ring = HashRing(['worker-a', 'worker-b'])
+		pair = [pair for pair in PAIRS
+				if ring.owner(':'.join(pair)) == 'worker-b'][0]
+
+		started, unblock, finished = (threading.Event(), threading.Event(),
+				[])
+		def deploy(queue, timeout):
+			started.set()
+			unblock.wait(5)
+			return 1
+		first.renew_interval = 0.01
+		function, callback = first.guard(pair, deploy,
+				lambda job: finished.append(job.deploy_id))
+		executor = DeployExecutor(workers=1, timeout=900)
+		executor.submit('i-deadbeef', function, ('queue',), callback)
+		self.assertTrue(started.wait(5))
+
+		# The first worker's other leases lapse, but this one is renewed.
+		self.now += 200
+		for _ in xrange(500):
+			if first.leases[pair] > self.now:
+				break
+			sleep(0.01)
+		owned = second.refresh(PAIRS)
+		self.assertFalse(pair in owned)
+		self.assertEqual(len(owned), len(PAIRS) - 1)
+		self.assertFalse(pair in first.refresh(PAIRS))
+		self.assertFalse(first.owns(pair))
+		self.assertTrue(pair in first.leases)
+		self.assertFalse(pair in second.refresh(PAIRS))
+
+		unblock.set()
+		self.assertTrue(executor.wait(5))
+		self.assertEqual(finished, [1])
+		self.assertEqual(first.busy, {})
+		self.assertFalse(pair in first.refresh(PAIRS))
+		self.assertTrue(pair in second.refresh(PAIRS))
+
+	def test_target_pair(self):
+		""" Targets map to the pairs named on ServiceQueues. """
+		self.assertEqual(target_pair(
+			"*.Production.Application-Knewmena.Instance.*.arrival_rate"),
+			('production', 'knewmena'))
+		self.assertEqual(target_pair("carbon.agents.*"), "carbon.agents.*")
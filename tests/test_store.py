@@ -0,0 +1,66 @@
+""" Unit test for the memory-mapped history store. """
+
+import numpy as np
+from time import time
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+import leptoid.store as store
+from leptoid.graphite import GraphiteHistory
+
+class TestHistoryStore(TestCase):
+
+	def setUp(self):
+		self.directory = mkdtemp()
+		self.end = int(time()) // 60 * 60
+
+	def tearDown(self):
+		rmtree(self.directory)
+
+	def history(self):
+		return GraphiteHistory(10, 5, store.HistoryStore(self.directory,
+			'arrival_rates', 10))
+
+	def response(self, hosts, points):
+		start = self.end - points * 60
+		return [{'name': "Knewton.Staging.Webservice-KRS.%s" % host,
+			'start': start, 'step': 60,
+			'values': np.arange(points, dtype=float) + idx}
+			for idx, host in enumerate(hosts)]
+
+	def test_reopen(self):
+		""" A reopened store has the same buffers, and only the gap since
+		the last write is requested.
+		"""
+		history = self.history()
+		history.update(self.response(['i-deadbeef', 'i-beefdead'], 12))
+		before = history.extract_fleet_matrix()
+
+		reopened = self.history()
+		self.assertEqual(reopened.render_params({'from': '-3d'})['from'],
+				'-300s')
+		self.assertEqual(sorted(reopened.buffers), sorted(history.buffers))
+		after = reopened.extract_fleet_matrix()
+		for key in before.keys:
+			self.assertTrue((before.row(key) == after.row(key)).all())
+		# Reopened buffers are views onto the mapped files.
+		buf = reopened.buffers[('staging', 'kbs.KRS', 'i-deadbeef')]
+		self.assertTrue(isinstance(buf.values.base, np.memmap))
+
+	def test_growth_and_eviction(self):
+		""" Files grow past their initial rows, and evicted rows are freed.
+		"""
+		hosts = ['i-%08x' % idx for idx in range(store.INITIAL_ROWS + 1)]
+		history = self.history()
+		history.update(self.response(hosts, 5))
+		self.assertEqual(len(history.store.values), 2 * store.INITIAL_ROWS)
+
+		history.update(self.response(hosts[:1], 5))
+		self.assertEqual(len(history.buffers), 1)
+		reopened = self.history()
+		reopened.extract_fleet_matrix()
+		self.assertEqual(reopened.buffers.keys(),
+				[('staging', 'kbs.KRS', hosts[0])])
+		self.assertEqual(len(reopened.store.free),
+				2 * store.INITIAL_ROWS - 1)
@@ -0,0 +1,101 @@
+""" Unit test for Leptoid's utility functions. """
+
+import threading
+from unittest import TestCase
+from mock import Mock
+
+import leptoid.utils as utils
+
+class StubEC2Connection(object):
+	""" Stands in for boto's EC2Connection, counting calls. """
+
+	def __init__(self, sizes):
+		self.sizes = sizes
+		self.bulk_calls = 0
+		self.single_calls = 0
+
+	def get_all_instances(self):
+		self.bulk_calls += 1
+		return [Mock(instances=[Mock(id=iid, instance_type=size)
+			for iid, size in self.sizes.items()])]
+
+	def get_instance_attribute(self, instance_id, attribute):
+		self.single_calls += 1
+		return {attribute: self.sizes[instance_id]}
+
+class TestInstanceSizeCache(TestCase):
+
+	def setUp(self):
+		self.conn = StubEC2Connection(
+				{'i-deadbeef': 'm1.large', 'i-beefdead': 'm1.small'})
+		self.cache = utils.InstanceSizeCache({'staging': self.conn})
+
+	def test_bulk_refresh(self):
+		""" One describe call should serve every lookup in an environment. """
+		self.cache.refresh('staging')
+		self.cache.refresh('staging')
+		self.assertEqual(self.cache.get('staging', 'i-deadbeef'), 'm1.large')
+		self.assertEqual(self.cache.get('staging', 'i-beefdead'), 'm1.small')
+		self.assertEqual(self.conn.bulk_calls, 1)
+		self.assertEqual(self.conn.single_calls, 0)
+
+	def test_fallback_and_invalidation(self):
+		""" Unknown or invalidated ids are looked up individually. """
+		self.cache.refresh('staging')
+		self.conn.sizes['i-00000000'] = 'm2.xlarge'
+		self.assertEqual(self.cache.get('staging', 'i-00000000'), 'm2.xlarge')
+
+		self.conn.sizes['i-deadbeef'] = 'm1.xlarge'
+		self.cache.invalidate('staging', 'i-deadbeef')
+		self.assertEqual(self.cache.get('staging', 'i-deadbeef'), 'm1.xlarge')
+		self.assertEqual(self.conn.single_calls, 2)
+
+	def test_expiry(self):
+		""" Expired entries are fetched again. """
+		self.cache.ttl = 0
+		self.cache.refresh('staging')
+		self.cache.refresh('staging')
+		self.cache.get('staging', 'i-deadbeef')
+		self.assertEqual(self.conn.bulk_calls, 2)
+		self.assertEqual(self.conn.single_calls, 1)
+
+class TestLazyClients(TestCase):
+
+	def test_created_on_first_use(self):
+		""" Clients should be created once, on first access. """
+		factory = Mock(return_value='client')
+		clients = utils.LazyClients({'staging': factory})
+		self.assertFalse(factory.called)
+		self.assertEqual(clients['staging'], 'client')
+		self.assertEqual(clients['staging'], 'client')
+		self.assertEqual(factory.call_count, 1)
+
+	def test_override(self):
+		""" Assigned clients should replace the factory until reset. """
+		factory = Mock(return_value='client')
+		clients = utils.LazyClients({'staging': factory})
+		clients['staging'] = 'stand-in'
+		self.assertEqual(clients['staging'], 'stand-in')
+		clients.reset()
+		self.assertEqual(clients['staging'], 'client')
+
+class TestRRuntime(TestCase):
+
+	def test_after_fork(self):
+		""" A forked worker doesn't wait on a lock held by a parent thread. """
+		runtime = utils.RRuntime(threading.RLock())
+		held, release = threading.Event(), threading.Event()
+		def hold():
+			with runtime.lock:
+				held.set()
+				release.wait(5)
+		thread = threading.Thread(target=hold)
+		thread.start()
+		held.wait(5)
+
+		forecast = Mock()
+		runtime.after_fork()
+		runtime.override(forecast=forecast)
+		self.assertTrue(runtime.package('forecast') is forecast)
+		release.set()
+		thread.join()